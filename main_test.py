@@ -1,13 +1,15 @@
-from PyQt5.uic import loadUi
+from PyQt5.uic import loadUiType
 from PyQt5.QtWidgets import QApplication, QHBoxLayout, QMainWindow
+import os
 import sys
-from polywidget import PolyWidget
+from polywidget import PolyWidget, UI_DIR
 
 
-UI_FILE = 'mainwindow_test.ui'
+UI_FILE = os.path.join(UI_DIR, 'mainwindow_test.ui')
+MainWindowForm, _ = loadUiType(UI_FILE)
 
 
-class MainWindow(QMainWindow):
+class MainWindow(QMainWindow, MainWindowForm):
     count = 0
 
     def __init__(self, parent=None):
@@ -15,7 +17,7 @@ class MainWindow(QMainWindow):
         self._init_ui()
 
     def _init_ui(self):
-        loadUi(UI_FILE, self)
+        self.setupUi(self)
         layout = QHBoxLayout()
         self.groupBox.setLayout(layout)
 
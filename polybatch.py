@@ -0,0 +1,181 @@
+"""
+Пакетная обработка CSV файлов с полигонами без Qt и без дисплея (например, ночные задания на сервере).
+
+CSV файлы из указанных папок распределяются по процессам (ProcessPoolExecutor), а результат каждого файла
+записывается в папку --output, как только этот файл обработан:
+
+    python polybatch.py unite data/ --output out/
+    python polybatch.py intersect data/ other/ --mask mask.csv --output out/ --workers 8
+
+Операции:
+    unite - объединение всех полигонов файла;
+    intersect - каждый полигон файла обрезается маской (полигоны вне маски отбрасываются);
+    subtract - из каждого полигона файла вычитается маска.
+Маска - CSV файл того же формата, все ее полигоны объединяются. Результаты сохраняются в формате Polygon_*.csv
+"""
+import argparse
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+import numpy as np
+
+from polygeometry import booleanOperation, extractPolyCoordinates, flatGeometriesFromPolygons, \
+    polygonsFromFlatBatch, shapely, toFlatGeometry
+from polyio import readPolygonsCsv, writePolygonsCsv
+
+
+# Итог обработки одного файла: число полигонов на входе и выходе, вершин на выходе и время обработки (секунды)
+FileResult = namedtuple("FileResult", ["source", "output", "polygons", "results", "vertices", "seconds"])
+
+# Объединенная маска в процессе-исполнителе (загружается один раз при запуске процесса)
+_mask = None
+
+
+def uniteAll(flatGeometries):
+    if len(flatGeometries) < 2:
+        return list(flatGeometries)
+    return [extractPolyCoordinates(result) for result in booleanOperation("Unite", flatGeometries)]
+
+
+def intersectMask(flatGeometries):
+    """
+    Обрезает все полигоны маской одним вызовом shapely.intersection. Полигоны, не задевающие маску,
+    отсеиваются заранее по подготовленной маске
+    """
+    polygons = polygonsFromFlatBatch(flatGeometries)
+    hits = shapely.intersects(_mask, polygons)
+    return [flat for flat in flatGeometriesFromPolygons(shapely.intersection(polygons[hits], _mask))
+            if flat is not None]
+
+
+def subtractMask(flatGeometries):
+    """
+    Вычитает маску из всех полигонов одним вызовом shapely.difference. Полигоны, не задевающие маску,
+    остаются как есть
+    """
+    polygons = polygonsFromFlatBatch(flatGeometries)
+    hits = np.flatnonzero(shapely.intersects(_mask, polygons))
+    results = list(flatGeometries)
+    for i, flat in zip(hits.tolist(), flatGeometriesFromPolygons(shapely.difference(polygons[hits], _mask))):
+        results[i] = flat
+    return [flat for flat in results if flat is not None]
+
+
+BATCH_OPERATIONS = {
+    "unite": uniteAll,
+    "intersect": intersectMask,
+    "subtract": subtractMask,
+}
+MASK_OPERATIONS = ("intersect", "subtract")
+
+
+def loadMask(path):
+    """
+    Объединяет все полигоны CSV файла маски в одну подготовленную (shapely.prepare) геометрию
+    """
+    flatGeometries = [toFlatGeometry(coordinates) for _, coordinates in readPolygonsCsv(path)]
+    if not flatGeometries:
+        raise ValueError(f"There are no polygons in mask {path}")
+    mask = shapely.union_all(polygonsFromFlatBatch(flatGeometries))
+    shapely.prepare(mask)
+    return mask
+
+
+def _initWorker(maskPath):
+    global _mask
+    _mask = loadMask(maskPath) if maskPath else None
+
+
+def processFile(operation, source, output):
+    """
+    Обрабатывает один файл в процессе-исполнителе. Результат сначала пишется во временный файл и затем
+    переименовывается, поэтому в папке результатов не бывает недописанных файлов
+    """
+    start = perf_counter()
+    flatGeometries = [toFlatGeometry(coordinates) for _, coordinates in readPolygonsCsv(source)]
+    results = BATCH_OPERATIONS[operation](flatGeometries)
+
+    temporary = output + '.part'
+    writePolygonsCsv(temporary, results)
+    os.replace(temporary, output)
+    return FileResult(source, output, len(flatGeometries), len(results),
+                      sum(len(flat.coordinates) for flat in results), perf_counter() - start)
+
+
+def findCsvFiles(paths):
+    """
+    CSV файлы из папок (без вложенных папок, по алфавиту) и явно указанные файлы
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                  if name.lower().endswith('.csv')))
+        else:
+            sources.append(path)
+    return sources
+
+
+def outputPaths(sources, outputDir, operation):
+    """
+    Имена результатов: <имя исходного файла>_<операция>.csv в папке outputDir
+    """
+    outputs = [os.path.join(outputDir, f"{os.path.splitext(os.path.basename(source))[0]}_{operation}.csv")
+               for source in sources]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Input files with the same name would overwrite each other's results")
+    return outputs
+
+
+def runBatch(operation, sources, outputDir, maskPath=None, workers=None, report=print):
+    """
+    Обрабатывает файлы sources в пуле процессов и сообщает (report) об итоге каждого файла по мере готовности.
+    Ошибка в одном файле не останавливает остальные. Возвращает число файлов, обработанных с ошибкой
+    """
+    if operation in MASK_OPERATIONS and not maskPath:
+        raise ValueError(f"Operation {operation} needs a mask")
+    os.makedirs(outputDir, exist_ok=True)
+    outputs = outputPaths(sources, outputDir, operation)
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(maskPath,)) as pool:
+        futures = {pool.submit(processFile, operation, source, output): source
+                   for source, output in zip(sources, outputs)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                failures += 1
+                report(f"{futures[future]}: failed: {error!r}")
+                continue
+            report(f"{result.source} -> {result.output}: {result.polygons} -> {result.results} polygons, "
+                   f"{result.vertices} vertices, {result.seconds:.3f} s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless batch operations on polygon CSV files")
+    parser.add_argument("operation", choices=list(BATCH_OPERATIONS), help="operation applied to every file")
+    parser.add_argument("inputs", nargs="+", help="directories with CSV files or CSV files")
+    parser.add_argument("--output", required=True, help="directory for the results")
+    parser.add_argument("--mask", help="CSV file with the mask polygons (for intersect and subtract)")
+    parser.add_argument("--workers", type=int, help="number of worker processes (all CPUs by default)")
+    args = parser.parse_args()
+
+    if args.operation in MASK_OPERATIONS and not args.mask:
+        parser.error(f"{args.operation} needs --mask")
+    sources = findCsvFiles(args.inputs)
+    if not sources:
+        parser.error("no CSV files found")
+
+    start = perf_counter()
+    failures = runBatch(args.operation, sources, args.output, args.mask, args.workers,
+                        report=lambda line: print(line, flush=True))
+    print(f"{len(sources) - failures} of {len(sources)} files done in {perf_counter() - start:.3f} s")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+Бенчмарки горячих путей PolyWidget без окна на экране (QT_QPA_PLATFORM=offscreen).
+
+Каждый замер выполняется для всех сочетаний числа полигонов (--sizes) и числа вершин в полигоне (--vertices),
+а результаты сохраняются в JSON, чтобы сравнивать их между запусками:
+
+    python polybench.py --output before.json
+    python polybench.py --output after.json --compare before.json
+"""
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtCore, QtWidgets
+
+import argparse
+import json
+import platform
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+import numpy as np
+
+from polygeometry import POSSIBLE_OPERATIONS, toFlatGeometry
+from polyio import writePolygonsCsv
+from polywidget import PolyWidget
+
+
+SIZES = (10, 1000, 10000)
+VERTEX_COUNTS = (8, 128)
+SEED = 0
+
+# Вызовов одиночных действий (сохранение полигона, операции, смена стиля) на один замер
+SAMPLE_CALLS = 10
+
+
+def makePolygons(n, vertices, seed=SEED):
+    """
+    n простых (звездных относительно центра) полигонов по vertices вершин на квадратной сетке. Соседние
+    полигоны перекрываются, чтобы булевы операции над ними не были тривиальными
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n)))
+    centers = np.stack(np.divmod(np.arange(n), side), axis=1).astype(np.float64) * 1.5
+    angles = np.sort(rng.uniform(0, 2 * np.pi, (n, vertices)), axis=1)
+    radii = rng.uniform(0.7, 1.0, (n, vertices))
+    xs = centers[:, :1] + radii * np.cos(angles)
+    ys = centers[:, 1:] + radii * np.sin(angles)
+    return list(np.stack((xs, ys), axis=2))
+
+
+class PolyBenchmark:
+    """
+    Набор замеров. Файловые диалоги и окна сообщений подменяются, а отложенная работа виджета (перестройка
+    пакетной отрисовки, доставка сигналов фоновых задач) выполняется внутри замера через processEvents
+    """
+
+    def __init__(self, app, workdir, sampleCalls=SAMPLE_CALLS):
+        self.app = app
+        self.workdir = workdir
+        self.sampleCalls = sampleCalls
+        self.results = []
+        self._openFile = None
+        self._saveFile = None
+
+        QtWidgets.QFileDialog.getOpenFileName = lambda *args, **kw: (self._openFile, "")
+        QtWidgets.QFileDialog.getSaveFileName = lambda *args, **kw: (self._saveFile, "")
+        QtWidgets.QMessageBox.about = lambda *args, **kw: None
+
+    def run(self, sizes, vertexCounts):
+        for n in sizes:
+            for vertices in vertexCounts:
+                polygons = makePolygons(n, vertices)
+                print(f"{n} polygons x {vertices} vertices", flush=True)
+                self.benchPolyAddition(polygons)
+                self.benchLoadPoly(polygons)
+                self.benchSavePoly(polygons)
+                self.benchFindItemIndexInData(polygons)
+                self.benchStyleSetters(polygons)
+                self.benchOperations(polygons)
+                self.benchPolyDeletion(polygons)
+        return self.results
+
+    # ~~~ Замеры ~~~ #
+
+    def benchPolyAddition(self, polygons):
+        widget = self.newWidget()
+        timings = []
+        for polygon in polygons:
+            start = perf_counter()
+            widget.polyAddition(exterior=polygon)
+            self.app.processEvents()
+            timings.append(perf_counter() - start)
+        self.addResult("polyAddition", polygons, timings)
+        self.dispose(widget)
+
+    def benchLoadPoly(self, polygons):
+        self._openFile = os.path.join(self.workdir, "load.csv")
+        writePolygonsCsv(self._openFile, [toFlatGeometry(polygon) for polygon in polygons])
+
+        widget = self.newWidget()
+        start = perf_counter()
+        widget.loadPoly()
+        self.app.processEvents()
+        self.addResult("loadPoly", polygons, [perf_counter() - start])
+        assert len(widget.displayData) == len(polygons)
+        self.dispose(widget)
+
+    def benchSavePoly(self, polygons):
+        widget = self.filledWidget(polygons)
+        self._saveFile = os.path.join(self.workdir, "save.csv")
+        timings = []
+        for key_id in self.sampleKeys(widget):
+            widget.polyListWidget.setCurrentItem(widget.polyItems[key_id])
+            start = perf_counter()
+            widget.savePoly()
+            timings.append(perf_counter() - start)
+        self.addResult("savePoly", polygons, timings)
+        self.dispose(widget)
+
+    def benchFindItemIndexInData(self, polygons):
+        widget = self.filledWidget(polygons)
+        items = list(widget.polyItems.values())
+        start = perf_counter()
+        for item in items:
+            widget.findItemIndexInData(item)
+        total = perf_counter() - start
+        self.addResult("findItemIndexInData", polygons, [total / len(items)] * len(items))
+        self.dispose(widget)
+
+    def benchStyleSetters(self, polygons):
+        """
+        Каждый сеттер стиля вызывается для выбранного (редактируемого) полигона со сменой значения в панели
+        кастомизации
+        """
+        widget = self.filledWidget(polygons)
+        item = widget.polyItems[next(iter(widget.polyItems))]
+        widget.polyListWidget.setCurrentItem(item)
+
+        colors = [(255, 0, 0, 255), (0, 255, 0, 255)]
+        setters = {
+            "lineColorChanged": lambda i: widget.lineColorButtonWidget.setColor(colors[i % 2]),
+            "markerColorChanged": lambda i: widget.markerColorButtonWidget.setColor(colors[i % 2]),
+            "fillColorChanged": lambda i: widget.polyFillColorButtonWidget.setColor(colors[i % 2]),
+            "lineStyleChanged": lambda i: widget.lineStyleComboBox.setCurrentIndex(i % 4),
+            "markerStyleChanged": lambda i: widget.markerStyleComboBox.setCurrentIndex(0),
+            "lineWidthChanged": lambda i: widget.lineWidthSpinBox.setValue(1 + i % 5),
+            "markerSizeChanged": lambda i: widget.markerSizeSpinBox.setValue(1 + i % 5),
+        }
+        for name, setValue in setters.items():
+            slot = getattr(widget, name)
+            timings = []
+            for i in range(self.sampleCalls):
+                # Значение меняется без сигналов, чтобы слот вызывался ровно один раз - внутри замера
+                for w in widget.customizationWidgets():
+                    w.blockSignals(True)
+                setValue(i)
+                for w in widget.customizationWidgets():
+                    w.blockSignals(False)
+                start = perf_counter()
+                slot()
+                self.app.processEvents()
+                timings.append(perf_counter() - start)
+            self.addResult(name, polygons, timings)
+
+        # Смена цвета линий сразу у всех полигонов (выбраны все элементы списка)
+        widget.polyListWidget.selectAll()
+        timings = []
+        for i in range(self.sampleCalls):
+            widget.lineColorButtonWidget.blockSignals(True)
+            widget.lineColorButtonWidget.setColor(colors[i % 2])
+            widget.lineColorButtonWidget.blockSignals(False)
+            start = perf_counter()
+            widget.lineColorChanged()
+            self.app.processEvents()
+            timings.append(perf_counter() - start)
+        self.addResult("lineColorChanged[all]", polygons, timings)
+        self.dispose(widget)
+
+    def benchOperations(self, polygons):
+        """
+        Каждая операция из POSSIBLE_OPERATIONS над двумя соседними (перекрывающимися) полигонами, от запуска
+        до применения результата в GUI-потоке
+        """
+        if len(polygons) < 2:
+            return
+        for operation in POSSIBLE_OPERATIONS:
+            widget = self.filledWidget(polygons)
+            widget.polyOperationsComboBox.setCurrentText(operation)
+            timings = []
+            for _ in range(self.sampleCalls):
+                records = list(widget.displayData)
+                if len(records) < 2:
+                    break
+                widget.poly1LineEdit.setText(records[0].name)
+                widget.poly2LineEdit.setText(records[1].name)
+
+                start = perf_counter()
+                widget.doOperation()
+                while widget.operationJob is not None:
+                    widget.operationPool.waitForDone()
+                    self.app.processEvents()
+                timings.append(perf_counter() - start)
+            self.addResult(f"doOperation[{operation}]", polygons, timings)
+            self.dispose(widget)
+
+    def benchPolyDeletion(self, polygons):
+        widget = self.filledWidget(polygons)
+        timings = []
+        for key_id in list(widget.polyItems):
+            item = widget.polyItems[key_id]
+            widget.polyListWidget.setCurrentItem(item)
+            start = perf_counter()
+            widget.polyDeletion()
+            self.app.processEvents()
+            timings.append(perf_counter() - start)
+        self.addResult("polyDeletion", polygons, timings)
+        self.dispose(widget)
+
+    # ~~~ Сопутствующие методы ~~~ #
+
+    def newWidget(self):
+        widget = PolyWidget()
+        widget.resize(1200, 800)
+        widget.show()
+        self.app.processEvents()
+        return widget
+
+    def filledWidget(self, polygons):
+        widget = self.newWidget()
+        widget.polyBulkAddition(polygons)
+        self.app.processEvents()
+        return widget
+
+    def dispose(self, widget):
+        widget.close()
+        widget.deleteLater()
+        self.app.processEvents()
+
+    def sampleKeys(self, widget):
+        keys = list(widget.polyItems)
+        step = max(len(keys) // self.sampleCalls, 1)
+        return keys[::step][:self.sampleCalls]
+
+    def addResult(self, name, polygons, timings):
+        timings = np.asarray(timings, dtype=np.float64)
+        self.results.append({
+            "name": name,
+            "polygons": len(polygons),
+            "vertices": len(polygons[0]) if len(polygons) else 0,
+            "calls": len(timings),
+            "total": float(timings.sum()),
+            "mean": float(timings.mean()),
+            "median": float(np.median(timings)),
+            "min": float(timings.min()),
+            "max": float(timings.max()),
+        })
+
+
+def environment():
+    import shapely
+    import pyqtgraph as pg
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "shapely": shapely.__version__,
+        "pyqtgraph": pg.__version__,
+        "qt": QtCore.QT_VERSION_STR,
+    }
+
+
+def compareResults(old, new):
+    """
+    Печатает отношение медианных времен нового запуска к старому для совпадающих замеров (< 1 - ускорение)
+    """
+    oldResults = {(r["name"], r["polygons"], r["vertices"]): r for r in old["results"]}
+    for result in new["results"]:
+        key = (result["name"], result["polygons"], result["vertices"])
+        if key not in oldResults:
+            continue
+        ratio = result["median"] / oldResults[key]["median"] if oldResults[key]["median"] else float('inf')
+        print(f"{key[0]:<36} {key[1]:>6} x {key[2]:<5} {oldResults[key]['median'] * 1e3:>10.3f} ms -> "
+              f"{result['median'] * 1e3:>10.3f} ms  x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PolyWidget hot path benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="numbers of polygons")
+    parser.add_argument("--vertices", type=int, nargs="+", default=list(VERTEX_COUNTS),
+                        help="numbers of vertices per polygon")
+    parser.add_argument("--calls", type=int, default=SAMPLE_CALLS, help="calls per single-action benchmark")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    with tempfile.TemporaryDirectory() as workdir:
+        results = PolyBenchmark(app, workdir, args.calls).run(args.sizes, args.vertices)
+
+    report = {"environment": environment(), "results": results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compareResults(json.load(file), report)
+
+
+if __name__ == '__main__':
+    main()
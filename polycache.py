@@ -0,0 +1,89 @@
+import numpy as np
+from collections import OrderedDict
+import hashlib
+
+
+# Операции, результат которых не зависит от порядка операндов (результаты Symmetry Difference идут в порядке
+# операндов, поэтому она сюда не входит)
+COMMUTATIVE_OPERATIONS = ('Unite', 'Intersect')
+
+
+def geometryFingerprint(flat):
+    """
+    Отпечаток содержимого FlatGeometry: хеш BLAKE2b массивов координат и смещений (вместе с их длинами).
+    Одинаковые по содержимому геометрии дают одинаковый отпечаток, даже если это разные массивы
+    """
+    coordinates, ringOffsets, partOffsets = flat
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.array([len(coordinates), len(ringOffsets), len(partOffsets)], dtype=np.int64))
+    digest.update(np.ascontiguousarray(coordinates, dtype=np.float64))
+    digest.update(np.ascontiguousarray(ringOffsets, dtype=np.int64))
+    digest.update(np.ascontiguousarray(partOffsets, dtype=np.int64))
+    return digest.digest()
+
+
+class OperationResultCache:
+    """
+    LRU кэш результатов булевых операций. Ключ - операция и отпечатки операндов (geometryFingerprint),
+    значение - список FlatGeometry результата. Объем ограничен суммарным числом вершин в закэшированных
+    результатах: при переполнении вытесняются давно не использованные. Результаты хранятся как есть - массивы
+    FlatGeometry только для чтения, поэтому их можно отдавать повторно без копирования
+    """
+
+    MAX_VERTICES = 1_000_000
+
+    def __init__(self, maxVertices=MAX_VERTICES):
+        self.maxVertices = maxVertices
+        self._results = OrderedDict()   # ключ -> (результаты, число вершин)
+        self._vertices = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, key):
+        return key in self._results
+
+    @property
+    def vertices(self):
+        return self._vertices
+
+    @staticmethod
+    def key(operation, fingerprints):
+        """
+        Ключ кэша. Для перестановочных операций порядок операндов не важен
+        """
+        if operation in COMMUTATIVE_OPERATIONS:
+            return operation, tuple(sorted(fingerprints))
+        return operation, tuple(fingerprints)
+
+    def get(self, key):
+        """
+        Возвращает закэшированный результат (список FlatGeometry) или None
+        """
+        entry = self._results.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        return list(entry[0])
+
+    def put(self, key, results):
+        vertices = sum(len(flat.coordinates) for flat in results)
+        if vertices > self.maxVertices:
+            return
+        old = self._results.pop(key, None)
+        if old is not None:
+            self._vertices -= old[1]
+
+        while self._results and self._vertices + vertices > self.maxVertices:
+            _, (_, evicted) = self._results.popitem(last=False)
+            self._vertices -= evicted
+        self._results[key] = (tuple(results), vertices)
+        self._vertices += vertices
+
+    def clear(self):
+        self._results.clear()
+        self._vertices = 0
@@ -0,0 +1,430 @@
+import numpy as np
+from collections import namedtuple
+import importlib.util
+import sys
+
+
+def lazyImport(name):
+    """
+    Возвращает модуль, который выполняется при первом обращении к его атрибутам (importlib.util.LazyLoader).
+    Так тяжелые зависимости (shapely) не загружаются при импорте модулей и создании виджета, а только при первой
+    операции с геометрией
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+shapely = lazyImport("shapely")
+
+
+POSSIBLE_OPERATIONS = ['Unite', 'Intersect', 'Subtract', 'Symmetry Difference']
+
+# Плоское представление полигона с вырезами и частями (в стиле GeoArrow): coordinates (M, 2) - вершины всех
+# контуров подряд без замыкающих точек, ringOffsets - границы контуров в coordinates, partOffsets - границы
+# частей в ringOffsets (первый контур части - внешний, остальные - вырезы)
+FlatGeometry = namedtuple("FlatGeometry", ["coordinates", "ringOffsets", "partOffsets"])
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+def asCoordinateArray(points):
+    """
+    Преобразует последовательность точек в массив (N, 2) float64 только для чтения. Замыкающая точка
+    (совпадающая с первой) отбрасывается, так как PolyLineROI замыкает контур сам. Массивы, уже доступные только
+    для чтения (например, срезы np.memmap рабочего пространства), не копируются
+    """
+    if isinstance(points, np.ndarray) and not points.flags.writeable:
+        coordinates = np.asarray(points, dtype=np.float64)
+    else:
+        coordinates = np.array(points, dtype=np.float64)
+    if coordinates.ndim != 2 or coordinates.shape[1] != 2:
+        coordinates = coordinates.reshape(-1, 2)
+    if len(coordinates) > 1 and np.array_equal(coordinates[0], coordinates[-1]):
+        coordinates = coordinates[:-1]
+    coordinates.flags.writeable = False
+    return coordinates
+
+
+def toFlatGeometry(polygon):
+    """
+    Приводит полигон к FlatGeometry: последовательность точек становится однокольцевым полигоном,
+    а готовая FlatGeometry только переводится в режим "только для чтения"
+    """
+    if isinstance(polygon, FlatGeometry):
+        coordinates, ringOffsets, partOffsets = (np.asarray(a) for a in polygon)
+        coordinates = coordinates.astype(np.float64, copy=False)
+        if coordinates.ndim != 2 or coordinates.shape[1] != 2:
+            coordinates = coordinates.reshape(-1, 2)
+        ringOffsets = ringOffsets.astype(np.int64, copy=False)
+        partOffsets = partOffsets.astype(np.int64, copy=False)
+    else:
+        coordinates = asCoordinateArray(polygon)
+        ringOffsets = np.array([0, len(coordinates)], dtype=np.int64)
+        partOffsets = np.array([0, 1], dtype=np.int64)
+
+    for array in (coordinates, ringOffsets, partOffsets):
+        array.flags.writeable = False
+    return FlatGeometry(coordinates, ringOffsets, partOffsets)
+
+
+def extractPolyCoordinates(geom):
+    """
+    Переводит Polygon или MultiPolygon в FlatGeometry: все контуры всех частей подряд (без замыкающих точек),
+    границы контуров и границы частей. Первый контур каждой части - внешний, остальные - вырезы
+    """
+    if geom.geom_type not in ('Polygon', 'MultiPolygon'):
+        raise ValueError('Unhandled geometry type: ' + repr(geom.geom_type))
+
+    parts = shapely.get_parts(geom)
+    rings = shapely.get_rings(parts)
+    ringLengths = shapely.get_num_coordinates(rings)
+    ringsPerPart = shapely.get_num_interior_rings(parts) + 1
+
+    # get_coordinates возвращает контуры с замыкающими точками - выбросим их одной маской
+    coordinates = shapely.get_coordinates(rings)
+    keep = np.ones(len(coordinates), dtype=bool)
+    keep[np.cumsum(ringLengths) - 1] = False
+
+    return toFlatGeometry(FlatGeometry(
+        coordinates[keep],
+        np.concatenate(([0], np.cumsum(ringLengths - 1))),
+        np.concatenate(([0], np.cumsum(ringsPerPart)))
+    ))
+
+
+def checkFlatGeometry(flat):
+    """
+    Проверяет, что из FlatGeometry можно собрать полигон: в каждом контуре не меньше трех точек, а все
+    координаты конечны. Иначе бросает ValueError
+    """
+    if len(flat.ringOffsets) < 2 or np.diff(flat.ringOffsets).min() < 3:
+        raise ValueError("Every ring must have at least 3 points")
+    if not np.isfinite(flat.coordinates).all():
+        raise ValueError("Coordinates must be finite numbers")
+
+
+def polygonFromFlat(flat):
+    """
+    Собирает shapely Polygon (или MultiPolygon, если частей несколько) из FlatGeometry
+    """
+    coordinates, ringOffsets, partOffsets = flat
+    if len(ringOffsets) == 2:
+        return shapely.polygons(coordinates)
+
+    rings = shapely.linearrings(coordinates, indices=np.repeat(np.arange(len(ringOffsets) - 1), np.diff(ringOffsets)))
+    parts = shapely.polygons(rings, indices=np.repeat(np.arange(len(partOffsets) - 1), np.diff(partOffsets)))
+    return parts[0] if len(parts) == 1 else shapely.multipolygons(parts)
+
+
+def concatFlatGeometries(flatGeometries):
+    """
+    Склеивает много FlatGeometry в один буфер в стиле GeoArrow (MultiPolygon): coordinates, ringOffsets,
+    partOffsets и geometryOffsets (границы полигонов в partOffsets). Смещения каждого полигона сдвигаются
+    на число вершин и контуров всех предыдущих полигонов
+    """
+    count = len(flatGeometries)
+    vertexCounts = np.fromiter((len(f.coordinates) for f in flatGeometries), dtype=np.int64, count=count)
+    ringCounts = np.fromiter((len(f.ringOffsets) - 1 for f in flatGeometries), dtype=np.int64, count=count)
+    partCounts = np.fromiter((len(f.partOffsets) - 1 for f in flatGeometries), dtype=np.int64, count=count)
+    vertexStarts = np.concatenate(([0], np.cumsum(vertexCounts)))
+    ringStarts = np.concatenate(([0], np.cumsum(ringCounts)))
+    if not count:
+        return np.empty((0, 2)), vertexStarts, ringStarts, np.zeros(1, dtype=np.int64)
+
+    # Смещения склеиваются как есть, а сдвиг добавляется одним сложением
+    ringOffsets = np.concatenate([f.ringOffsets[:-1] for f in flatGeometries]) + \
+        np.repeat(vertexStarts[:-1], ringCounts)
+    partOffsets = np.concatenate([f.partOffsets[:-1] for f in flatGeometries]) + \
+        np.repeat(ringStarts[:-1], partCounts)
+    return (
+        np.concatenate([f.coordinates for f in flatGeometries]),
+        np.append(ringOffsets, vertexStarts[-1]),
+        np.append(partOffsets, ringStarts[-1]),
+        np.concatenate(([0], np.cumsum(partCounts))),
+    )
+
+
+# Поля метрик полигона (столбцы результата polygonMetrics)
+METRIC_FIELDS = ("area", "perimeter", "centroidX", "centroidY", "xmin", "ymin", "xmax", "ymax")
+
+
+def polygonMetrics(coordinates, ringOffsets, partOffsets, geometryOffsets):
+    """
+    Площадь (формула шнурования), периметр, центр масс и габариты сразу всех полигонов склеенного буфера
+    (concatFlatGeometries) одним проходом NumPy без сборки shapely-объектов. Площадь вырезов вычитается,
+    а их длина входит в периметр. Возвращает массив (N, len(METRIC_FIELDS)) float64
+    """
+    n = len(geometryOffsets) - 1
+    metrics = np.zeros((n, len(METRIC_FIELDS)), dtype=np.float64)
+    if not n:
+        return metrics
+
+    ringStarts = ringOffsets[:-1]
+    ringCounts = np.diff(ringOffsets)
+    polyRingStarts = partOffsets[geometryOffsets[:-1]]      # первый контур каждого полигона
+    polyVertexStarts = ringOffsets[polyRingStarts]
+
+    # Координаты сдвигаются к первой вершине своего полигона - так точнее для больших координат
+    ringPoly = np.repeat(np.arange(n), np.diff(np.append(polyRingStarts, len(ringStarts))))
+    origin = coordinates[polyVertexStarts]
+    local = coordinates - np.repeat(origin[ringPoly], ringCounts, axis=0)
+
+    # Следующая вершина в своем контуре (контуры хранятся без замыкающих точек)
+    following = np.arange(1, len(coordinates) + 1)
+    following[ringOffsets[1:] - 1] = ringStarts
+    x, y = local[:, 0], local[:, 1]
+    nx, ny = x[following], y[following]
+    cross = x * ny - nx * y
+
+    ringArea = np.add.reduceat(cross, ringStarts) / 2
+    ringMomentX = np.add.reduceat((x + nx) * cross, ringStarts) / 6
+    ringMomentY = np.add.reduceat((y + ny) * cross, ringStarts) / 6
+    ringLength = np.add.reduceat(np.hypot(nx - x, ny - y), ringStarts)
+
+    # Внешний контур части добавляет площадь, вырез - вычитает, независимо от направления обхода
+    sign = np.where(ringArea < 0, -1.0, 1.0)
+    sign[np.setdiff1d(np.arange(len(ringStarts)), partOffsets[:-1], assume_unique=True)] *= -1
+    area = np.add.reduceat(sign * ringArea, polyRingStarts)
+    momentX = np.add.reduceat(sign * ringMomentX, polyRingStarts)
+    momentY = np.add.reduceat(sign * ringMomentY, polyRingStarts)
+
+    # У вырожденных (нулевой площади) полигонов центр - среднее вершин
+    degenerate = area == 0
+    safeArea = np.where(degenerate, 1.0, area)
+    vertexCounts = np.diff(np.append(polyVertexStarts, len(coordinates)))
+    meanX = np.add.reduceat(x, polyVertexStarts) / vertexCounts
+    meanY = np.add.reduceat(y, polyVertexStarts) / vertexCounts
+
+    metrics[:, 0] = area
+    metrics[:, 1] = np.add.reduceat(ringLength, polyRingStarts)
+    metrics[:, 2] = origin[:, 0] + np.where(degenerate, meanX, momentX / safeArea)
+    metrics[:, 3] = origin[:, 1] + np.where(degenerate, meanY, momentY / safeArea)
+    metrics[:, 4:6] = np.minimum.reduceat(coordinates, polyVertexStarts)
+    metrics[:, 6:8] = np.maximum.reduceat(coordinates, polyVertexStarts)
+    return metrics
+
+
+def polygonsFromFlatBatch(flatGeometries):
+    """
+    Собирает массив shapely MultiPolygon из многих FlatGeometry одним вызовом shapely.from_ragged_array
+    по склеенному буферу координат (контуры замыкаются автоматически)
+    """
+    if not len(flatGeometries):
+        return np.empty(0, dtype=object)
+    coordinates, ringOffsets, partOffsets, geometryOffsets = concatFlatGeometries(flatGeometries)
+    return shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON, coordinates,
+                                     (ringOffsets, partOffsets, geometryOffsets))
+
+
+def flatGeometriesFromPolygons(geometries):
+    """
+    Переводит массив геометрий (например, результатов векторизованной операции) в список FlatGeometry.
+    От каждой геометрии остаются только площадные части, а для геометрий без них возвращается None.
+    Координаты всех результатов извлекаются одним вызовом shapely.to_ragged_array
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    result = [None] * len(geometries)
+
+    # Части геометрий (дважды - чтобы раскрыть MultiPolygon внутри GeometryCollection) и номера их владельцев
+    parts, owners = shapely.get_parts(geometries, return_index=True)
+    parts, inner = shapely.get_parts(parts, return_index=True)
+    owners = owners[inner]
+    keep = (shapely.get_type_id(parts) == shapely.GeometryType.POLYGON) & ~shapely.is_empty(parts)
+    parts, owners = parts[keep], owners[keep]
+    if not len(parts):
+        return result
+
+    _, coordinates, (ringOffsets, partOffsets) = shapely.to_ragged_array(parts)
+
+    # to_ragged_array возвращает контуры с замыкающими точками - выбросим их одной маской
+    keepPoints = np.ones(len(coordinates), dtype=bool)
+    keepPoints[ringOffsets[1:] - 1] = False
+    coordinates = coordinates[keepPoints]
+    ringOffsets = ringOffsets - np.arange(len(ringOffsets))
+
+    # Части одного владельца идут подряд
+    boundaries = np.flatnonzero(np.diff(owners)) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [len(owners)]))
+    for owner, p0, p1 in zip(owners[starts].tolist(), starts.tolist(), stops.tolist()):
+        r0, r1 = partOffsets[p0], partOffsets[p1]
+        v0, v1 = ringOffsets[r0], ringOffsets[r1]
+        result[owner] = toFlatGeometry(FlatGeometry(
+            coordinates[v0:v1], ringOffsets[r0:r1 + 1] - v0, partOffsets[p0:p1 + 1] - r0
+        ))
+    return result
+
+
+def flatRings(flat):
+    """
+    Возвращает список контуров FlatGeometry (срезы координат без копирования)
+    """
+    offsets = flat.ringOffsets.tolist()
+    return [flat.coordinates[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def flatExteriors(flat):
+    """
+    Возвращает внешние контуры всех частей FlatGeometry
+    """
+    offsets = flat.ringOffsets.tolist()
+    return [flat.coordinates[offsets[ring]:offsets[ring + 1]] for ring in flat.partOffsets[:-1].tolist()]
+
+
+def booleanOperation(operation, flatGeometries, isCancelled=None, progress=None):
+    """
+    Выполняет операцию из POSSIBLE_OPERATIONS над N полигонами, заданными FlatGeometry, и возвращает список
+    Polygon или MultiPolygon (вместе с вырезами), пустые результаты в список не попадают:
+        Unite - каскадное объединение всех операндов (shapely.union_all);
+        Intersect - пересечение всех операндов;
+        Subtract - первый операнд минус объединение остальных;
+        Symmetry Difference - точки, покрытые нечетным числом операндов. Результат делится по операндам:
+            каждый получает свою долю (для двух операндов - A - B и B - A), точки нескольких операндов
+            достаются первому из них.
+    Все операции, кроме Symmetry Difference, дают не больше одного результата.
+    Пары операндов, которые не могут пересекаться, отсеиваются по STRtree, построенному по операндам.
+    Работает без Qt, поэтому может выполняться в фоновом потоке: между шагами вызывается isCancelled() и при
+    отмене бросается OperationCancelled, а progress(процент) сообщает о ходе выполнения
+    """
+    def checkCancelled(percent):
+        if isCancelled is not None and isCancelled():
+            raise OperationCancelled(operation)
+        if progress is not None:
+            progress(percent)
+
+    if len(flatGeometries) < 2:
+        raise ValueError("Operation needs at least two polygons")
+
+    polygons = np.array([polygonFromFlat(flat) for flat in flatGeometries], dtype=object)
+    tree = shapely.STRtree(polygons)
+    checkCancelled(10)
+
+    if operation == "Unite":
+        result = shapely.union_all(polygons)
+
+    elif operation == "Intersect":
+        # Общий габарит всех операндов: если какой-то операнд его не задевает, пересечение пусто
+        bounds = shapely.bounds(polygons)
+        xmin, ymin = bounds[:, :2].max(axis=0)
+        xmax, ymax = bounds[:, 2:].min(axis=0)
+        if xmin > xmax or ymin > ymax or len(tree.query(shapely.box(xmin, ymin, xmax, ymax))) < len(polygons):
+            return []
+
+        # Пересекаем начиная с самых маленьких операндов, чтобы промежуточный результат быстрее сжимался
+        result = None
+        order = np.argsort(shapely.area(polygons))
+        for step, i in enumerate(order.tolist()):
+            result = polygons[i] if result is None else result.intersection(polygons[i])
+            if result.is_empty:
+                return []
+            checkCancelled(10 + 80 * (step + 1) // len(order))
+
+    elif operation == "Subtract":
+        # Вычитаем только те операнды, которые действительно пересекают уменьшаемое
+        subtrahends = [i for i in tree.query(polygons[0], predicate='intersects').tolist() if i != 0]
+        result = polygons[0]
+        if subtrahends:
+            result = result.difference(shapely.union_all(polygons[subtrahends]))
+
+    elif operation == "Symmetry Difference":
+        # Операнды разбиваются на связные группы по пересечениям: для непересекающихся операндов
+        # симметрическая разность - просто их объединение, поэтому сводить попарно нужно только внутри групп
+        groups = overlapGroups(tree, polygons)
+        shares = [None] * len(polygons)
+        for step, group in enumerate(groups):
+            part = polygons[group[0]]
+            for i in group[1:]:
+                part = part.symmetric_difference(polygons[i])
+
+            # Доля операнда - его точки из part, не доставшиеся операндам группы с меньшим номером
+            covered = None
+            for i in group:
+                share = part if len(group) == 1 else part.intersection(polygons[i])
+                shares[i] = share if covered is None else share.difference(covered)
+                covered = polygons[i] if covered is None else covered.union(polygons[i])
+            checkCancelled(10 + 80 * (step + 1) // len(groups))
+
+        checkCancelled(90)
+        return [share for share in map(_areaParts, shares) if share is not None]
+
+    else:
+        raise ValueError(f"Impossible operation {operation}")
+
+    checkCancelled(90)
+    result = _areaParts(result)
+    return [] if result is None else [result]
+
+
+def _areaParts(geometry):
+    """
+    Оставляет от результата операции (в том числе GeometryCollection) только площадные части: Polygon,
+    MultiPolygon или None, если их нет
+    """
+    parts = [part for part in shapely.get_parts(shapely.get_parts(geometry)).tolist()
+             if part.geom_type == 'Polygon' and not part.is_empty]
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else shapely.multipolygons(parts)
+
+
+def overlapGroups(tree, polygons):
+    """
+    Разбивает полигоны на связные группы по отношению "пересекается" (объединение-поиск по парам из STRtree)
+    """
+    parent = list(range(len(polygons)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    left, right = tree.query(polygons, predicate='intersects')
+    for i, j in zip(left.tolist(), right.tolist()):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    groups = {}
+    for i in range(len(polygons)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def overlayCandidates(polygonsA, polygonsB):
+    """
+    Пары-кандидаты для наложения двух групп полигонов (массивов shapely-геометрий): номера (indicesA, indicesB)
+    пар, чьи габариты пересекаются (запрос STRtree, построенного по группе B, сразу всеми полигонами группы A)
+    """
+    if not len(polygonsA) or not len(polygonsB):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    indicesA, indicesB = shapely.STRtree(polygonsB).query(polygonsA)
+    return indicesA, indicesB
+
+
+def pairIntersections(polygonsA, polygonsB, indicesA, indicesB):
+    """
+    Пересечения пар (polygonsA[indicesA[k]], polygonsB[indicesB[k]]) уже собранных shapely-геометрий одним
+    вызовом shapely.intersection. Возвращает номера k пар с непустым площадным пересечением и их FlatGeometry
+    """
+    results = flatGeometriesFromPolygons(shapely.intersection(polygonsA[indicesA], polygonsB[indicesB]))
+    found = [k for k, flat in enumerate(results) if flat is not None]
+    return found, [results[k] for k in found]
+
+
+def overlayIntersections(flatGeometriesA, flatGeometriesB, indicesA, indicesB):
+    """
+    То же, что pairIntersections, но для полигонов, заданных FlatGeometry (геометрии собираются здесь).
+    Работает без Qt, поэтому может выполняться в отдельном процессе
+    """
+    return pairIntersections(polygonsFromFlatBatch(flatGeometriesA), polygonsFromFlatBatch(flatGeometriesB),
+                             indicesA, indicesB)
@@ -0,0 +1,94 @@
+from collections import defaultdict, namedtuple
+import heapq
+
+
+# Узел графа: операция из POSSIBLE_OPERATIONS и key_id операндов (в порядке операндов)
+OperationNode = namedtuple("OperationNode", ["operation", "inputs"])
+
+
+class PolyOperationGraph:
+    """
+    Граф операций (DAG) производных полигонов. Узел - это полигон displayData с тем же key_id, чья геометрия -
+    результат операции над полигонами-входами (исходными или другими производными). Входы существуют раньше
+    узла, поэтому их key_id меньше, и обход по возрастанию key_id - топологический порядок.
+
+    Для каждого узла запоминаются отпечатки входов, по которым он вычислен в последний раз: узел из очереди
+    на пересчет пересчитывается, только если они изменились. Узлы удаленных полигонов остаются в графе, чтобы
+    после отмены удаления полигон снова стал производным
+    """
+
+    def __init__(self):
+        self._nodes = {}                        # key_id -> OperationNode
+        self._dependents = defaultdict(set)     # key_id -> key_id узлов, для которых он вход
+        self._evaluatedWith = {}                # key_id -> отпечатки входов при последнем вычислении
+        self._dirty = []                        # куча key_id узлов, ожидающих проверки
+        self._dirtySet = set()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, key_id):
+        return key_id in self._nodes
+
+    def add(self, key_id, operation, inputs, fingerprints):
+        """
+        Добавляет узел, уже вычисленный по входам с отпечатками fingerprints
+        """
+        inputs = tuple(inputs)
+        if key_id in self._nodes:
+            raise KeyError(f"Key {key_id} is already derived")
+        if any(input_id >= key_id for input_id in inputs):
+            raise ValueError("Derived polygon must be newer than its inputs")
+        self._nodes[key_id] = OperationNode(operation, inputs)
+        for input_id in inputs:
+            self._dependents[input_id].add(key_id)
+        self._evaluatedWith[key_id] = tuple(fingerprints)
+
+    def detach(self, key_id):
+        """
+        Превращает производный полигон в обычный: узел удаляется, а его зависимые узлы остаются (теперь их вход -
+        обычный полигон)
+        """
+        node = self._nodes.pop(key_id)
+        for input_id in node.inputs:
+            self._dependents[input_id].discard(key_id)
+        del self._evaluatedWith[key_id]
+        self._dirtySet.discard(key_id)
+
+    def node(self, key_id):
+        return self._nodes[key_id]
+
+    def dependents(self, key_id):
+        return set(self._dependents.get(key_id, ()))
+
+    def invalidate(self, key_id):
+        """
+        Геометрия key_id изменилась: его зависимые узлы ставятся в очередь на проверку
+        """
+        for dependent in self._dependents.get(key_id, ()):
+            self.markDirty(dependent)
+
+    def markDirty(self, key_id):
+        if key_id in self._nodes and key_id not in self._dirtySet:
+            self._dirtySet.add(key_id)
+            heapq.heappush(self._dirty, key_id)
+
+    def hasDirty(self):
+        return bool(self._dirtySet)
+
+    def popDirty(self):
+        """
+        Следующий узел на проверку в топологическом порядке. Узлы, поставленные в очередь во время обхода
+        (зависимые пересчитанных), всегда новее текущего, поэтому порядок сохраняется
+        """
+        while True:
+            key_id = heapq.heappop(self._dirty)
+            if key_id in self._dirtySet:
+                self._dirtySet.discard(key_id)
+                return key_id
+
+    def isStale(self, key_id, fingerprints):
+        return self._evaluatedWith.get(key_id) != tuple(fingerprints)
+
+    def markEvaluated(self, key_id, fingerprints):
+        self._evaluatedWith[key_id] = tuple(fingerprints)
@@ -0,0 +1,170 @@
+import numpy as np
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+
+# Изменения, которые записываются в журнал. Каждое хранит только то, что нужно, чтобы применить его в обе стороны
+PolysAdded = namedtuple("PolysAdded", ["columns"])                      # снимок PolyColumns добавленных полигонов
+PolysRemoved = namedtuple("PolysRemoved", ["columns", "rows"])          # снимок удаленных полигонов и их строки
+FieldsChanged = namedtuple("FieldsChanged", ["key_id", "old", "new"])   # {поле: значение} до и после (имя, стиль)
+VerticesMoved = namedtuple("VerticesMoved", ["key_id", "indices", "old", "new"])  # номера вершин и их координаты
+VerticesTranslated = namedtuple("VerticesTranslated", ["key_id", "offset"])      # сдвиг всех вершин (dx, dy)
+GeometryReplaced = namedtuple("GeometryReplaced", ["key_id", "old", "new"])       # FlatGeometry до и после
+
+# Допуск сравнения координат: пересчет узлов ROI в мировые координаты вносит погрешность в последние разряды,
+# и такие вершины не считаются сдвинутыми
+VERTEX_RTOL = 1e-9
+VERTEX_ATOL = 1e-9
+
+
+def verticesDelta(key_id, old, new):
+    """
+    Сжатое описание правки вершин. Если число вершин не изменилось, сдвиг всего полигона хранится как смещение
+    (VerticesTranslated), а правка узлов - как номера сдвинутых вершин и их старые и новые координаты
+    (VerticesMoved), иначе - ссылки на старую и новую геометрию (FlatGeometry). Координаты сравниваются
+    с допуском VERTEX_RTOL, VERTEX_ATOL. Возвращает None, если геометрия не изменилась
+    """
+    if len(old.coordinates) == len(new.coordinates) and np.array_equal(old.ringOffsets, new.ringOffsets):
+        moved = ~np.isclose(old.coordinates, new.coordinates, rtol=VERTEX_RTOL, atol=VERTEX_ATOL).all(axis=1)
+        indices = np.flatnonzero(moved)
+        if not len(indices):
+            return None
+        if len(indices) == len(moved):
+            shift = new.coordinates - old.coordinates
+            offset = shift.mean(axis=0)
+            if np.isclose(shift, offset, rtol=VERTEX_RTOL, atol=VERTEX_ATOL).all():
+                return VerticesTranslated(key_id, offset)
+        return VerticesMoved(key_id, indices, old.coordinates[indices], new.coordinates[indices])
+    return GeometryReplaced(key_id, old, new)
+
+
+def applyVertices(coordinates, delta, undo, inPlace=False):
+    """
+    Применяет VerticesMoved или VerticesTranslated к массиву координат (в сторону отмены, если undo).
+    При inPlace массив меняется на месте - он должен принадлежать только журналу (не передаваться в фоновые
+    задачи и кэши), иначе меняется копия. Возвращает измененный массив, снова только для чтения
+    """
+    coordinates = coordinates if inPlace else coordinates.copy()
+    coordinates.flags.writeable = True
+    try:
+        if isinstance(delta, VerticesTranslated):
+            coordinates += -delta.offset if undo else delta.offset
+        else:
+            coordinates[delta.indices] = delta.old if undo else delta.new
+    finally:
+        coordinates.flags.writeable = False
+    return coordinates
+
+
+def deltaSize(delta):
+    """
+    Оценка памяти, которую удерживает изменение (в байтах): учитываются массивы координат и смещений
+    """
+    if isinstance(delta, VerticesMoved):
+        return delta.indices.nbytes + delta.old.nbytes + delta.new.nbytes
+    if isinstance(delta, VerticesTranslated):
+        return delta.offset.nbytes
+    if isinstance(delta, GeometryReplaced):
+        return sum(array.nbytes for geometry in (delta.old, delta.new) for array in geometry)
+    if isinstance(delta, (PolysAdded, PolysRemoved)):
+        return sum(value.nbytes if isinstance(value, np.ndarray) else sum(array.nbytes for array in value)
+                   for value in delta.columns)
+    return 0
+
+
+class PolyHistory:
+    """
+    Журнал отмены и повтора действий. Шаг журнала - это список изменений (дельт), применяемых вместе
+    (например, удаление операндов и добавление результата булевой операции). Изменения, записанные внутри
+    group(), объединяются в один шаг. Объем удерживаемых данных ограничен maxBytes: при превышении забываются
+    самые старые шаги отмены
+    """
+
+    MAX_BYTES = 64 * 2 ** 20
+
+    def __init__(self, maxBytes=MAX_BYTES):
+        self.maxBytes = maxBytes
+        self._undo = deque()    # (список изменений, размер)
+        self._redo = deque()
+        self._bytes = 0
+        self._group = None
+        self._groupDepth = 0
+        self._suspended = 0
+
+    def __len__(self):
+        return len(self._undo)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def canUndo(self):
+        return bool(self._undo)
+
+    def canRedo(self):
+        return bool(self._redo)
+
+    def record(self, delta):
+        """
+        Записывает изменение. Новое действие делает шаги повтора недействительными
+        """
+        if self._suspended or delta is None:
+            return
+        if self._group is not None:
+            self._group.append(delta)
+            return
+        self._push([delta])
+
+    @contextmanager
+    def group(self):
+        if self._groupDepth == 0:
+            self._group = []
+        self._groupDepth += 1
+        try:
+            yield
+        finally:
+            self._groupDepth -= 1
+            if self._groupDepth == 0:
+                deltas, self._group = self._group, None
+                if deltas and not self._suspended:
+                    self._push(deltas)
+
+    @contextmanager
+    def suspended(self):
+        """
+        Изменения внутри блока не записываются (применение отмены и повтора)
+        """
+        self._suspended += 1
+        try:
+            yield
+        finally:
+            self._suspended -= 1
+
+    def undoStep(self):
+        """
+        Переносит последний шаг в стек повтора и возвращает его изменения (применять в обратном порядке)
+        """
+        deltas, size = self._undo.pop()
+        self._redo.append((deltas, size))
+        return deltas
+
+    def redoStep(self):
+        deltas, size = self._redo.pop()
+        self._undo.append((deltas, size))
+        return deltas
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self._bytes = 0
+
+    def _push(self, deltas):
+        self._bytes -= sum(size for _, size in self._redo)
+        self._redo.clear()
+
+        size = sum(deltaSize(delta) for delta in deltas)
+        self._undo.append((deltas, size))
+        self._bytes += size
+        while self._bytes > self.maxBytes and self._undo:
+            _, forgotten = self._undo.popleft()
+            self._bytes -= forgotten
@@ -0,0 +1,140 @@
+import numpy as np
+
+from polygeometry import shapely
+
+
+class PolySpatialIndex:
+    """
+    Пространственный индекс полигонов displayData на основе shapely.STRtree.
+
+    STRtree неизменяем, поэтому индекс состоит из построенного дерева и небольшого буфера изменений:
+    добавленные и измененные полигоны попадают в буфер (проверяется перебором), а их старые версии в дереве
+    помечаются устаревшими. Когда буфер разрастается больше REBUILD_RATIO от размера дерева (но не меньше
+    MIN_PENDING), дерево перестраивается целиком за O(n log n) при ближайшем запросе. Так добавление, удаление
+    и изменение полигона обходятся в O(1), а запросы - в O(log n + размер буфера)
+    """
+
+    REBUILD_RATIO = 0.1
+    MIN_PENDING = 64
+
+    def __init__(self):
+        self._geometries = {}       # key_id -> shapely.Polygon или MultiPolygon (актуальная версия)
+        self._tree = None
+        self._treeKeys = np.empty(0, dtype=np.int64)
+        self._treeGeometries = []
+        self._stale = set()         # key_id, чья версия в дереве устарела или удалена
+        self._pending = {}          # key_id -> геометрия, отсутствующая в дереве
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def __contains__(self, key_id):
+        return key_id in self._geometries
+
+    def geometry(self, key_id):
+        return self._geometries[key_id]
+
+    def insert(self, key_id, geometry):
+        """
+        Добавляет полигон (shapely.Polygon или MultiPolygon) или обновляет его геометрию
+        """
+        self.bulkInsert([(key_id, geometry)])
+
+    def bulkInsert(self, items):
+        """
+        Добавляет или обновляет сразу много полигонов (пары key_id, геометрия shapely)
+        """
+        for key_id, geometry in items:
+            if key_id in self._geometries and key_id not in self._pending:
+                self._stale.add(key_id)
+            self._geometries[key_id] = geometry
+            self._pending[key_id] = geometry
+
+    def remove(self, key_id):
+        del self._geometries[key_id]
+        if self._pending.pop(key_id, None) is None:
+            self._stale.add(key_id)
+
+    def rebuild(self):
+        self._treeKeys = np.fromiter(self._geometries.keys(), dtype=np.int64, count=len(self._geometries))
+        self._treeGeometries = list(self._geometries.values())
+        self._tree = shapely.STRtree(self._treeGeometries) if self._treeGeometries else None
+        self._stale = set()
+        self._pending = {}
+
+    # ~~~ Запросы ~~~ #
+
+    def queryBox(self, xmin, ymin, xmax, ymax):
+        """
+        Возвращает key_id полигонов, пересекающих прямоугольник
+        """
+        return self._query(shapely.box(xmin, ymin, xmax, ymax), 'intersects')
+
+    def queryBoxCandidates(self, xmin, ymin, xmax, ymax):
+        """
+        Возвращает key_id полигонов, чьи габариты пересекают прямоугольник (без точной проверки)
+        """
+        return self._query(shapely.box(xmin, ymin, xmax, ymax), None)
+
+    def queryPoint(self, x, y):
+        """
+        Возвращает key_id полигонов, содержащих точку (то, что находится под курсором)
+        """
+        return self._query(shapely.points(x, y), 'within')
+
+    def queryGeometry(self, geometry, predicate='intersects'):
+        """
+        Возвращает key_id полигонов, для которых выполняется predicate(geometry, полигон индекса)
+        (та же семантика, что и у STRtree.query)
+        """
+        return self._query(geometry, predicate)
+
+    def nearest(self, x, y):
+        """
+        Возвращает key_id ближайшего к точке полигона или None, если индекс пуст
+        """
+        self._maybeRebuild()
+        point = shapely.points(x, y)
+        best, bestDistance = None, np.inf
+
+        if self._tree is not None:
+            # Берем все равноудаленные кандидаты и отбрасываем устаревшие; если все устарели - перебираем
+            indices, distances = self._tree.query_nearest(point, return_distance=True, all_matches=True)
+            for index, distance in zip(indices.tolist(), distances.tolist()):
+                key_id = int(self._treeKeys[index])
+                if key_id not in self._stale and distance < bestDistance:
+                    best, bestDistance = key_id, distance
+            if best is None and self._stale:
+                fresh = [k for k in self._treeKeys.tolist() if k not in self._stale]
+                if fresh:
+                    distances = shapely.distance([self._geometries[k] for k in fresh], point)
+                    best, bestDistance = fresh[int(np.argmin(distances))], float(np.min(distances))
+
+        if self._pending:
+            pendingKeys = list(self._pending)
+            distances = shapely.distance(list(self._pending.values()), point)
+            i = int(np.argmin(distances))
+            if distances[i] < bestDistance:
+                best = pendingKeys[i]
+        return best
+
+    def _query(self, geometry, predicate):
+        self._maybeRebuild()
+        result = []
+        if self._tree is not None:
+            indices = self._tree.query(geometry, predicate=predicate)
+            result = [k for k in self._treeKeys[indices].tolist() if k not in self._stale]
+
+        if self._pending:
+            pendingKeys = list(self._pending)
+            geometries = list(self._pending.values())
+            if predicate is None:
+                mask = shapely.intersects(geometry.envelope, shapely.envelope(geometries))
+            else:
+                mask = getattr(shapely, predicate)(geometry, geometries)
+            result += [k for k, m in zip(pendingKeys, mask.tolist()) if m]
+        return result
+
+    def _maybeRebuild(self):
+        if len(self._pending) + len(self._stale) > max(self.MIN_PENDING, self.REBUILD_RATIO * len(self._treeKeys)):
+            self.rebuild()
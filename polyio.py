@@ -0,0 +1,235 @@
+import numpy as np
+from collections import namedtuple
+
+from polygeometry import FlatGeometry
+from itertools import islice
+import json
+import os
+import struct
+
+
+CSV_DELIMITER = ';'
+CSV_CHUNK_SIZE = 65536
+_COORDINATE_SEPARATORS = str.maketrans('(),', '   ')
+
+WORKSPACE_MAGIC = b'PQAREAWS'
+WORKSPACE_VERSION = 1
+WORKSPACE_ALIGNMENT = 64
+
+# Рабочее пространство в колоночном виде. Геометрия хранится в стиле GeoArrow (MultiPolygon):
+# coordinates (M, 2) - все вершины подряд, ringOffsets - границы контуров в coordinates, partOffsets - границы
+# частей в ringOffsets (первый контур части - внешний, остальные - вырезы), geometryOffsets - границы полигонов
+# в partOffsets. Остальные поля - столбцы стилей по одному значению на полигон
+Workspace = namedtuple(
+    "Workspace",
+    ["coordinates",
+     "ringOffsets",
+     "partOffsets",
+     "geometryOffsets",
+     "names",
+     "linecolor",
+     "linewidth",
+     "linestyle",
+     "markercolor",
+     "markersize",
+     "markerstyle",
+     "fillcolor"]
+)
+_WORKSPACE_ARRAYS = ["coordinates", "ringOffsets", "partOffsets", "geometryOffsets",
+                     "linecolor", "linewidth", "markercolor", "markersize", "fillcolor"]
+_WORKSPACE_STRINGS = ["linestyle", "markerstyle"]
+
+
+def readPolygonsCsv(path, chunkSize=CSV_CHUNK_SIZE):
+    """
+    Читает полигоны из CSV файла формата Polygon_*.csv (столбец exterior с точками вида "(x, y)") и выдает пары
+    (id полигона, массив координат (N, 2) float64).
+
+    В файле может быть несколько полигонов: их границы задаются либо дополнительным столбцом с id полигона
+    (например, "id;exterior"), либо пустыми строками между полигонами. Для файлов без столбца id выдается None.
+    Если в файле есть столбцы part и ring (номер части полигона и номер контура в части, 0 - внешний), вместо
+    массива координат выдается FlatGeometry с вырезами и частями. Файл читается по chunkSize строк, а координаты
+    каждой порции разбираются одним вызовом NumPy, без eval
+    """
+    with open(path, 'r', newline='') as csvfile:
+        header = csvfile.readline().strip().split(CSV_DELIMITER)
+        if 'exterior' not in header:
+            raise ValueError(f"There is no 'exterior' column in {path}")
+        exteriorColumn = header.index('exterior')
+        ringColumns = (header.index('part'), header.index('ring')) if {'part', 'ring'} <= set(header) else None
+        idColumn = next((i for i, name in enumerate(header) if name not in ('exterior', 'part', 'ring')), None)
+
+        group = 0           # номер блока между пустыми строками
+        carry = None        # (метка, [массивы координат], [номера (часть, контур)]) последнего полигона
+        while True:
+            lines = list(islice(csvfile, chunkSize))
+            if not lines:
+                break
+
+            labels, coordinates, rings, group = _parseCsvChunk(lines, exteriorColumn, idColumn, ringColumns, group)
+            if not labels:
+                continue
+
+            # Границы полигонов внутри порции - там, где меняется метка (id или номер блока)
+            boundaries = [0] + [i for i in range(1, len(labels)) if labels[i] != labels[i - 1]] + [len(labels)]
+            for start, stop in zip(boundaries[:-1], boundaries[1:]):
+                label = labels[start]
+                if carry is not None and carry[0] == label:
+                    carry[1].append(coordinates[start:stop])
+                    carry[2].extend(rings[start:stop])
+                    continue
+                if carry is not None:
+                    yield _emitPolygon(carry, idColumn, ringColumns)
+                carry = (label, [coordinates[start:stop]], rings[start:stop])
+
+        if carry is not None:
+            yield _emitPolygon(carry, idColumn, ringColumns)
+
+
+def _parseCsvChunk(lines, exteriorColumn, idColumn, ringColumns, group):
+    labels = []
+    exteriors = []
+    rings = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            group += 1
+            continue
+        fields = line.split(CSV_DELIMITER)
+        exteriors.append(fields[exteriorColumn])
+        labels.append((group, fields[idColumn]) if idColumn is not None else group)
+        if ringColumns is not None:
+            rings.append((int(fields[ringColumns[0]]), int(fields[ringColumns[1]])))
+
+    values = np.array(' '.join(exteriors).translate(_COORDINATE_SEPARATORS).split(), dtype=np.float64)
+    if len(values) != 2 * len(exteriors):
+        raise ValueError("Every 'exterior' value must be a point of two coordinates")
+    return labels, values.reshape(-1, 2), rings, group
+
+
+def _emitPolygon(carry, idColumn, ringColumns):
+    label, parts, rings = carry
+    coordinates = parts[0] if len(parts) == 1 else np.concatenate(parts)
+    key = label[1] if idColumn is not None else None
+    if ringColumns is None:
+        return key, coordinates
+
+    # Контур - это подряд идущие точки с одинаковыми (часть, контур), часть - подряд идущие контуры одной части
+    rings = np.array(rings, dtype=np.int64).reshape(-1, 2)
+    ringStarts = np.flatnonzero((rings[1:] != rings[:-1]).any(axis=1)) + 1
+    ringOffsets = np.concatenate(([0], ringStarts, [len(rings)]))
+    ringParts = rings[ringOffsets[:-1], 0]
+    partStarts = np.flatnonzero(ringParts[1:] != ringParts[:-1]) + 1
+    partOffsets = np.concatenate(([0], partStarts, [len(ringParts)]))
+    return key, FlatGeometry(coordinates, ringOffsets, partOffsets)
+
+
+def writePolygonsCsv(path, flatGeometries):
+    """
+    Записывает полигоны (FlatGeometry) в CSV файл формата Polygon_*.csv, полигоны разделяются пустыми строками.
+    Если хотя бы у одного полигона есть вырезы или несколько частей, добавляются столбцы part и ring, чтобы
+    readPolygonsCsv собрал каждый полигон обратно целиком. Файлы простых полигонов остаются в прежнем формате
+    """
+    flatGeometries = list(flatGeometries)
+    withRings = any(len(flat.ringOffsets) > 2 for flat in flatGeometries)
+    with open(path, 'w', newline='') as csvfile:
+        csvfile.write(CSV_DELIMITER.join(('part', 'ring', 'exterior')) + '\r\n' if withRings else 'exterior\r\n')
+        for i, flat in enumerate(flatGeometries):
+            if i:
+                csvfile.write('\r\n')
+            if not withRings:
+                csvfile.writelines(f"({x!r}, {y!r})\r\n" for x, y in flat.coordinates.tolist())
+                continue
+
+            ringOffsets = flat.ringOffsets.tolist()
+            partOffsets = flat.partOffsets.tolist()
+            for part, (firstRing, lastRing) in enumerate(zip(partOffsets[:-1], partOffsets[1:])):
+                for ring in range(lastRing - firstRing):
+                    start, stop = ringOffsets[firstRing + ring], ringOffsets[firstRing + ring + 1]
+                    prefix = f"{part}{CSV_DELIMITER}{ring}{CSV_DELIMITER}"
+                    csvfile.writelines(f"{prefix}({x!r}, {y!r})\r\n" for x, y in flat.coordinates[start:stop].tolist())
+
+
+def writeWorkspace(path, workspace):
+    """
+    Записывает рабочее пространство в бинарный файл: сигнатура, длина и JSON заголовок (описание массивов,
+    имена полигонов и таблицы строковых стилей), затем выровненные сырые массивы. Строковые столбцы стилей
+    хранятся кодами в таблице уникальных значений
+    """
+    arrays = {name: np.ascontiguousarray(getattr(workspace, name)) for name in _WORKSPACE_ARRAYS}
+    header = {"version": WORKSPACE_VERSION, "names": list(workspace.names), "arrays": {}, "tables": {}}
+    for name in _WORKSPACE_STRINGS:
+        table, codes = np.unique(np.asarray(getattr(workspace, name), dtype=str), return_inverse=True)
+        header["tables"][name] = table.tolist()
+        arrays[name] = codes.astype(np.int32)
+
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += _aligned(array.nbytes)
+
+    headerBytes = json.dumps(header).encode('utf-8')
+    dataStart = _aligned(len(WORKSPACE_MAGIC) + 8 + len(headerBytes))
+
+    # Файл пишется рядом и затем подменяет старый: отображения старого файла в память (readWorkspace) остаются
+    # целыми, а недописанный файл не заменяет рабочий
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(WORKSPACE_MAGIC)
+        file.write(struct.pack('<Q', len(headerBytes)))
+        file.write(headerBytes)
+        file.write(b'\0' * (dataStart - file.tell()))
+        for array in arrays.values():
+            file.write(array.tobytes())
+            file.write(b'\0' * (_aligned(array.nbytes) - array.nbytes))
+    os.replace(temporary, path)
+
+
+def readWorkspace(path):
+    """
+    Открывает рабочее пространство, записанное writeWorkspace. Числовые массивы отображаются в память (np.memmap)
+    только для чтения, поэтому открытие не зависит от числа вершин: данные подгружаются при обращении
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(WORKSPACE_MAGIC)) != WORKSPACE_MAGIC:
+            raise ValueError(f"{path} is not a workspace file")
+        headerLength, = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(headerLength).decode('utf-8'))
+    if header["version"] != WORKSPACE_VERSION:
+        raise ValueError(f"Unsupported workspace version {header['version']}")
+    dataStart = _aligned(len(WORKSPACE_MAGIC) + 8 + headerLength)
+
+    fields = {"names": header["names"]}
+    for name, description in header["arrays"].items():
+        shape = tuple(description["shape"])
+        if not np.prod(shape):
+            fields[name] = np.empty(shape, dtype=description["dtype"])
+            continue
+        fields[name] = np.memmap(path, dtype=description["dtype"], mode='r',
+                                 offset=dataStart + description["offset"], shape=shape)
+    for name in _WORKSPACE_STRINGS:
+        table = header["tables"][name]
+        fields[name] = [table[code] for code in fields[name].tolist()]
+    return Workspace(**fields)
+
+
+def workspacePolygons(workspace):
+    """
+    Выдает каждый полигон рабочего пространства как FlatGeometry: координаты - срез (только для чтения) одной
+    копии всех координат, смещения контуров и частей пересчитаны от начала полигона. Координаты копируются
+    из np.memmap в память, чтобы перезапись файла (например, сохранение в тот же файл) не меняла геометрию
+    загруженных полигонов
+    """
+    coordinates = np.array(workspace.coordinates, dtype=np.float64)
+    coordinates.flags.writeable = False
+    ringOffsets = workspace.ringOffsets
+    partOffsets = workspace.partOffsets
+    geometryOffsets = workspace.geometryOffsets.tolist()
+    for firstPart, lastPart in zip(geometryOffsets[:-1], geometryOffsets[1:]):
+        parts = np.asarray(partOffsets[firstPart:lastPart + 1], dtype=np.int64)
+        rings = np.asarray(ringOffsets[parts[0]:parts[-1] + 1], dtype=np.int64)
+        yield FlatGeometry(coordinates[rings[0]:rings[-1]], rings - rings[0], parts - parts[0])
+
+
+def _aligned(size):
+    return -(-size // WORKSPACE_ALIGNMENT) * WORKSPACE_ALIGNMENT
@@ -0,0 +1,166 @@
+from PyQt5 import QtCore
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+import numpy as np
+
+from polygeometry import OperationCancelled, booleanOperation, extractPolyCoordinates, overlayCandidates, \
+    overlayIntersections, pairIntersections, polygonsFromFlatBatch
+
+
+class JobSignals(QtCore.QObject):
+    """
+    Сигналы фоновой задачи. Объект создается в GUI-потоке, поэтому сигналы, испущенные из рабочего потока,
+    доставляются в слоты виджета через очередь событий
+    """
+    progress = QtCore.pyqtSignal(int)
+    finished = QtCore.pyqtSignal(object, object)    # задача, результат
+    failed = QtCore.pyqtSignal(object, str)         # задача, описание ошибки
+    stopped = QtCore.pyqtSignal(object)             # задача завершилась любым образом (в том числе отменой)
+
+
+class PolyJob(QtCore.QRunnable):
+    """
+    Фоновая задача над полигонами в пуле потоков: сигналы, момент запуска и отмена. Прервать вызов GEOS нельзя,
+    поэтому отмена проверяется между шагами, а результат отмененной задачи никуда не передается
+    """
+
+    operation = None
+
+    def __init__(self):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.signals = JobSignals()
+        self.submitted = perf_counter()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def isCancelled(self):
+        return self._cancelled.is_set()
+
+    def checkCancelled(self):
+        if self.isCancelled():
+            raise OperationCancelled(self.operation)
+
+    def run(self):
+        try:
+            result = self.compute()
+            self.checkCancelled()
+            self.signals.progress.emit(100)
+            self.signals.finished.emit(self, result)
+        except OperationCancelled:
+            pass
+        except Exception as error:
+            self.signals.failed.emit(self, repr(error))
+        finally:
+            self.signals.stopped.emit(self)
+
+    def compute(self):
+        raise NotImplementedError
+
+
+class BooleanOperationJob(PolyJob):
+    """
+    Булева операция над N полигонами в пуле потоков. Задача получает только плоские геометрии операндов
+    (FlatGeometry, не ROI), а результат - список FlatGeometry от extractPolyCoordinates - отдает сигналом finished.
+    Вычисления GEOS в shapely 2 отпускают GIL, поэтому GUI продолжает отвечать
+    """
+
+    def __init__(self, operation, keys, flatGeometries, cacheKey=None):
+        super().__init__()
+        self.operation = operation
+        self.keys = keys
+        self.flatGeometries = flatGeometries
+        self.cacheKey = cacheKey        # ключ результата в OperationResultCache
+
+    def compute(self):
+        results = booleanOperation(self.operation, self.flatGeometries,
+                                   isCancelled=self.isCancelled, progress=self.signals.progress.emit)
+        return [extractPolyCoordinates(result) for result in results]
+
+
+class OverlayJob(PolyJob):
+    """
+    Наложение двух групп полигонов: пересечения всех пар полигонов из разных групп. Пары-кандидаты
+    отбираются по габаритам через STRtree, а пересечения считаются порциями по CHUNK_PAIRS пар. Если пар больше
+    PARALLEL_PAIRS, порции распределяются по процессам (каждому процессу передаются только полигоны его
+    порции), иначе считаются в этом же потоке. Результат - пары key_id (A, B) с непустым пересечением
+    и FlatGeometry пересечений
+    """
+
+    operation = "Overlay"
+    CHUNK_PAIRS = 4096
+    PARALLEL_PAIRS = 4 * CHUNK_PAIRS
+
+    def __init__(self, keysA, flatGeometriesA, keysB, flatGeometriesB, workers=None):
+        super().__init__()
+        self.keysA = keysA
+        self.flatGeometriesA = flatGeometriesA
+        self.keysB = keysB
+        self.flatGeometriesB = flatGeometriesB
+        self.workers = workers
+
+    def compute(self):
+        # Геометрии групп собираются один раз: и для отбора кандидатов, и для пересечений в этом потоке
+        polygonsA = polygonsFromFlatBatch(self.flatGeometriesA)
+        polygonsB = polygonsFromFlatBatch(self.flatGeometriesB)
+        indicesA, indicesB = overlayCandidates(polygonsA, polygonsB)
+        # Полигон, входящий в обе группы, с собой не пересекается, а пара полигонов из обеих групп считается
+        # один раз
+        keysA = np.asarray(self.keysA, dtype=np.int64)
+        keysB = np.asarray(self.keysB, dtype=np.int64)
+        pairA, pairB = keysA[indicesA], keysB[indicesB]
+        symmetric = np.isin(pairA, keysB) & np.isin(pairB, keysA)
+        keep = (pairA != pairB) & (~symmetric | (pairA < pairB))
+        indicesA, indicesB = indicesA[keep], indicesB[keep]
+        self.checkCancelled()
+        self.signals.progress.emit(10)
+
+        chunks = [(start, indicesA[start:start + self.CHUNK_PAIRS], indicesB[start:start + self.CHUNK_PAIRS])
+                  for start in range(0, len(indicesA), self.CHUNK_PAIRS)]
+        chunkResults = {}   # начало порции -> (номера пар с пересечением, их FlatGeometry)
+
+        if len(indicesA) <= self.PARALLEL_PAIRS:
+            for done, (start, chunkA, chunkB) in enumerate(chunks, 1):
+                self.checkCancelled()
+                chunkResults[start] = pairIntersections(polygonsA, polygonsB, chunkA, chunkB)
+                self.signals.progress.emit(10 + 90 * done // len(chunks))
+            return self._collect(chunks, chunkResults, keysA[indicesA], keysB[indicesB])
+
+        # Процессы запускаются через spawn: fork процесса с запущенными потоками Qt небезопасен
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            futures = {}
+            for start, chunkA, chunkB in chunks:
+                usedA, localA = np.unique(chunkA, return_inverse=True)
+                usedB, localB = np.unique(chunkB, return_inverse=True)
+                future = pool.submit(overlayIntersections, [self.flatGeometriesA[i] for i in usedA.tolist()],
+                                     [self.flatGeometriesB[i] for i in usedB.tolist()], localA, localB)
+                futures[future] = start
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    self.checkCancelled()
+                    chunkResults[futures[future]] = future.result()
+                    self.signals.progress.emit(10 + 90 * done // len(chunks))
+            except OperationCancelled:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        return self._collect(chunks, chunkResults, keysA[indicesA], keysB[indicesB])
+
+    @staticmethod
+    def _collect(chunks, chunkResults, pairA, pairB):
+        """
+        Склеивает результаты порций в порядке порций (а не завершения процессов), поэтому порядок результатов,
+        а с ним имена и key_id новых полигонов, от запуска к запуску не меняется
+        """
+        pairs = []
+        geometries = []
+        for start, _, _ in chunks:
+            found, results = chunkResults[start]
+            pairs.extend((int(pairA[start + k]), int(pairB[start + k])) for k in found)
+            geometries.extend(results)
+        return pairs, geometries
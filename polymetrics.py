@@ -0,0 +1,211 @@
+from PyQt5 import QtCore
+
+import numpy as np
+
+from polygeometry import METRIC_FIELDS, FlatGeometry, concatFlatGeometries, polygonMetrics
+
+
+class PolyMetrics:
+    """
+    Метрики полигонов (METRIC_FIELDS) по столбцам: одна строка массива (N, len(METRIC_FIELDS)) на полигон.
+    Метрики многих полигонов вычисляются одним проходом polygonMetrics. При удалении на место строки
+    переносится последняя, поэтому порядок строк произвольный
+    """
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self._rowOf = {}        # key_id -> строка
+        self._keys = np.full(capacity, -1, dtype=np.int64)
+        self._values = np.zeros((capacity, len(METRIC_FIELDS)), dtype=np.float64)
+
+    def __len__(self):
+        return len(self._rowOf)
+
+    def __contains__(self, key_id):
+        return key_id in self._rowOf
+
+    def rowOf(self, key_id):
+        return self._rowOf[key_id]
+
+    def keyAt(self, row):
+        return int(self._keys[row])
+
+    def keys(self):
+        return self._keys[:len(self._rowOf)]
+
+    def values(self):
+        """
+        Метрики всех полигонов (представление (N, len(METRIC_FIELDS)), строки - как у keys)
+        """
+        return self._values[:len(self._rowOf)]
+
+    def column(self, field):
+        return self.values()[:, METRIC_FIELDS.index(field)]
+
+    def set(self, keys, flatGeometries):
+        """
+        Вычисляет метрики полигонов keys по их FlatGeometry одним проходом: строки известных полигонов
+        перезаписываются, новые полигоны добавляются в конец. Возвращает строки keys
+        """
+        values = polygonMetrics(*concatFlatGeometries(flatGeometries))
+        size = len(self._rowOf)
+        newKeys = [key_id for key_id in keys if key_id not in self._rowOf]
+        if size + len(newKeys) > len(self._keys):
+            self._grow(max(2 * len(self._keys), size + len(newKeys)))
+        for row, key_id in enumerate(newKeys, size):
+            self._rowOf[key_id] = row
+            self._keys[row] = key_id
+
+        rows = np.fromiter((self._rowOf[key_id] for key_id in keys), dtype=np.int64, count=len(keys))
+        self._values[rows] = values
+        return rows
+
+    def remove(self, key_id):
+        row = self._rowOf.pop(key_id)
+        last = len(self._rowOf)
+        if row != last:
+            moved = int(self._keys[last])
+            self._keys[row] = moved
+            self._values[row] = self._values[last]
+            self._rowOf[moved] = row
+        self._keys[last] = -1
+
+    def _grow(self, capacity):
+        keys = np.full(capacity, -1, dtype=np.int64)
+        values = np.zeros((capacity, len(METRIC_FIELDS)), dtype=np.float64)
+        keys[:len(self._keys)] = self._keys
+        values[:len(self._values)] = self._values
+        self._keys, self._values = keys, values
+
+
+class PolyMetricsModel(QtCore.QAbstractTableModel):
+    """
+    Таблица метрик всех полигонов для QTableView. Изменения (polysChanged, polysRemoved) копятся и применяются
+    один раз при возврате в цикл событий: метрики всех изменившихся полигонов пересчитываются одним проходом,
+    а после правки одного полигона обновляется только его строка. Ячейки читаются из массивов по требованию
+    представления (только видимые), а сортировка - это одна перестановка np.argsort по столбцу
+    """
+
+    HEADERS = ("Имя", "Площадь", "Периметр", "Центр X", "Центр Y", "X min", "Y min", "X max", "Y max")
+    KEY_ROLE = QtCore.Qt.UserRole
+
+    def __init__(self, store, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.metrics = PolyMetrics()
+        self._order = np.empty(0, dtype=np.int64)       # строка таблицы -> строка PolyMetrics
+        self._viewRow = np.empty(0, dtype=np.int64)     # строка PolyMetrics -> строка таблицы
+        self._sortColumn = -1
+        self._sortOrder = QtCore.Qt.AscendingOrder
+        self._dirty = set()
+        self._removed = set()
+        self._flushScheduled = False
+
+    # ~~~ Изменения полигонов ~~~ #
+
+    def polysChanged(self, keys):
+        """
+        Геометрия полигонов keys появилась или изменилась
+        """
+        self._dirty.update(keys)
+        self._scheduleFlush()
+
+    def polysRemoved(self, keys):
+        for key_id in keys:
+            self._dirty.discard(key_id)
+            self._removed.add(key_id)
+        self._scheduleFlush()
+
+    def nameChanged(self, key_id):
+        if key_id in self.metrics:
+            row = int(self._viewRow[self.metrics.rowOf(key_id)])
+            self.dataChanged.emit(self.index(row, 0), self.index(row, 0))
+
+    def flush(self):
+        self._flushScheduled = False
+        removed = [key_id for key_id in self._removed if key_id in self.metrics]
+        dirty = sorted(key_id for key_id in self._dirty if key_id in self.store)
+        self._removed = set()
+        self._dirty = set()
+
+        structural = bool(removed) or any(key_id not in self.metrics for key_id in dirty)
+        if structural:
+            self.beginResetModel()
+        for key_id in removed:
+            self.metrics.remove(key_id)
+        rows = self.metrics.set(dirty, [self._flatGeometryOf(key_id) for key_id in dirty]) if dirty else []
+
+        if structural:
+            self._applySort()
+            self.endResetModel()
+        else:
+            # Порядок строк сохраняется до следующей сортировки, меняются только значения
+            for row in self._viewRow[rows].tolist():
+                self.dataChanged.emit(self.index(row, 1), self.index(row, len(self.HEADERS) - 1))
+
+    def keyAt(self, row):
+        return self.metrics.keyAt(self._order[row])
+
+    # ~~~ QAbstractTableModel ~~~ #
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.metrics)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._order[index.row()]
+        column = index.column()
+        if role == self.KEY_ROLE:
+            return self.metrics.keyAt(row)
+        if role == QtCore.Qt.DisplayRole:
+            if column == 0:
+                return self.store.get(self.metrics.keyAt(row), "name")
+            return f"{self.metrics.values()[row, column - 1]:.6g}"
+        if role == QtCore.Qt.TextAlignmentRole and column:
+            return int(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        self._sortColumn = column
+        self._sortOrder = order
+        self._applySort()
+        self.layoutChanged.emit()
+
+    # ~~~ Сопутствующие методы ~~~ #
+
+    def _applySort(self):
+        size = len(self.metrics)
+        if self._sortColumn < 0:
+            order = np.arange(size)
+        elif self._sortColumn == 0:
+            names = np.array([self.store.get(key_id, "name") for key_id in self.metrics.keys().tolist()])
+            order = np.argsort(names, kind='stable')
+        else:
+            order = np.argsort(self.metrics.values()[:, self._sortColumn - 1], kind='stable')
+        if self._sortOrder == QtCore.Qt.DescendingOrder:
+            order = order[::-1]
+
+        self._order = order
+        self._viewRow = np.empty(size, dtype=np.int64)
+        self._viewRow[order] = np.arange(size)
+
+    def _flatGeometryOf(self, key_id):
+        store = self.store
+        return FlatGeometry(store.get(key_id, "coordinates"), store.get(key_id, "ringOffsets"),
+                            store.get(key_id, "partOffsets"))
+
+    def _scheduleFlush(self):
+        if not self._flushScheduled:
+            self._flushScheduled = True
+            QtCore.QTimer.singleShot(0, self.flush)
@@ -0,0 +1,429 @@
+from PyQt5 import QtCore, QtWidgets
+import pyqtgraph as pg
+
+import numpy as np
+from math import floor, log2
+
+from polygeometry import extractPolyCoordinates, shapely
+
+
+def closedRingBuffer(coordinatesList, ringOffsetsList=None):
+    """
+    Склеивает контуры в один буфер вершин, дописывая к каждому контуру замыкающую точку, и возвращает
+    (x, y, connect), где connect[i] == False разрывает линию между i-й и (i + 1)-й вершинами.
+    Если задан ringOffsetsList, каждый элемент coordinatesList - это несколько контуров подряд с границами
+    ringOffsets (вырезы и части полигона), иначе - один контур
+    """
+    if not coordinatesList:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=bool)
+    flat = np.concatenate(coordinatesList)
+    if not len(flat):
+        return np.empty(0), np.empty(0), np.empty(0, dtype=bool)
+
+    if ringOffsetsList is None:
+        lengths = np.fromiter((len(c) for c in coordinatesList), dtype=np.int64, count=len(coordinatesList))
+    else:
+        # Смещения контуров каждого полигона сдвигаются на число вершин предыдущих полигонов
+        polygonStarts = np.cumsum([0] + [len(c) for c in coordinatesList[:-1]])
+        offsets = np.concatenate([offsets[:-1] + start for offsets, start in zip(ringOffsetsList, polygonStarts)] +
+                                 [[len(flat)]])
+        lengths = np.diff(offsets)
+        lengths = lengths[lengths > 0]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ends = starts + lengths
+    buffer = np.insert(flat, ends, flat[starts], axis=0)
+
+    connect = np.ones(len(buffer), dtype=bool)
+    connect[ends + np.arange(1, len(ends) + 1) - 1] = False
+    return buffer[:, 0], buffer[:, 1], connect
+
+
+class _BatchCurveItem(pg.PlotCurveItem):
+    """
+    PlotCurveItem, который сообщает ViewBox границы всей группы, а не только видимой (отсеченной) части.
+    Иначе автомасштабирование подстраивалось бы под отсеченные данные
+    """
+
+    fullBounds = None   # (xmin, ymin, xmax, ymax)
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        if self.fullBounds is None:
+            return None, None
+        return (self.fullBounds[0], self.fullBounds[2]) if ax == 0 else (self.fullBounds[1], self.fullBounds[3])
+
+
+class PolyBatchRenderer:
+    """
+    Пакетная отрисовка неактивных полигонов. Полигоны с одинаковым стилем линий рисуются одним PlotCurveItem
+    из общего буфера вершин (все контуры, включая вырезы и части, разделяются массивом connect), поэтому число элементов сцены зависит
+    от числа стилей, а не от числа полигонов. Перестройка буферов откладывается до ближайшей итерации
+    цикла событий, так что серия изменений дает одну перерисовку.
+
+    В буфер попадают только полигоны, чьи габариты пересекают текущую область просмотра (с запасом CULL_MARGIN) -
+    они выбираются запросом к пространственному индексу, а не перебором. Полигоны размером меньше LOD_PIXELS
+    пикселей рисуются упрощенной геометрией. Упрощенные контуры кэшируются по "корзинам" масштаба (степеням двойки
+    размера пикселя) и сбрасываются только при изменении геометрии. Полные координаты в displayData
+    не затрагиваются
+    """
+
+    LOD_PIXELS = 8
+    CULL_MARGIN = 0.25
+
+    def __init__(self, displayArea, displayData, spatialIndex, penFactory):
+        self.displayArea = displayArea
+        self.displayData = displayData
+        self.spatialIndex = spatialIndex
+        self.penFactory = penFactory
+
+        self._styleOf = {}      # key_id -> стиль линий
+        self._groups = {}       # стиль линий -> {key_id: None} (упорядоченное множество)
+        self._curves = {}       # стиль линий -> _BatchCurveItem
+        self._simplified = {}   # key_id -> {корзина масштаба: (упрощенные координаты, смещения контуров)}
+        self._dirty = set()
+        self._flushScheduled = False
+
+        # Габариты групп поддерживаются инкрементально: добавленные полигоны расширяют их, а пересчет по всей
+        # группе нужен, только если ушел полигон, касавшийся границы
+        self._keyBounds = {}    # key_id -> габариты (xmin, ymin, xmax, ymax), учтенные в габаритах группы
+        self._groupBounds = {}  # стиль линий -> габариты группы (нет записи - пересчитать по всей группе)
+        self._pending = {}      # стиль линий -> key_id, чьи габариты еще не учтены
+
+        # Состояние отсечения: расширенная область, по которой отсекали в последний раз, и корзина масштаба
+        self._cullRect = None
+        self._bucket = None
+        self._viewDirty = True
+
+        viewBox = self.displayArea.getViewBox()
+        viewBox.sigRangeChanged.connect(self.viewChanged)
+        viewBox.sigResized.connect(self.viewChanged)
+
+    def styleKey(self, key_id):
+        store = self.displayData
+        return store.get(key_id, "linecolor"), store.get(key_id, "linewidth"), store.get(key_id, "linestyle")
+
+    def show(self, key_id):
+        """
+        Добавляет полигон в пакетную отрисовку (или обновляет его стиль и геометрию)
+        """
+        style = self.styleKey(key_id)
+        oldStyle = self._styleOf.get(key_id)
+        if oldStyle is not None and oldStyle != style:
+            self._markDirty(self._discard(key_id))
+        elif oldStyle is not None:
+            self._forgetBounds(key_id, style)   # геометрия могла измениться
+
+        self._styleOf[key_id] = style
+        self._groups.setdefault(style, {})[key_id] = None
+        self._pending.setdefault(style, set()).add(key_id)
+        self._simplified.pop(key_id, None)
+        self._markDirty(style)
+
+    def hide(self, key_id):
+        """
+        Убирает полигон из пакетной отрисовки (при удалении или при переводе в редактируемый ROI)
+        """
+        if key_id in self._styleOf:
+            self._simplified.pop(key_id, None)
+            self._markDirty(self._discard(key_id))
+
+    def isShown(self, key_id):
+        return key_id in self._styleOf
+
+    def viewChanged(self, *args):
+        """
+        Перерисовка нужна, только если область просмотра вышла за пределы последнего отсечения
+        или сменилась корзина масштаба
+        """
+        (xmin, xmax), (ymin, ymax) = self.displayArea.getViewBox().viewRange()
+        if self._cullRect is not None and self._bucket == self._zoomBucket():
+            cx0, cy0, cx1, cy1 = self._cullRect
+            if cx0 <= xmin and xmax <= cx1 and cy0 <= ymin and ymax <= cy1:
+                return
+
+        self._viewDirty = True
+        self._scheduleFlush()
+
+    def flush(self):
+        """
+        Перестраивает буферы групп, которые изменились с прошлой отрисовки, а при смене области просмотра -
+        буферы всех групп
+        """
+        self._flushScheduled = False
+        dirty, self._dirty = self._dirty, set()
+
+        for style in dirty:
+            keys = self._groups.get(style)
+            if not keys:
+                self._groups.pop(style, None)
+                self._groupBounds.pop(style, None)
+                self._pending.pop(style, None)
+                if style in self._curves:
+                    self.displayArea.removeItem(self._curves.pop(style))
+                continue
+
+            curve = self._curves.get(style)
+            if curve is None:
+                curve = _BatchCurveItem(pen=self.penFactory(*style), skipFiniteCheck=True)
+                self._curves[style] = curve
+                self.displayArea.addItem(curve)
+            curve.fullBounds = list(self._updateGroupBounds(style, keys))
+
+        if self._viewDirty:
+            self._updateCullState()
+            dirty = self._curves.keys()
+
+        # Отсечение по габаритам: один запрос к индексу на все перерисовываемые группы
+        visible = {style: [] for style in dirty if style in self._curves}
+        if not visible:
+            return
+        for key_id in self.spatialIndex.queryBoxCandidates(*self._cullRect):
+            keys = visible.get(self._styleOf.get(key_id))
+            if keys is not None:
+                keys.append(key_id)
+
+        for style, keys in visible.items():
+            self._drawGroup(style, keys)
+
+    def _updateGroupBounds(self, style, keys):
+        """
+        Учитывает в габаритах группы добавленные с прошлой отрисовки полигоны (или считает габариты по всем
+        полигонам keys, если группа новая или ее граница ушла)
+        """
+        groupBounds = self._groupBounds.get(style)
+        added = list(keys) if groupBounds is None else list(self._pending.get(style, ()))
+        self._pending.pop(style, None)
+        if added:
+            bounds = shapely.bounds([self.spatialIndex.geometry(key) for key in added]).reshape(-1, 4)
+            self._keyBounds.update(zip(added, map(tuple, bounds.tolist())))
+            if groupBounds is not None:
+                bounds = np.vstack((bounds, groupBounds))
+            groupBounds = (*np.nanmin(bounds[:, :2], axis=0).tolist(), *np.nanmax(bounds[:, 2:], axis=0).tolist())
+            self._groupBounds[style] = groupBounds
+        return groupBounds
+
+    def _forgetBounds(self, key_id, style):
+        """
+        Полигон уходит из группы (или меняет геометрию). Габариты группы пересчитываются заново, только если
+        он касался их границы
+        """
+        self._pending.get(style, set()).discard(key_id)
+        bounds = self._keyBounds.pop(key_id, None)
+        groupBounds = self._groupBounds.get(style)
+        if bounds is not None and groupBounds is not None and (
+                bounds[0] <= groupBounds[0] or bounds[1] <= groupBounds[1] or
+                bounds[2] >= groupBounds[2] or bounds[3] >= groupBounds[3]):
+            del self._groupBounds[style]
+
+    def _drawGroup(self, style, keys):
+        bounds = shapely.bounds([self.spatialIndex.geometry(key) for key in keys]).reshape(-1, 4)
+
+        # Уровень детализации по экранному размеру полигона
+        px, py = self._pixelSize
+        if px > 0 and py > 0:
+            sizes = np.maximum((bounds[:, 2] - bounds[:, 0]) / px, (bounds[:, 3] - bounds[:, 1]) / py)
+            small = sizes < self.LOD_PIXELS
+        else:
+            small = np.zeros(len(keys), dtype=bool)
+
+        coordinatesList = []
+        ringOffsetsList = []
+        for i, (key, isSmall) in enumerate(zip(keys, small.tolist())):
+            if isSmall:
+                coordinates, ringOffsets = self._simplifiedCoordinates(key, bounds[i])
+            else:
+                coordinates = self.displayData.get(key, "coordinates")
+                ringOffsets = self.displayData.get(key, "ringOffsets")
+            coordinatesList.append(coordinates)
+            ringOffsetsList.append(ringOffsets)
+        x, y, connect = closedRingBuffer(coordinatesList, ringOffsetsList)
+        self._curves[style].setData(x=x, y=y, connect=connect)
+
+    def _simplifiedCoordinates(self, key_id, bounds):
+        cache = self._simplified.setdefault(key_id, {})
+        simplifiedRings = cache.get(self._bucket)
+        if simplifiedRings is None:
+            simplified = self.spatialIndex.geometry(key_id).simplify(2.0 ** self._bucket, preserve_topology=False)
+            if simplified.is_empty or simplified.geom_type not in ('Polygon', 'MultiPolygon'):
+                # Полигон схлопнулся - рисуем его габаритный прямоугольник
+                xmin, ymin, xmax, ymax = bounds
+                simplifiedRings = (np.array([(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]),
+                                   np.array([0, 4]))
+            else:
+                flat = extractPolyCoordinates(simplified)
+                simplifiedRings = (flat.coordinates, flat.ringOffsets)
+            cache[self._bucket] = simplifiedRings
+        return simplifiedRings
+
+    def _updateCullState(self):
+        self._viewDirty = False
+        (xmin, xmax), (ymin, ymax) = self.displayArea.getViewBox().viewRange()
+        dx = (xmax - xmin) * self.CULL_MARGIN
+        dy = (ymax - ymin) * self.CULL_MARGIN
+        self._cullRect = (xmin - dx, ymin - dy, xmax + dx, ymax + dy)
+        self._bucket = self._zoomBucket()
+
+    def _zoomBucket(self):
+        px, py = self._pixelSize
+        size = max(px, py)
+        return floor(log2(size)) if size > 0 else None
+
+    @property
+    def _pixelSize(self):
+        try:
+            px, py = self.displayArea.getViewBox().viewPixelSize()
+        except Exception:
+            return 0, 0
+        return (px, py) if np.isfinite(px) and np.isfinite(py) else (0, 0)
+
+    def _discard(self, key_id):
+        style = self._styleOf.pop(key_id)
+        del self._groups[style][key_id]
+        self._forgetBounds(key_id, style)
+        return style
+
+    def _markDirty(self, style):
+        self._dirty.add(style)
+        self._scheduleFlush()
+
+    def _scheduleFlush(self):
+        if not self._flushScheduled:
+            self._flushScheduled = True
+            QtCore.QTimer.singleShot(0, self.flush)
+
+
+def fillPath(coordinates, ringOffsets):
+    """
+    Строит QPainterPath заливки полигона из всех его контуров (по правилу четности: вырезы остаются пустыми)
+    """
+    x, y, connect = closedRingBuffer([coordinates], [ringOffsets])
+    path = pg.arrayToQPath(x, y, connect)
+    path.setFillRule(QtCore.Qt.OddEvenFill)
+    return path
+
+
+class _FillGroupItem(QtWidgets.QGraphicsItem):
+    """
+    Заливка группы полигонов одного цвета. Пути заливки готовые (из кэша PolyFillRenderer), поэтому отрисовка -
+    это только drawPath для путей, чьи габариты попадают в перерисовываемую область
+    """
+
+    def __init__(self, brush):
+        super().__init__()
+        self.brush = brush
+        self.paths = []                 # [(QPainterPath, габариты)]
+        self._bounds = QtCore.QRectF()
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def setPaths(self, paths):
+        self.prepareGeometryChange()
+        self.paths = paths
+        bounds = QtCore.QRectF()
+        for _, rect in paths:
+            bounds = bounds.united(rect)
+        self._bounds = bounds
+        self.update()
+
+    def boundingRect(self):
+        return self._bounds
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(self.brush)
+        exposed = option.exposedRect
+        for path, rect in self.paths:
+            if rect.intersects(exposed):
+                painter.drawPath(path)
+
+
+class PolyFillRenderer:
+    """
+    Заливка полигонов. Путь заливки (QPainterPath со всеми контурами, включая вырезы) строится для полигона
+    один раз и кэшируется до изменения его геометрии (invalidate). Полигоны одного цвета заливки рисуются одним
+    элементом сцены, поэтому смена цвета только переносит готовый путь в группу с другой кистью, а сдвиг
+    и масштабирование области просмотра пути не перестраивают. Полигоны с прозрачной заливкой не рисуются.
+    Как и в PolyBatchRenderer, перестройка групп откладывается до ближайшей итерации цикла событий
+    """
+
+    def __init__(self, displayArea, displayData, brushFactory):
+        self.displayArea = displayArea
+        self.displayData = displayData
+        self.brushFactory = brushFactory
+
+        self._colorOf = {}      # key_id -> цвет заливки
+        self._groups = {}       # цвет -> {key_id: None} (упорядоченное множество)
+        self._items = {}        # цвет -> _FillGroupItem
+        self._paths = {}        # key_id -> (QPainterPath, габариты)
+        self._dirty = set()
+        self._flushScheduled = False
+
+    def show(self, key_id):
+        """
+        Добавляет заливку полигона (или переносит ее в группу нового цвета). Путь заливки не перестраивается
+        """
+        color = self.displayData.get(key_id, "fillcolor")
+        oldColor = self._colorOf.get(key_id)
+        if oldColor == color:
+            return
+        if oldColor is not None:
+            self._markDirty(self._discard(key_id))
+        if color[3] == 0:
+            return
+
+        self._colorOf[key_id] = color
+        self._groups.setdefault(color, {})[key_id] = None
+        self._markDirty(color)
+
+    def hide(self, key_id):
+        self._paths.pop(key_id, None)
+        if key_id in self._colorOf:
+            self._markDirty(self._discard(key_id))
+
+    def invalidate(self, key_id):
+        """
+        Сбрасывает путь заливки после изменения геометрии полигона
+        """
+        self._paths.pop(key_id, None)
+        color = self._colorOf.get(key_id)
+        if color is not None:
+            self._markDirty(color)
+
+    def cachedPaths(self):
+        return len(self._paths)
+
+    def flush(self):
+        self._flushScheduled = False
+        dirty, self._dirty = self._dirty, set()
+
+        for color in dirty:
+            keys = self._groups.get(color)
+            if not keys:
+                self._groups.pop(color, None)
+                if color in self._items:
+                    self.displayArea.removeItem(self._items.pop(color))
+                continue
+
+            item = self._items.get(color)
+            if item is None:
+                item = _FillGroupItem(self.brushFactory(color))
+                item.setZValue(-1)
+                self._items[color] = item
+                self.displayArea.addItem(item)
+            item.setPaths([self._path(key_id) for key_id in keys])
+
+    def _path(self, key_id):
+        cached = self._paths.get(key_id)
+        if cached is None:
+            path = fillPath(self.displayData.get(key_id, "coordinates"), self.displayData.get(key_id, "ringOffsets"))
+            cached = self._paths[key_id] = (path, path.boundingRect())
+        return cached
+
+    def _discard(self, key_id):
+        color = self._colorOf.pop(key_id)
+        del self._groups[color][key_id]
+        return color
+
+    def _markDirty(self, color):
+        self._dirty.add(color)
+        if not self._flushScheduled:
+            self._flushScheduled = True
+            QtCore.QTimer.singleShot(0, self.flush)
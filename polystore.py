@@ -0,0 +1,359 @@
+import numpy as np
+from collections import namedtuple
+
+
+# Снимок всех полей полигона. Хранилище держит поля по столбцам, а такие записи создаются только при добавлении
+# полигона и при чтении целой записи (например, для журнала отмены)
+PolyRecord = namedtuple(
+    "PolyRecord",
+    ["key_id",
+     "name",
+     "coordinates",
+     "ringOffsets",
+     "partOffsets",
+     "exterior_object",
+     "linecolor",
+     "linewidth",
+     "linestyle",
+     "markercolor",
+     "markersize",
+     "markerstyle",
+     "fillcolor"]
+)
+
+# Снимок многих полигонов по столбцам (PolyStore.columns): key_id, стили и имена - массивы NumPy (строковые поля
+# хранятся кодами таблиц хранилища), геометрия - списки массивов. Пакет полигонов - один снимок, а не PolyRecord
+# на каждый полигон (так их добавляют и хранит журнал отмены). Объект ROI в снимок не входит
+PolyColumns = namedtuple(
+    "PolyColumns",
+    ["key_id",
+     "name",
+     "coordinates",
+     "ringOffsets",
+     "partOffsets",
+     "linecolor",
+     "linewidth",
+     "linestyle",
+     "markercolor",
+     "markersize",
+     "markerstyle",
+     "fillcolor"]
+)
+
+# Числовые столбцы: поле -> (dtype, форма одного значения)
+_NUMERIC_FIELDS = {
+    "linecolor": (np.uint8, (4,)),
+    "linewidth": (np.int32, ()),
+    "markercolor": (np.uint8, (4,)),
+    "markersize": (np.int32, ()),
+    "fillcolor": (np.uint8, (4,)),
+}
+_COLOR_FIELDS = ("linecolor", "markercolor", "fillcolor")
+# Строковые столбцы хранятся кодами в таблице интернированных значений. Таблица только растет, поэтому коды
+# в снимках (PolyColumns) остаются действительными
+_STRING_FIELDS = ("name", "linestyle", "markerstyle")
+# Поля, которые хранятся объектами Python (по одному на строку)
+_OBJECT_FIELDS = ("coordinates", "ringOffsets", "partOffsets", "exterior_object")
+_GEOMETRY_FIELDS = ("coordinates", "ringOffsets", "partOffsets")
+
+
+class PolyStore:
+    """
+    Хранилище отображаемых полигонов (displayData) в виде структуры массивов. Каждому полигону выделяется
+    строка: стили лежат в столбцах NumPy (цвета - (N, 4) uint8, толщины и размеры - int32, имена, стили линий
+    и узлов - коды в таблицах интернированных строк), а геометрия и объект ROI - в списках того же размера.
+    Освободившиеся строки переиспользуются, а при заполнении емкость удваивается.
+
+    Изменение полей (update) выполняется на месте за O(1), поиск по key_id, имени и объекту ROI, как и проверка
+    уникальности имени, - тоже за O(1) с помощью хеш-индексов. Выборки по значениям стиля (keysWhere)
+    и чтение целого столбца (column) векторизованы. Порядок обхода - порядок добавления
+    """
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self._rowOf = {}        # key_id -> строка (упорядочено по добавлению)
+        self._freeRows = []
+        self._capacity = 0
+        self._keyIds = np.empty(0, dtype=np.int64)
+        self._numeric = {field: np.empty((0,) + shape, dtype=dtype)
+                         for field, (dtype, shape) in _NUMERIC_FIELDS.items()}
+        self._codes = {field: np.empty(0, dtype=np.int32) for field in _STRING_FIELDS}
+        self._tables = {field: [] for field in _STRING_FIELDS}      # код -> строка
+        self._tableIndex = {field: {} for field in _STRING_FIELDS}  # строка -> код
+        self._objects = {field: [] for field in _OBJECT_FIELDS}
+        self._byName = {}       # имя -> key_id
+        self._byRoi = {}        # объект ROI -> key_id
+        self._grow(max(capacity, 1))
+
+    def __len__(self):
+        return len(self._rowOf)
+
+    def __iter__(self):
+        for key_id in list(self._rowOf):
+            yield self[key_id]
+
+    def __contains__(self, key_id):
+        return key_id in self._rowOf
+
+    def __getitem__(self, key_id):
+        """
+        Снимок записи (PolyRecord). Для чтения одного поля дешевле get
+        """
+        row = self._rowOf[key_id]
+        return PolyRecord(key_id, *(self._read(field, row) for field in PolyRecord._fields[1:]))
+
+    def __setitem__(self, key_id, record):
+        """
+        Замена всех полей записи с тем же key_id
+        """
+        if record.key_id != key_id:
+            raise KeyError("Record key_id doesn't match the key it is stored under")
+        self.update(key_id, **record._asdict())
+
+    def get(self, key_id, field):
+        return self._read(field, self._rowOf[key_id])
+
+    def update(self, key_id, **fields):
+        """
+        Меняет поля полигона на месте. Индексы по имени и ROI обновляются, если соответствующие поля изменились
+        """
+        row = self._rowOf[key_id]
+        fields.pop("key_id", None)
+
+        name = fields.get("name")
+        if name is not None and name != self._read("name", row):
+            if name in self._byName:
+                raise ValueError("No two names can be the same")
+            del self._byName[self._read("name", row)]
+            self._byName[name] = key_id
+
+        if "exterior_object" in fields:
+            old = self._objects["exterior_object"][row]
+            roi = fields["exterior_object"]
+            if old is not roi:
+                self._byRoi.pop(old, None)
+                if roi is not None:
+                    self._byRoi[roi] = key_id
+
+        for field, value in fields.items():
+            self._write(field, row, value)
+
+    def add(self, record):
+        if record.key_id in self._rowOf:
+            raise KeyError(f"Key {record.key_id} is already in store")
+        if record.name in self._byName:
+            raise ValueError("No two names can be the same")
+
+        if not self._freeRows:
+            self._grow(2 * self._capacity)
+        row = self._freeRows.pop()
+
+        self._rowOf[record.key_id] = row
+        self._keyIds[row] = record.key_id
+        for field, value in zip(PolyRecord._fields[1:], record[1:]):
+            self._write(field, row, value)
+        self._byName[record.name] = record.key_id
+        if record.exterior_object is not None:
+            self._byRoi[record.exterior_object] = record.key_id
+
+    def addColumns(self, columns):
+        """
+        Добавляет пакет полигонов, заданный снимком столбцов (PolyColumns): числовые поля и коды записываются
+        в строки хранилища одним присваиванием на столбец
+        """
+        keys = columns.key_id.tolist()
+        names = self.decode("name", columns.name)
+        if any(key_id in self._rowOf for key_id in keys):
+            raise KeyError("Some keys are already in store")
+        if len(set(names)) != len(names) or any(name in self._byName for name in names):
+            raise ValueError("No two names can be the same")
+
+        capacity = self._capacity
+        while len(self._freeRows) + capacity - self._capacity < len(keys):
+            capacity *= 2
+        if capacity != self._capacity:
+            self._grow(capacity)
+        rows = [self._freeRows.pop() for _ in keys]
+
+        rowIndex = np.array(rows, dtype=np.int64)
+        self._keyIds[rowIndex] = columns.key_id
+        for field in self._numeric:
+            self._numeric[field][rowIndex] = getattr(columns, field)
+        for field in self._codes:
+            self._codes[field][rowIndex] = getattr(columns, field)
+        for field in _GEOMETRY_FIELDS:
+            objects = self._objects[field]
+            for row, value in zip(rows, getattr(columns, field)):
+                objects[row] = value
+        self._rowOf.update(zip(keys, rows))
+        self._byName.update(zip(names, keys))
+
+    def columns(self, keys):
+        """
+        Снимок столбцов (PolyColumns) полигонов keys в заданном порядке
+        """
+        rows = np.fromiter((self._rowOf[key_id] for key_id in keys), dtype=np.int64, count=len(keys))
+        objects = {field: [self._objects[field][row] for row in rows.tolist()] for field in _GEOMETRY_FIELDS}
+        return PolyColumns(
+            key_id=self._keyIds[rows],
+            **objects,
+            **{field: column[rows] for field, column in self._numeric.items()},
+            **{field: column[rows] for field, column in self._codes.items()}
+        )
+
+    def newColumns(self, keys, names, geometries, style, overrides=()):
+        """
+        Снимок столбцов (PolyColumns) новых полигонов: у всех стиль style (словарь полей стиля), кроме полигонов
+        из overrides - пар (номер в пакете, словарь полей стиля)
+        """
+        count = len(keys)
+        columns = {}
+        for field, (dtype, shape) in _NUMERIC_FIELDS.items():
+            columns[field] = np.empty((count,) + shape, dtype=dtype)
+            columns[field][:] = style[field]
+        for field in ("linestyle", "markerstyle"):
+            columns[field] = np.full(count, self._intern(field, style[field]), dtype=np.int32)
+        for index, fields in overrides:
+            for field, value in fields.items():
+                columns[field][index] = self._intern(field, value) if field in self._codes else value
+
+        return PolyColumns(
+            key_id=np.asarray(keys, dtype=np.int64),
+            name=self.intern("name", names),
+            coordinates=[geometry.coordinates for geometry in geometries],
+            ringOffsets=[geometry.ringOffsets for geometry in geometries],
+            partOffsets=[geometry.partOffsets for geometry in geometries],
+            **columns
+        )
+
+    def intern(self, field, values):
+        """
+        Коды строк values в таблице строкового поля field (новые строки добавляются в таблицу)
+        """
+        return np.fromiter((self._intern(field, value) for value in values), dtype=np.int32)
+
+    def decode(self, field, codes):
+        table = self._tables[field]
+        return [table[code] for code in np.asarray(codes).tolist()]
+
+    def remove(self, key_id):
+        row = self._rowOf.pop(key_id)
+        del self._byName[self._read("name", row)]
+        self._byRoi.pop(self._objects["exterior_object"][row], None)
+
+        # Строка освобождается: ссылки на геометрию и ROI отпускаются, а key_id помечается пустым
+        for field in _OBJECT_FIELDS:
+            self._objects[field][row] = None
+        self._keyIds[row] = -1
+        self._freeRows.append(row)
+
+    def keys(self):
+        return self._rowOf.keys()
+
+    def names(self):
+        """
+        Возвращает имена полигонов (представление с проверкой вхождения за O(1))
+        """
+        return self._byName.keys()
+
+    def hasName(self, name):
+        return name in self._byName
+
+    def keyByName(self, name):
+        return self._byName.get(name)
+
+    def keyByRoi(self, roi):
+        return self._byRoi.get(roi)
+
+    def roiKeys(self):
+        """
+        Возвращает key_id полигонов, у которых есть объект ROI
+        """
+        return list(self._byRoi.values())
+
+    def column(self, field):
+        """
+        Значения поля у всех полигонов в порядке добавления: массив NumPy для числовых полей и список для
+        строковых и объектных
+        """
+        rows = self._rows()
+        if field == "key_id":
+            return self._keyIds[rows]
+        if field in self._numeric:
+            return self._numeric[field][rows]
+        if field in self._codes:
+            return self.decode(field, self._codes[field][rows])
+        objects = self._objects[field]
+        return [objects[row] for row in rows.tolist()]
+
+    def keysWhere(self, **fields):
+        """
+        Возвращает key_id (в порядке добавления) полигонов, у которых все заданные поля стиля равны заданным
+        значениям, например keysWhere(linecolor=(255, 0, 0, 255), linestyle='Solid')
+        """
+        rows = self._rows()
+        mask = np.ones(len(rows), dtype=bool)
+        for field, value in fields.items():
+            if field in self._numeric:
+                values = self._numeric[field][rows]
+                equal = values == np.asarray(value, dtype=values.dtype)
+                mask &= equal.all(axis=1) if equal.ndim > 1 else equal
+            elif field in self._codes:
+                code = self._tableIndex[field].get(value)
+                if code is None:
+                    return []
+                mask &= self._codes[field][rows] == code
+            else:
+                raise KeyError(f"Field {field} can't be queried")
+        return self._keyIds[rows[mask]].tolist()
+
+    @property
+    def nbytes(self):
+        """
+        Память столбцов NumPy (без геометрии, на которую ссылаются записи)
+        """
+        return self._keyIds.nbytes + sum(a.nbytes for a in self._numeric.values()) + \
+            sum(a.nbytes for a in self._codes.values())
+
+    def _rows(self):
+        return np.fromiter(self._rowOf.values(), dtype=np.int64, count=len(self._rowOf))
+
+    def _read(self, field, row):
+        objects = self._objects.get(field)
+        if objects is not None:
+            return objects[row]
+        if field in self._codes:
+            return self._tables[field][self._codes[field][row]]
+        value = self._numeric[field][row].tolist()
+        return tuple(value) if field in _COLOR_FIELDS else value
+
+    def _write(self, field, row, value):
+        if field in self._numeric:
+            self._numeric[field][row] = value
+        elif field in self._codes:
+            self._codes[field][row] = self._intern(field, value)
+        else:
+            self._objects[field][row] = value
+
+    def _intern(self, field, value):
+        index = self._tableIndex[field]
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(self._tables[field])
+            self._tables[field].append(value)
+        return code
+
+    def _grow(self, capacity):
+        old = self._capacity
+        self._keyIds = np.concatenate((self._keyIds, np.full(capacity - old, -1, dtype=np.int64)))
+        for field, column in self._numeric.items():
+            self._numeric[field] = np.concatenate((column, np.zeros((capacity - old,) + column.shape[1:],
+                                                                    dtype=column.dtype)))
+        for field, column in self._codes.items():
+            self._codes[field] = np.concatenate((column, np.zeros(capacity - old, dtype=column.dtype)))
+        for column in self._objects.values():
+            column.extend([None] * (capacity - old))
+        # Свободные строки выдаются с конца списка, поэтому младшие строки заполняются первыми
+        self._freeRows.extend(range(capacity - 1, old - 1, -1))
+        self._capacity = capacity
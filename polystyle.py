@@ -0,0 +1,54 @@
+from PyQt5 import QtCore
+import pyqtgraph as pg
+
+
+LINE_STYLES = {
+    "solid": QtCore.Qt.SolidLine,
+    "dashed": QtCore.Qt.DashLine,
+    "dash-dotted": QtCore.Qt.DashDotLine,
+}
+
+
+def penStyleFromStr(string):
+    return LINE_STYLES.get(string.lower(), QtCore.Qt.DotLine)
+
+
+class PolyStyleCache:
+    """
+    Интернированные QPen и QBrush: на каждый набор полей стиля создается один объект, который затем раздается
+    всем полигонам и узлам с этим стилем. Объекты общие, поэтому их нельзя менять на месте (setColor, setWidth) -
+    при смене стиля объекту присваивается другое перо из кэша
+    """
+
+    def __init__(self):
+        self._pens = {}         # (вид пера, цвет, толщина, стиль) -> QPen
+        self._brushes = {}      # цвет -> QBrush
+
+    def __len__(self):
+        return len(self._pens) + len(self._brushes)
+
+    def linePen(self, linecolor, linewidth, linestyle):
+        key = ("line", tuple(linecolor), linewidth, linestyle)
+        pen = self._pens.get(key)
+        if pen is None:
+            pen = self._pens[key] = pg.mkPen(tuple(linecolor), width=linewidth / 3,
+                                             style=penStyleFromStr(linestyle))
+        return pen
+
+    def handlePen(self, markercolor, markersize):
+        key = ("handle", tuple(markercolor), markersize, None)
+        pen = self._pens.get(key)
+        if pen is None:
+            pen = self._pens[key] = pg.mkPen(tuple(markercolor), width=markersize)
+        return pen
+
+    def brush(self, fillcolor):
+        key = tuple(fillcolor)
+        brush = self._brushes.get(key)
+        if brush is None:
+            brush = self._brushes[key] = pg.mkBrush(key)
+        return brush
+
+    def clear(self):
+        self._pens.clear()
+        self._brushes.clear()
@@ -0,0 +1,144 @@
+import numpy as np
+from time import perf_counter
+
+
+# Событие трассировки: момент завершения (секунды perf_counter), код операции, key_id полигона (-1, если
+# событие не относится к одному полигону), длительность (секунды, 0 для мгновенных событий) и число вершин
+TRACE_DTYPE = np.dtype([
+    ("timestamp", np.float64),
+    ("operation", np.uint16),
+    ("key_id", np.int64),
+    ("duration", np.float64),
+    ("vertices", np.int64),
+])
+
+
+class _Span:
+    """
+    Замер длительности операции (with tracer.span(...) as span). Число вершин можно уточнить внутри блока
+    """
+
+    __slots__ = ("tracer", "operation", "key_id", "vertices", "start")
+
+    def __init__(self, tracer, operation, key_id, vertices):
+        self.tracer = tracer
+        self.operation = operation
+        self.key_id = key_id
+        self.vertices = vertices
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = perf_counter()
+        self.tracer._write(end, self.operation, self.key_id, end - self.start, self.vertices)
+        return False
+
+
+class _NullSpan:
+    """
+    Замер при выключенной трассировке: один общий объект, который ничего не делает
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class PolyTracer:
+    """
+    Трассировка действий виджета в кольцевой буфер фиксированного размера (структурированный массив NumPy
+    с полями TRACE_DTYPE). При переполнении затираются самые старые события. Имена операций переводятся
+    в коды один раз, поэтому запись события - это одно присваивание строки массива без форматирования строк.
+    Пока трассировка выключена, record и span сразу возвращаются
+    """
+
+    CAPACITY = 65536
+
+    def __init__(self, capacity=CAPACITY, enabled=False):
+        self.enabled = enabled
+        self._events = np.zeros(capacity, dtype=TRACE_DTYPE)
+        self._count = 0         # всего записано событий (позиция записи - _count % capacity)
+        self._codes = {}        # имя операции -> код
+        self._names = []        # код -> имя операции
+
+    def __len__(self):
+        return min(self._count, len(self._events))
+
+    @property
+    def capacity(self):
+        return len(self._events)
+
+    @property
+    def dropped(self):
+        """
+        Число событий, затертых при переполнении буфера
+        """
+        return max(self._count - len(self._events), 0)
+
+    def record(self, operation, key_id=-1, duration=0.0, vertices=0):
+        if not self.enabled:
+            return
+        self._write(perf_counter(), operation, key_id, duration, vertices)
+
+    def span(self, operation, key_id=-1, vertices=0):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, operation, key_id, vertices)
+
+    def clear(self):
+        self._count = 0
+
+    def events(self):
+        """
+        Возвращает копию событий в порядке записи (от старых к новым)
+        """
+        capacity = len(self._events)
+        if self._count <= capacity:
+            return self._events[:self._count].copy()
+        head = self._count % capacity
+        return np.concatenate((self._events[head:], self._events[:head]))
+
+    def operationNames(self):
+        """
+        Возвращает имена операций, где номер имени - это его код в поле operation
+        """
+        return list(self._names)
+
+    def export(self, path):
+        """
+        Сохраняет события для анализа вне приложения: .npz (массив событий и имена операций) или CSV
+        с именами операций вместо кодов
+        """
+        events = self.events()
+        if str(path).lower().endswith('.csv'):
+            names = np.array(self._names or [''], dtype=object)
+            with open(path, 'w', newline='') as file:
+                file.write("timestamp;operation;key_id;duration;vertices\n")
+                for timestamp, name, key_id, duration, vertices in zip(
+                        events["timestamp"].tolist(), names[events["operation"]].tolist(),
+                        events["key_id"].tolist(), events["duration"].tolist(), events["vertices"].tolist()):
+                    file.write(f"{timestamp!r};{name};{key_id};{duration!r};{vertices}\n")
+        else:
+            np.savez(path, events=events, operations=np.array(self._names, dtype=str))
+
+    def _write(self, timestamp, operation, key_id, duration, vertices):
+        code = self._codes.get(operation)
+        if code is None:
+            code = self._codes[operation] = len(self._names)
+            self._names.append(operation)
+
+        self._events[self._count % len(self._events)] = (timestamp, code, key_id, duration, vertices)
+        self._count += 1
@@ -0,0 +1,200 @@
+import pyqtgraph as pg
+
+import numpy as np
+from collections import defaultdict
+from math import floor, sqrt
+
+from polygeometry import shapely
+
+
+def _orientation(ax, ay, bx, by, cx, cy):
+    return (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+
+
+class RingValidator:
+    """
+    Инкрементальная проверка простоты замкнутого контура (отсутствия самопересечений и самокасаний).
+
+    Отрезки контура (i-й отрезок соединяет i-ю и (i + 1)-ю вершины) хранятся в равномерной сетке ячеек, а для
+    каждого отрезка запоминаются пересекающие его несмежные отрезки. При перемещении одной вершины меняются
+    только два примыкающих к ней отрезка: они перекладываются в сетке и сравниваются лишь с отрезками из своих
+    ячеек. Поэтому проверка после сдвига вершины не зависит от числа вершин контура, а isValid - это просто
+    отсутствие найденных пересечений
+    """
+
+    def __init__(self, coordinates):
+        self.reset(coordinates)
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def isValid(self):
+        return len(self.points) >= 3 and not self._conflictCount
+
+    def reset(self, coordinates):
+        """
+        Полная перестройка индекса (при создании и при добавлении или удалении вершин)
+        """
+        self.points = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+        self._cells = defaultdict(set)      # ячейка сетки -> номера отрезков
+        self._segmentCells = {}             # номер отрезка -> ячейки, которые он занимает
+        self._conflicts = defaultdict(set)  # номер отрезка -> номера пересекающих его отрезков
+        self._conflictCount = 0
+
+        # Размер ячейки - порядка средней длины отрезка, но не меньше среднего расстояния между вершинами,
+        # чтобы длинные отрезки не занимали слишком много ячеек
+        n = len(self.points)
+        if n:
+            lengths = np.hypot(*(np.roll(self.points, -1, axis=0) - self.points).T)
+            extent = np.ptp(self.points, axis=0).max()
+            self._cellSize = max(float(lengths.mean()), extent / sqrt(n)) or 1.0
+
+        for segment in range(n):
+            self._indexSegment(segment)
+        self._checkAll()
+
+    def moveVertex(self, vertex, x, y):
+        """
+        Переносит вершину и перепроверяет два примыкающих к ней отрезка. Возвращает isValid
+        """
+        n = len(self.points)
+        self.points[vertex] = x, y
+        segments = {(vertex - 1) % n, vertex}
+        for segment in segments:
+            self._unindexSegment(segment)
+        for segment in segments:
+            self._indexSegment(segment)
+        for segment in segments:
+            self._checkSegment(segment)
+        return self.isValid
+
+    def _segmentEnds(self, segments):
+        return self.points[segments], self.points[(segments + 1) % len(self.points)]
+
+    def _indexSegment(self, segment):
+        (ax, ay), (bx, by) = self._segmentEnds(segment)
+        size = self._cellSize
+        cells = [(i, j)
+                 for i in range(floor(min(ax, bx) / size), floor(max(ax, bx) / size) + 1)
+                 for j in range(floor(min(ay, by) / size), floor(max(ay, by) / size) + 1)]
+        for cell in cells:
+            self._cells[cell].add(segment)
+        self._segmentCells[segment] = cells
+
+    def _unindexSegment(self, segment):
+        for cell in self._segmentCells.pop(segment):
+            self._cells[cell].discard(segment)
+        for other in self._conflicts.pop(segment, ()):
+            self._conflicts[other].discard(segment)
+            self._conflictCount -= 1
+
+    def _checkSegment(self, segment):
+        candidates = set().union(*(self._cells[cell] for cell in self._segmentCells[segment]))
+        candidates.discard(segment)
+        candidates.difference_update(self._conflicts[segment])
+        if not candidates:
+            return
+
+        others = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        for other in others[self._intersects(np.full(len(others), segment), others)].tolist():
+            self._addConflict(segment, other)
+
+    def _checkAll(self):
+        # Кандидаты для первоначальной проверки - пары отрезков с пересекающимися габаритами из STRtree,
+        # точная проверка та же, что и при перемещении вершины
+        n = len(self.points)
+        if n < 2:
+            return
+        starts, ends = self._segmentEnds(np.arange(n))
+        boxes = shapely.box(np.minimum(starts[:, 0], ends[:, 0]), np.minimum(starts[:, 1], ends[:, 1]),
+                            np.maximum(starts[:, 0], ends[:, 0]), np.maximum(starts[:, 1], ends[:, 1]))
+        first, second = shapely.STRtree(boxes).query(boxes)
+        ordered = first < second
+        first, second = first[ordered], second[ordered]
+        for segment, other in zip(*(a[self._intersects(first, second)].tolist() for a in (first, second))):
+            self._addConflict(segment, other)
+
+    def _addConflict(self, segment, other):
+        self._conflicts[segment].add(other)
+        self._conflicts[other].add(segment)
+        self._conflictCount += 1
+
+    def _intersects(self, segments, others):
+        """
+        Попарная проверка пересечения отрезков segments[k] и others[k]
+        """
+        n = len(self.points)
+        (ax, ay), (bx, by) = (ends.T for ends in self._segmentEnds(segments))
+        (cx, cy), (dx, dy) = (ends.T for ends in self._segmentEnds(others))
+
+        # Пересечение замкнутых отрезков (касание тоже считается): концы каждого отрезка лежат по разные
+        # стороны другого или на нем, а для коллинеарных отрезков дополнительно пересекаются проекции
+        d1 = _orientation(cx, cy, dx, dy, ax, ay)
+        d2 = _orientation(cx, cy, dx, dy, bx, by)
+        d3 = _orientation(ax, ay, bx, by, cx, cy)
+        d4 = _orientation(ax, ay, bx, by, dx, dy)
+        collinear = (d1 == 0) & (d2 == 0)
+        overlapX = (np.maximum(np.minimum(ax, bx), np.minimum(cx, dx)) <=
+                    np.minimum(np.maximum(ax, bx), np.maximum(cx, dx)))
+        overlapY = (np.maximum(np.minimum(ay, by), np.minimum(cy, dy)) <=
+                    np.minimum(np.maximum(ay, by), np.maximum(cy, dy)))
+        intersects = (d1 * d2 <= 0) & (d3 * d4 <= 0) & (~collinear | (overlapX & overlapY))
+
+        # Смежные отрезки всегда касаются в общей вершине - ошибкой считается только их наложение
+        # (коллинеарные отрезки, идущие из общей вершины в одну сторону)
+        nextAdjacent = others == (segments + 1) % n
+        previousAdjacent = others == (segments - 1) % n
+        adjacent = nextAdjacent | previousAdjacent
+        if adjacent.any():
+            shared = np.where(nextAdjacent, (segments + 1) % n, segments)[adjacent]
+            v = self.points[shared]
+            p = self.points[(shared - 1) % n] - v
+            q = self.points[(shared + 1) % n] - v
+            cross = p[:, 0] * q[:, 1] - p[:, 1] * q[:, 0]
+            dot = (p * q).sum(axis=1)
+            intersects[adjacent] = (cross == 0) & (dot > 0)
+        return intersects
+
+
+class ValidatedPolyLineROI(pg.PolyLineROI):
+    """
+    PolyLineROI, который проверяет контур при каждом перемещении узла через RingValidator (в локальных координатах
+    ROI: простота контура не зависит от сдвига, поворота и масштаба). Если rejectInvalid, перемещение, после
+    которого контур стал бы самопересекающимся, отклоняется сразу, и узел остается на месте
+    """
+
+    def __init__(self, positions, rejectInvalid=True, **kw):
+        super().__init__(positions, **kw)
+        self.rejectInvalid = rejectInvalid
+        self.validator = RingValidator(self.localCoordinates())
+        self._dragHandle = None
+        self._dragIndex = None
+
+    @property
+    def isValid(self):
+        if len(self.validator) != len(self.handles):
+            # Узлы добавлены или удалены через контекстное меню - перестраиваем индекс
+            self.validator.reset(self.localCoordinates())
+            self._dragHandle = None
+        return self.validator.isValid
+
+    def localCoordinates(self):
+        return np.array([(p.x(), p.y()) for p in (h['item'].pos() for h in self.handles)],
+                        dtype=np.float64).reshape(-1, 2)
+
+    def checkPointMove(self, handle, pos, modifiers):
+        wasValid = self.isValid
+        if handle is not self._dragHandle:
+            self._dragHandle = handle
+            self._dragIndex = self.indexOfHandle(handle)
+
+        local = self.mapFromScene(pos)
+        previous = self.validator.points[self._dragIndex].copy()
+        valid = self.validator.moveVertex(self._dragIndex, local.x(), local.y())
+
+        # Уже невалидный контур разрешаем править, иначе его нельзя было бы исправить
+        if self.rejectInvalid and wasValid and not valid:
+            self.validator.moveVertex(self._dragIndex, *previous)
+            return False
+        return True
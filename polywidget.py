@@ -1,42 +1,62 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.uic import loadUi
+from PyQt5.uic import loadUiType
 import pyqtgraph as pg
 
-from collections import namedtuple
+from itertools import repeat
 import numpy as np
 from math import sqrt
-from shapely.geometry import Polygon
-from shapely.ops import unary_union
-import logging
+from time import perf_counter
 import os
-import csv
+
+from polystore import PolyStore
+from polyrender import PolyBatchRenderer, PolyFillRenderer, closedRingBuffer
+from polyindex import PolySpatialIndex
+from polygeometry import POSSIBLE_OPERATIONS, FlatGeometry, booleanOperation, checkFlatGeometry, \
+    concatFlatGeometries, extractPolyCoordinates, flatGeometriesFromPolygons, flatRings, polygonFromFlat, \
+    polygonsFromFlatBatch, shapely, toFlatGeometry
+from polyhistory import FieldsChanged, GeometryReplaced, PolyHistory, PolysAdded, PolysRemoved, VerticesMoved, \
+    VerticesTranslated, applyVertices, verticesDelta
+from polyjobs import BooleanOperationJob, OverlayJob
+from polycache import OperationResultCache, geometryFingerprint
+from polygraph import PolyOperationGraph
+from polymetrics import PolyMetricsModel
+from polyvalidate import ValidatedPolyLineROI
+from polyio import Workspace, readPolygonsCsv, readWorkspace, workspacePolygons, writePolygonsCsv, writeWorkspace
+from polytrace import PolyTracer
+from polystyle import PolyStyleCache, penStyleFromStr
 
 
 PATH = os.getcwd()
-UI_WIDGET_FILE = 'graphWidgetForm.ui'
-POSSIBLE_OPERATIONS = ['Unite', 'Intersect', 'Subtract', 'Symmetry Difference']
-
-
-def extractPolyCoordinates(geom):
-    if geom.type == 'Polygon':
-        exteriorCoordinates = geom.exterior.coords[:]
-        interiorCoordinates = []
-        for interior in geom.interiors:
-            interiorCoordinates += interior.coords[:]
-    elif geom.type == 'MultiPolygon':
-        exteriorCoordinates = []
-        interiorCoordinates = []
-        for part in geom:
-            epc = extractPolyCoordinates(part)  # Recursive call
-            exteriorCoordinates += epc['exterior']
-            interiorCoordinates += epc['interiors']
-    else:
-        raise ValueError('Unhandled geometry type: ' + repr(geom.type))
-    return {'exterior': exteriorCoordinates,
-            'interiors': interiorCoordinates}
-
-
-class PolyWidget(QtWidgets.QWidget):
+UI_DIR = os.path.dirname(os.path.abspath(__file__))
+UI_WIDGET_FILE = os.path.join(UI_DIR, 'graphWidgetForm.ui')
+
+# Форма компилируется из XML в Python класс один раз при импорте, а каждый виджет только вызывает setupUi
+WidgetForm, _ = loadUiType(UI_WIDGET_FILE)
+
+
+def roiWorldCoordinates(roi):
+    """
+    Возвращает координаты узлов (Handles) ROI в системе координат области отображения. Локальные позиции узлов
+    переводятся одним матричным умножением на трансформацию ROI (сдвиг, поворот и масштаб), поэтому
+    перемещение всей области тоже учитывается
+    """
+    local = np.array([(p.x(), p.y()) for p in (h['item'].pos() for h in roi.handles)], dtype=np.float64)
+    return mapRoiToWorld(roi, local.reshape(-1, 2))
+
+
+def mapRoiToWorld(roi, local):
+    """
+    Переводит массив (N, 2) локальных координат ROI в систему координат области отображения
+    """
+    tr = roi.transform()
+    pos = roi.pos()
+    coordinates = local @ np.array([[tr.m11(), tr.m12()], [tr.m21(), tr.m22()]]) + \
+        np.array([tr.dx() + pos.x(), tr.dy() + pos.y()])
+    coordinates.flags.writeable = False
+    return coordinates
+
+
+class PolyWidget(QtWidgets.QWidget, WidgetForm):
 
     DEFAULT_LINE_COLOR = (255, 255, 255, 255)
     DEFAULT_LINE_WIDTH = 3
@@ -44,41 +64,74 @@ class PolyWidget(QtWidgets.QWidget):
     DEFAULT_MARKER_COLOR = (150, 255, 255, 255)
     DEFAULT_MARKER_SIZE = 1
     DEFAULT_MARKER_STYLE = 's'
-    DEFAULT_FILL_COLOR = (255, 255, 255, 255)
+    DEFAULT_FILL_COLOR = (255, 255, 255, 0)     # Прозрачная заливка не рисуется
+
+    # Неактивные полигоны рисуются пакетно, а редактируемый ROI создается только для выбранного полигона.
+    # При False каждый полигон, как и раньше, сразу получает свой PolyLineROI
+    BATCH_RENDERING = True
+
+    # Перемещение узла, после которого контур стал бы самопересекающимся, отклоняется сразу (при False
+    # такой контур только подсвечивается цветом INVALID_LINE_COLOR)
+    REJECT_INVALID_EDITS = True
+    INVALID_LINE_COLOR = (255, 0, 0, 255)
+
+    # Отмена правки не более чем HANDLE_PATCH_LIMIT узлов двигает узлы ROI на месте, иначе ROI пересоздается
+    HANDLE_PATCH_LIMIT = 64
+
+    # Начальная емкость буфера узлов эскиза нового полигона (при заполнении удваивается)
+    SKETCH_CAPACITY = 256
+
+    # Трассировка действий в кольцевой буфер (см. PolyTracer). Выключена по умолчанию, включается
+    # connectTracing(True)
+    TRACING = False
 
     # ~~~ Инициализация и подключение сигналов ~~~ #
 
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
-        loadUi(UI_WIDGET_FILE, self)
+        self.setupUi(self)
 
-        # Добавим ключ, по которому будем определять, выбран ли какой-то объект в QListWidget или нет
-        self.selectedFlag = True
+        # Подключим трассировку произведенных действий (при необходимости)
+        self.tracer = PolyTracer()
+        self.connectTracing(self.TRACING)
 
-        # Подключим вывод в консоль о произведенных действиях (при необходимости)
-        self.connectLogging(True)
+        # Группы полигонов для наложения (overlayPolys), задаются выбором в polyListWidget
+        self.overlayGroups = {'A': [], 'B': []}
 
         # Подключим сигналы от кнопок
         self.connectSignals()
 
+        # Пул потоков для булевых операций над полигонами (одна операция за раз)
+        self.operationPool = QtCore.QThreadPool(self)
+        self.operationPool.setMaxThreadCount(1)
+        self.operationJob = None
+        self._operationJobs = set()     # ссылки на задачи, которые еще выполняются (в том числе отмененные)
+        # Кэш результатов операций и отпечатки геометрии полигонов (пересчитываются только после изменения)
+        self.operationCache = OperationResultCache()
+        self._fingerprints = {}     # key_id -> отпечаток текущей геометрии
+        # key_id -> массив координат, созданный правкой ROI и известный только хранилищу и журналу: отмена
+        # и повтор правок вершин меняют его на месте, без копирования
+        self._ownedCoordinates = {}
+
         # Инициализируем хранилище отображаемых полигонов и область отображения
         self._init_displayData()
         self._init_displayArea()
 
-    @staticmethod
-    def connectLogging(status):
-        if status:
-            logging.basicConfig(format="%(asctime)s :    %(levelname)s :    %(message)s", level=logging.INFO)
+    def connectTracing(self, status):
+        self.tracer.enabled = status
 
     def connectSignals(self):
         self.addPolyPushButton.clicked.connect(self.addPolyButtonClicked)
         self.deletePolyPushButton.clicked.connect(self.polyDeletion)        # Только если кнопка удаления активирована
         self.polyListWidget.itemChanged.connect(self.polyItemChangedEvent)
-        self.polyListWidget.itemClicked.connect(self.polyItemSelectedEvent)
+        self.polyListWidget.itemSelectionChanged.connect(self.polySelectionChanged)
         self.addPolyButtonBox.accepted.connect(self.polyAccepted)           # Только если кнопка удаления активирована
         self.addPolyButtonBox.rejected.connect(self.polyRejected)           # Только если кнопка удаления активирована
         self.savePolyPushButton.clicked.connect(self.savePoly)              # Только если кнопка удаления активирована
         self.loadPolyPushButton.clicked.connect(self.loadPoly)
+        self.saveWorkspacePushButton.clicked.connect(self.saveWorkspace)
+        self.loadWorkspacePushButton.clicked.connect(self.loadWorkspace)
+        self.metricsPushButton.clicked.connect(self.showMetricsTable)
 
         # Панель кастомизации полигонов (изначально деактивирована)
         self.lineColorButtonWidget.sigColorChanged.connect(self.lineColorChanged)
@@ -90,34 +143,60 @@ class PolyWidget(QtWidgets.QWidget):
         self.markerSizeSpinBox.valueChanged.connect(self.markerSizeChanged)
 
         # Сигналы с displayArea
-        self.displayArea.scene().sigMouseMoved.connect(self.dAMouseMoved)
+        # Перемещения мыши приходят чаще, чем обновляется экран, поэтому перекрестие двигается не чаще частоты
+        # обновления дисплея (промежуточные события схлопываются в последнее)
+        self.mouseMoveProxy = pg.SignalProxy(self.displayArea.scene().sigMouseMoved,
+                                             rateLimit=self.displayRefreshRate(), slot=self.dAMouseMoved)
         self.displayArea.scene().sigMouseClicked.connect(self.dAMouseClicked)
 
         # Панель операций с полигонами
         self.polyOperationsComboBox.activated.connect(self.operationActivated)
         self.doPolyOperationPushButton.clicked.connect(self.doOperation)
+        self.derivePolyPushButton.clicked.connect(self.derivePolyButtonClicked)
+        self.cancelOperationPushButton.clicked.connect(self.cancelOperation)
+        self.overlayGroupAPushButton.clicked.connect(self.overlayGroupAButtonClicked)
+        self.overlayGroupBPushButton.clicked.connect(self.overlayGroupBButtonClicked)
+        self.overlayPushButton.clicked.connect(self.overlayButtonClicked)
+
+        # Отмена и повтор действий (Ctrl+Z, Ctrl+Shift+Z)
+        QtWidgets.QShortcut(QtGui.QKeySequence.Undo, self, activated=self.undo)
+        QtWidgets.QShortcut(QtGui.QKeySequence.Redo, self, activated=self.redo)
 
     def _init_displayData(self):
         self.key_id = 0
-        self.displayData = []
-        self.customPolygonStructure = namedtuple(
-            "customPolygonStructure",
-            ["key_id",
-             "name",
-             "exterior_object",
-             "interior_objects",
-             "linecolor",
-             "linewidth",
-             "linestyle",
-             "markercolor",
-             "markersize",
-             "markerstyle",
-             "fillcolor"]
-        )
+        self.displayData = PolyStore()
+        self.polyItems = {}     # key_id -> QListWidgetItem
+        self.spatialIndex = PolySpatialIndex()
+        self.roiCompanions = {}     # key_id -> (кривая прочих контуров редактируемого полигона, их локальные координаты)
+        self._roiShownValid = {}    # key_id -> валидность, с которой сейчас подсвечен ROI
+        self.history = PolyHistory()
+        self.operationGraph = PolyOperationGraph()
+        self._emptyDerived = {}     # key_id -> (снимок, строки) скрытого производного полигона с пустым результатом
+        self._derivedScheduled = False
+        self.metricsModel = PolyMetricsModel(self.displayData, self)
+        self.metricsView = None
 
     def _init_displayArea(self):
         self.dAClickFlag = False
 
+        self.batchRendering = self.BATCH_RENDERING
+        self.rejectInvalidEdits = self.REJECT_INVALID_EDITS
+        self.styleCache = PolyStyleCache()
+        self.batchRenderer = PolyBatchRenderer(self.displayArea, self.displayData, self.spatialIndex,
+                                               self.getLinePen)
+        self.fillRenderer = PolyFillRenderer(self.displayArea, self.displayData, self.styleCache.brush)
+
+        # Эскиз нового полигона - одна кривая, данные которой растут в заранее выделенном буфере
+        self.sketchPoints = np.empty((self.SKETCH_CAPACITY, 2))
+        self.sketchCount = 0
+        self.sketchItem = self.displayArea.plot(
+            pen=pg.mkPen('w', width=0.8),
+            symbol='s',
+            symbolPen=(150, 255, 255, 200),
+            symbolSize=7,
+            symbolBrush=(0, 0, 0, 0)
+        )
+
         self.vLine = pg.InfiniteLine(angle=90, movable=False)
         self.hLine = pg.InfiniteLine(angle=0, movable=False)
         self.displayArea.addItem(self.vLine, ignoreBounds=True)
@@ -133,46 +212,99 @@ class PolyWidget(QtWidgets.QWidget):
             self, "Сохранение", "{0}\\{1}.csv".format(PATH, filename), "CSV Files (*.csv)"
         )
 
-        index = self.findItemIndexInData(currentItem)
-        exteriorHandles = []
-        for handle in self.displayData[index].exterior_object.handles:
-            exteriorHandles.append(
-                handle['pos'] if isinstance(handle['pos'], pg.Point) else pg.Point(handle['pos'].x(), handle['pos'].y())
-            )
-        exteriorHandles = [self.displayData[index].exterior_object.getState()['pos'] + handle for handle in exteriorHandles]
+        if not file[0]:
+            return
 
-        with open(file[0], 'w', newline='') as csvfile:
-            headers = ['exterior']
-            writer = csv.DictWriter(csvfile, delimiter=";", fieldnames=headers)
-            writer.writeheader()
-            for point in exteriorHandles:
-                writer.writerow(
-                    {'exterior': (point.x(), point.y())},
-                )
+        # Вырезы и части многочастного полигона сохраняются столбцами part и ring, и loadPoly загружает
+        # такой файл обратно как один полигон
+        index = self.findItemIndexInData(currentItem)
+        writePolygonsCsv(file[0], [self.flatGeometryOf(index)])
 
     def loadPoly(self):
         file = QtWidgets.QFileDialog.getOpenFileName(
             self, "Открытие файла", "{0}\\*.csv".format(PATH), "CSV Files (*.csv)"
         )
-        exteriorHandles = []
-        with open(file[0], 'r', newline='') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=";")
-            for row in reader:
-                exteriorHandles.append(eval(row['exterior']))
+        if not file[0]:
+            return
+
+        # Файл читается порциями и целиком проверяется до добавления: ошибка в любом полигоне не оставляет
+        # частично загруженного файла. Все полигоны из него добавляются одним пакетом
+        with self.tracer.span("loadPoly"):
+            try:
+                geometries = [toFlatGeometry(coordinates) for _, coordinates in readPolygonsCsv(file[0])]
+                for geometry in geometries:
+                    checkFlatGeometry(geometry)
+            except ValueError as error:
+                QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Не удалось загрузить {file[0]}: {error}')
+                return
+            self.polyBulkAddition(geometries)
+
+    def saveWorkspace(self):
+        """
+        Сохранение всех полигонов вместе со стилями в бинарный файл рабочего пространства (*.pqa)
+        """
+        file = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Сохранение рабочего пространства", "{0}\\workspace.pqa".format(PATH), "Workspace Files (*.pqa)"
+        )
+        if not file[0]:
+            return
 
-        # Создаем новый полигон по тому же принципу
-        self.polyAddition(exterior=exteriorHandles)
+        with self.tracer.span("saveWorkspace"):
+            writeWorkspace(file[0], self.getWorkspace())
+
+    def loadWorkspace(self):
+        """
+        Загрузка полигонов со стилями из файла рабочего пространства одним пакетом
+        """
+        file = QtWidgets.QFileDialog.getOpenFileName(
+            self, "Открытие рабочего пространства", "{0}\\*.pqa".format(PATH), "Workspace Files (*.pqa)"
+        )
+        if not file[0]:
+            return
+
+        with self.tracer.span("loadWorkspace") as span:
+            workspace = readWorkspace(file[0])
+            span.vertices = len(workspace.coordinates)
+            self._addWorkspace(workspace)
+
+    def _addWorkspace(self, workspace):
+        styles = (
+            dict(linecolor=tuple(lc), linewidth=lw, linestyle=ls, markercolor=tuple(mc), markersize=ms,
+                 markerstyle=mst, fillcolor=tuple(fc))
+            for lc, lw, ls, mc, ms, mst, fc in zip(
+                workspace.linecolor.tolist(), workspace.linewidth.tolist(), workspace.linestyle,
+                workspace.markercolor.tolist(), workspace.markersize.tolist(), workspace.markerstyle,
+                workspace.fillcolor.tolist()
+            )
+        )
+        return self.polyBulkAddition(workspacePolygons(workspace), names=workspace.names, styles=styles)
+
+    def getWorkspace(self):
+        """
+        Собирает все полигоны displayData в колоночное рабочее пространство (одна склейка координат и по одному
+        массиву на каждый стиль)
+        """
+        store = self.displayData
+        return Workspace(
+            *concatFlatGeometries([self.flatGeometryOf(key_id) for key_id in store.keys()]),
+            store.column("name"),
+            store.column("linecolor"),
+            store.column("linewidth"),
+            store.column("linestyle"),
+            store.column("markercolor"),
+            store.column("markersize"),
+            store.column("markerstyle"),
+            store.column("fillcolor"),
+        )
 
     def polyAccepted(self):
-        if len(self.tempItemsBuffer) < 3:
+        if self.sketchCount < 3:
             QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Узлов в полигоне должно быть больше 2')
             raise Exception("Polygon has too less nodes")
 
-        # Удалим временный эскиз нового полигона
-        for i in range(len(self.tempItemsBuffer)):
-            self.displayArea.removeItem(self.tempItemsBuffer[i])
-
-        self.polyAddition(exterior=self.polyBuffer)
+        # Узлы копируются из буфера эскиза (он переиспользуется), затем эскиз очищается
+        self.polyAddition(exterior=self.sketchPoints[:self.sketchCount])
+        self.clearSketch()
 
         self.addPolyButtonBox.setEnabled(False)
         self.addPolyPushButton.setEnabled(True)
@@ -180,272 +312,240 @@ class PolyWidget(QtWidgets.QWidget):
 
     def polyRejected(self):
         # Удалим временный эскиз нового полигона
-        for i in range(len(self.tempItemsBuffer)):
-            self.displayArea.removeItem(self.tempItemsBuffer[i])
+        self.clearSketch()
 
         self.addPolyButtonBox.setEnabled(False)
         self.addPolyPushButton.setEnabled(True)
         self.dAClickFlag = False
-
-        # Информация
-        logging.info(f"Отмена добавления нового элемента")
-        logging.info(f"Фиксация координат кликов по displayArea выключена")
+        self.tracer.record("polyRejected")
 
     def addPolyButtonClicked(self):
         self.addPolyButtonBox.setEnabled(True)
-        self.tempItemsBuffer = []
-        self.polyBuffer = []
+        self.clearSketch()
         self.dAClickFlag = True
         self.addPolyPushButton.setEnabled(False)
-
-        # Информация
-        logging.info(f"tempBuffer очищен")
-        logging.info(f"Включена фиксация координат кликов по displayArea")
+        self.tracer.record("addPolyButtonClicked")
 
     def polyDeletion(self):
         """
         Данный метод реализует удаление выбранного Item'а из QListWidget'а и из displayArea
         """
 
-        self.selectedFlag = True
-
-        # Определяем, какой сейчас Item selected и удаляем его из QListWidget'а
+        # Определяем, какой сейчас Item selected и удаляем его полигон по key_id
         selectedItem = self.polyListWidget.currentItem()
-        self.polyListWidget.takeItem(self.polyListWidget.row(selectedItem))
-
-        # Ищем наш полигон в displayData по key_id
-        for i in range(len(self.displayData)):
-            if self.displayData[i].key_id == selectedItem.data(1):
-                # Сначал удаляем его с displayArea
-                self.displayArea.removeItem(self.displayData[i].exterior_object)
-
-                # Теперь удаляем его из displayArea (именно в таком порядке чтобы избежать дальнейшего ненахода)
-                self.displayData.remove(self.displayData[i])
-
-                # Информация
-                logging.info(f"Ключ {selectedItem.data(1)}. Элемент {selectedItem.text()} удален")
-
-                # Переопределяем новый выбранный элемент
-                newSelectedItem = self.polyListWidget.currentItem()
+        if selectedItem is None or self.findItemIndexInData(selectedItem) is None:
+            return
+        self._removePolys([selectedItem.data(1)])
 
-                # Disabl'им кнопку удаления, кнопку addHole и меню редактирования, если ни один элемент не selected
-                # (во избежания лишних тыканий и выползания ошибок)
-                if newSelectedItem is None:
-                    self.setItemCustomizationButtonsActive(False)
-                    return
+        # Переопределяем новый выбранный элемент
+        newSelectedItem = self.polyListWidget.currentItem()
 
-                # И снова информация, так как при удалении selected Item стал предыдущий
-                logging.info(f"Ключ {newSelectedItem.data(1)}. Элемент {newSelectedItem.text()} выбран")
+        # Disabl'им кнопку удаления, кнопку addHole и меню редактирования, если ни один элемент не selected
+        # (во избежания лишних тыканий и выползания ошибок)
+        if newSelectedItem is None:
+            self.setItemCustomizationButtonsActive(False)
 
-                # Выходим, чтобы в первую очередь прервать дальнейший поиск по циклу
-                return
+    def polyBulkDeletion(self, keys):
+        """
+        Удаление сразу многих полигонов без промежуточных перерисовок QListWidget'а
+        """
+        self.polyListWidget.setUpdatesEnabled(False)
+        self.polyListWidget.blockSignals(True)
+        try:
+            with self.tracer.span("polyBulkDeletion"):
+                self._removePolys(keys)
+        finally:
+            self.polyListWidget.blockSignals(False)
+            self.polyListWidget.setUpdatesEnabled(True)
+
+        if self.polyListWidget.currentItem() is None:
+            self.setItemCustomizationButtonsActive(False)
+
+    def _removePolys(self, keys):
+        """
+        Удаление полигонов keys из QListWidget'а, displayArea и displayData. В журнал записывается один снимок
+        столбцов удаленных полигонов (PolysRemoved) вместе с их строками в списке. Возвращает снимок и строки
+        """
+        # Полигоны упорядочиваются по строкам списка: при возврате они вставляются на те же строки по возрастанию
+        rows = [self.polyListWidget.row(self.polyItems[key_id]) for key_id in keys]
+        order = sorted(range(len(rows)), key=rows.__getitem__)
+        keys = [keys[i] for i in order]
+        rows = tuple(rows[i] for i in order)
+        columns = self.displayData.columns(keys)
+
+        for key_id, coordinates in zip(keys, columns.coordinates):
+            self.polyListWidget.takeItem(self.polyListWidget.row(self.polyItems.pop(key_id)))
+
+            # Сначала удаляем его с displayArea, затем из хранилища
+            self._demotePoly(key_id, show=False)
+            self.batchRenderer.hide(key_id)
+            self.fillRenderer.hide(key_id)
+            self.spatialIndex.remove(key_id)
+            self._fingerprints.pop(key_id, None)
+            self._ownedCoordinates.pop(key_id, None)
+            self.displayData.remove(key_id)
+            self.tracer.record("polyRemoved", key_id, vertices=len(coordinates))
+        self.metricsModel.polysRemoved(keys)
+        self.history.record(PolysRemoved(columns, rows))
+        return columns, rows
 
     def polyItemChangedEvent(self, item):
         # При изменении имени Item'а, необходимо синхронизировать эти изменения в displayData.
-        # Данная функция изменяет имя полигона в displayData в соответствии с новым именем Item (возможно, это можно
-        # сделать без цила, но я не нашел как...)
-        polyNames = self.displayDataNames()
-
-        for i in range(len(self.displayData)):
-            if self.displayData[i].key_id == item.data(1):
-                oldName = self.displayData[i].name
-
-                # Выполним важную проверку на совпадение с уже существующими именами
-                if item.text() in polyNames:
-                    item.setText(oldName)
-                    raise ValueError("No two names can be the same")
-
-                # Если проверка пройдена, то изменяем имя Item'а и элемента в хранилище displayData
-                self.displayData[i] = self.displayData[i]._replace(name=item.text())
+        # Данная функция изменяет имя полигона в displayData в соответствии с новым именем Item
+        index = self.findItemIndexInData(item)
+        if index is None:
+            return
 
-                # Информация
-                logging.info(f"Ключ {self.displayData[i].key_id}. Имя элемента изменено с {oldName} на {item.text()}")
-                return
+        oldName = self.displayData.get(index, "name")
+        if item.text() == oldName:
+            return
 
-    def polyItemSelectedEvent(self, item):
-        # Найдем selected Item в displayData
-        index = self.findItemIndexInData(item)
+        # Выполним важную проверку на совпадение с уже существующими именами
+        if self.displayData.hasName(item.text()):
+            item.setText(oldName)
+            raise ValueError("No two names can be the same")
 
-        # Добавим возможность Select и Deselect Item
-        if self._isItemSelected(item):
-            item.setSelected(True)
+        # Если проверка пройдена, то изменяем имя Item'а и элемента в хранилище displayData
+        self._updateFields(index, name=item.text())
 
-            # self.displayData[index].exterior_object.translatable = True
+    def polySelectionChanged(self):
+        """
+        Выбор в polyListWidget изменился (щелчок, Ctrl/Shift+щелчок, клавиатура). Ведущий полигон - текущий
+        элемент, если он выбран, иначе первый выбранный: он становится редактируемым ROI, остальные
+        возвращаются в пакетную отрисовку, а панель кастомизации заполняется по нему
+        """
+        items = self.polyListWidget.selectedItems()
+        currentItem = self.polyListWidget.currentItem()
+        item = currentItem if currentItem is not None and currentItem.isSelected() else next(iter(items), None)
+        index = self.findItemIndexInData(item) if item is not None else None
 
-            # Активируем все функции кастомизации области
-            self.setItemCustomizationButtonsActive(True)
-            self.fillItemCustomizationButtons(item)
+        if self.batchRendering:
+            for key_id in [k for k in self.promotedKeys if k != index]:
+                self._demotePoly(key_id)
+        if index is None:
+            self.tracer.record("selectionCleared")
+            self.setItemCustomizationButtonsActive(False)
             return
 
-        # self.displayData[index].exterior_object.translatable = False
-        self.setItemCustomizationButtonsActive(False)
+        self.tracer.record("itemSelected", index)
+        self._promotePoly(index)
+
+        # Активируем все функции кастомизации области
+        self.setItemCustomizationButtonsActive(True)
+        self.fillItemCustomizationButtons(item)
 
     # ~~~ Методы, обрабатывающие сигналы от панели кастомизации полигонов ~~~ #
 
     def lineColorChanged(self):
         """
-        Метод, меняющий цвет линий выбранного полигона
+        Метод, меняющий цвет линий выбранных полигонов
         """
-        color = self.lineColorButtonWidget.color(mode='byte')
-
-        index = self.findItemIndexInData(self.polyListWidget.currentItem())
-        self.displayData[index] = \
-            self.displayData[index]._replace(linecolor=color)
-
-        # Меняем цвет линий отображаемого объекта
-        self.displayData[index].exterior_object.setPen(
-            pg.mkPen(color,
-                     width=self.displayData[index].linewidth/3,
-                     style=self.getStyleFromStr(self.displayData[index].linestyle)
-                     )
-        )
-
-        # Информация
-        logging.info(f"Ключ {self.displayData[index].key_id}. Цвет линий элемента {self.displayData[index].name} "
-                     f"изменен на {self.displayData[index].linecolor}")
+        self.applyStyle(self.selectedKeys(), linecolor=tuple(self.lineColorButtonWidget.color(mode='byte')))
 
     def markerColorChanged(self):
         """
-        Метод, меняющий цвет точек(узлов) выбранного полигона
+        Метод, меняющий цвет точек(узлов) выбранных полигонов
         """
-        color = self.markerColorButtonWidget.color(mode='byte')
-
-        index = self.findItemIndexInData(self.polyListWidget.currentItem())
-        self.displayData[index] = \
-            self.displayData[index]._replace(markercolor=color)
-
-        # Меняем цвет точек (узлов) отображаемого объекта
-        for i in range(len(self.displayData[index].exterior_object.handles)):
-            self.displayData[index].exterior_object.handles[i]['item'].pen.setColor(self.getColorFromTuple(color))
-
-        # Информация
-        logging.info(f"Ключ {self.displayData[index].key_id}. Цвет узлов элемента {self.displayData[index].name} "
-                     f"изменен на {self.displayData[index].markercolor}")
+        self.applyStyle(self.selectedKeys(), markercolor=tuple(self.markerColorButtonWidget.color(mode='byte')))
 
     def fillColorChanged(self):
         """
-        Метод, меняющий цвет заливки выбранного полигона
+        Метод, меняющий цвет заливки выбранных полигонов
         """
-
-        index = self.findItemIndexInData(self.polyListWidget.currentItem())
-        self.displayData[index] = \
-            self.displayData[index]._replace(fillcolor=self.polyFillColorButtonWidget.color(mode='byte'))
-
-        # Информация
-        logging.info(f"Ключ {self.displayData[index].key_id}. Цвет заливки элемента {self.displayData[index].name} "
-                     f"изменен на {self.displayData[index].fillcolor}")
+        self.applyStyle(self.selectedKeys(), fillcolor=tuple(self.polyFillColorButtonWidget.color(mode='byte')))
 
     def lineStyleChanged(self):
         """
         Метод, изменяющий стиль линий в зависимости от выбранного элемента в lineStyleComboBox
         """
-        style = self.lineStyleComboBox.currentText()
-
-        index = self.findItemIndexInData(self.polyListWidget.currentItem())
-        self.displayData[index] = \
-            self.displayData[index]._replace(linestyle=style)
-
-        # Меняем стиль линий отображаемого объекта
-        self.displayData[index].exterior_object.setPen(
-            pg.mkPen(self.displayData[index].linecolor,
-                     width=self.displayData[index].linewidth/3,
-                     style=self.getStyleFromStr(style)
-                     )
-        )
-
-        # Информация
-        logging.info(f"Ключ {self.displayData[index].key_id}. Стиль линий элемента {self.displayData[index].name} "
-                     f"изменен на {self.displayData[index].linestyle}")
+        self.applyStyle(self.selectedKeys(), linestyle=self.lineStyleComboBox.currentText())
 
     def markerStyleChanged(self):
         """
         Метод, изменяющий стиль точек (узлов) в зависимости от выбранного элемента в markerStyleComboBox
         """
-
-        index = self.findItemIndexInData(self.polyListWidget.currentItem())
-        self.displayData[index] = \
-            self.displayData[index]._replace(markerstyle=self.markerStyleComboBox.currentText())
-
-        # Информация
-        logging.info(f"Ключ {self.displayData[index].key_id}. Стиль узлов элемента {self.displayData[index].name} "
-                     f"изменен на {self.displayData[index].markerstyle}")
+        self.applyStyle(self.selectedKeys(), markerstyle=self.markerStyleComboBox.currentText())
 
     def lineWidthChanged(self):
         """
         Метод, изменяющий толщину линий в зависимости от числа в lineWidthSpinBox
         """
-        width = self.lineWidthSpinBox.value()
-
-        index = self.findItemIndexInData(self.polyListWidget.currentItem())
-        self.displayData[index] = \
-            self.displayData[index]._replace(linewidth=width)
-
-        # Меняем стиль линий отображаемого объекта
-        self.displayData[index].exterior_object.setPen(
-            pg.mkPen(self.displayData[index].linecolor,
-                     width=width/3,
-                     style=self.getStyleFromStr(self.displayData[index].linestyle)
-                     )
-        )
-
-        # Информация
-        logging.info(f"Ключ {self.displayData[index].key_id}. Толщина линий элемента {self.displayData[index].name} "
-                     f"изменена на {self.displayData[index].linewidth}")
+        self.applyStyle(self.selectedKeys(), linewidth=self.lineWidthSpinBox.value())
 
     def markerSizeChanged(self):
         """
         Метод, изменяющий размер точек (узлов) в зависимости от числа в markerSizeSpinBox
         """
-        size = self.markerSizeSpinBox.value()
-
-        index = self.findItemIndexInData(self.polyListWidget.currentItem())
-        self.displayData[index] = \
-            self.displayData[index]._replace(markersize=size)
+        self.applyStyle(self.selectedKeys(), markersize=self.markerSizeSpinBox.value())
 
-        # Меняем размер точек (узлов) отображаемого объекта
-        for i in range(len(self.displayData[index].exterior_object.handles)):
-            self.displayData[index].exterior_object.handles[i]['item'].pen.setWidth(size)
-
-        # Информация
-        logging.info(f"Ключ {self.displayData[index].key_id}. Размер узлов элемента {self.displayData[index].name} "
-                     f"изменен на {self.displayData[index].markersize}")
+    def applyStyle(self, keys, **fields):
+        """
+        Меняет поля стиля сразу у всех полигонов keys за один шаг журнала отмены. Перерисовка области
+        отображения приостанавливается до конца применения, а пакетная отрисовка перестраивает каждую
+        затронутую группу стиля один раз, поэтому смена стиля у многих полигонов дает один кадр
+        """
+        linePen = not fields.keys().isdisjoint(('linecolor', 'linewidth', 'linestyle'))
+        handlePen = not fields.keys().isdisjoint(('markercolor', 'markersize'))
+        fill = 'fillcolor' in fields
+
+        # Повторное включение обновлений перерисовывает всю область, поэтому оно оправдано, только если
+        # меняется вид сразу нескольких полигонов
+        suspend = (linePen or handlePen or fill) and len(keys) > 1
+        if suspend:
+            self.displayArea.setUpdatesEnabled(False)
+        try:
+            with self.history.group():
+                for key_id in keys:
+                    if not self._updateFields(key_id, **fields):
+                        continue
+                    if linePen:
+                        self._applyLinePen(key_id)
+                    if handlePen:
+                        self._applyHandlePen(key_id)
+                    if fill:
+                        self.fillRenderer.show(key_id)
+        finally:
+            if suspend:
+                self.displayArea.setUpdatesEnabled(True)
 
     def regionChangeFinished(self, *args):
         roi, = args
+        start = perf_counter()
 
-        index = None
-        for i in range(len(self.displayData)):
-            if self.displayData[i].exterior_object == roi:
-                index = i
+        index = self.displayData.keyByRoi(roi)
         if index is None:
-            raise Exception("???")
-
-        # Информация
-        logging.info(f"Элемент {self.displayData[index].name} изменен")
-
-        # Меняем цвет точек (узлов) отображаемого объекта
-        for i in range(len(roi.handles)):
-            roi.handles[i]['item'].pen.setColor(self.getColorFromTuple(self.markerColorButtonWidget.color(mode='byte')))
-            roi.handles[i]['item'].pen.setWidth(self.markerSizeSpinBox.value())
-
-        handles = []
-        for handle in roi.handles:
-            handles.append(
-                handle['pos'] if isinstance(handle['pos'], pg.Point) else pg.Point(handle['pos'].x(), handle['pos'].y())
-            )
-
-        handles2 = []
-        for handle in self.displayData[index].exterior_object.handles:
-            handles2.append(
-                handle['pos'] if isinstance(handle['pos'], pg.Point) else pg.Point(handle['pos'].x(), handle['pos'].y())
-            )
-
-        print(roi.getState()['pos'], handles, "\n", self.displayData[index].exterior_object.getState()['pos'], handles2)
-        print([roi.getState()['pos'] + handle for handle in handles2])
-
-        polygon = Polygon(handles)
-        if not polygon.is_valid:
-            print("Polygon is invalid")
+            raise Exception("ROI is not in displayData")
+
+        # Обновляем мировые координаты полигона один раз на завершенное изменение (и сдвиг, и правка узлов).
+        # Узлы ROI - это внешний контур первой части, остальные контуры только сдвигаются вместе с ROI
+        record = self.displayData[index]
+        oldGeometry = self.flatGeometryOf(index)
+        exterior = roiWorldCoordinates(roi)
+        if index in self.roiCompanions:
+            others = mapRoiToWorld(roi, self.roiCompanions[index][1])
+            geometry = toFlatGeometry(FlatGeometry(
+                np.concatenate((exterior, others)),
+                np.concatenate(([0], record.ringOffsets[1:] - record.ringOffsets[1] + len(exterior))),
+                record.partOffsets
+            ))
+        else:
+            geometry = toFlatGeometry(exterior)
+        self.displayData.update(index, coordinates=geometry.coordinates, ringOffsets=geometry.ringOffsets)
+        if geometry.coordinates.flags.owndata:
+            self._ownedCoordinates[index] = geometry.coordinates
+        self.spatialIndex.insert(index, polygonFromFlat(geometry))
+        self.fillRenderer.invalidate(index)
+        self._geometryChanged(index)
+        self.history.record(verticesDelta(index, oldGeometry, geometry))
+        self.tracer.record("regionChangeFinished", index, perf_counter() - start, len(geometry.coordinates))
+
+        # Узлы, добавленные во время правки, получают перо стиля полигона
+        self._applyHandlePen(index)
+
+        # Внешний контур проверяется инкрементально при перемещении узлов, а вырезы и части - только
+        # при завершении изменения (их контуры не правятся узлами)
+        if not roi.isValid or (index in self.roiCompanions and not self.spatialIndex.geometry(index).is_valid):
+            self.tracer.record("invalidPoly", index)
 
     @staticmethod
     def regionChangeStarted(*args):
@@ -453,26 +553,23 @@ class PolyWidget(QtWidgets.QWidget):
         # roi.setState(roi.lastState)
 
     def regionChanged(self, *args):
+        """
+        Живая проверка во время перетаскивания узла: валидность контура уже посчитана в checkPointMove
+        (перепроверяются только два отрезка у перемещенного узла), здесь лишь меняется подсветка при ее смене
+        """
         roi, = args
 
-        index = None
-        for i in range(len(self.displayData)):
-            if self.displayData[i].exterior_object == roi:
-                index = i
+        index = self.displayData.keyByRoi(roi)
         if index is None:
-            raise Exception("???")
-
-        # Информация
-        logging.info(f"Элемент {self.displayData[index].name} изменен")
+            raise Exception("ROI is not in displayData")
 
-        # Меняем цвет точек (узлов) отображаемого объекта
-        for i in range(len(roi.handles)):
-            roi.handles[i]['item'].pen.setColor(self.getColorFromTuple(self.markerColorButtonWidget.color(mode='byte')))
-            roi.handles[i]['item'].pen.setWidth(self.markerSizeSpinBox.value())
+        if roi.isValid != self._roiShownValid.get(index, True):
+            self._applyLinePen(index)
 
     # ~~~ Методы, работающие с displayArea ~~~ #
 
-    def dAMouseMoved(self, event):
+    def dAMouseMoved(self, args):
+        event, = args      # аргументы сигнала, переданные через SignalProxy
         vb = self.displayArea.plotItem.vb
         if self.displayArea.sceneBoundingRect().contains(event):
             mousePoint = vb.mapSceneToView(event)
@@ -488,25 +585,23 @@ class PolyWidget(QtWidgets.QWidget):
 
         if self.displayArea.sceneBoundingRect().contains(sceneCoordinates) and event.button() == 1:
             mousePoint = vb.mapSceneToView(sceneCoordinates)
+            self.appendSketchPoint(mousePoint.x(), mousePoint.y())
+            self.tracer.record("sketchPoint", vertices=self.sketchCount)
 
-            # Информация
-            logging.info(f"Точка с координатами ({round(mousePoint.x(), 2)}, {round(mousePoint.y(), 2)}) "
-                         f"добавлена в tempBuffer")
-
-            self.polyBuffer.append((mousePoint.x(), mousePoint.y()))
-            ind = -1 if len(self.polyBuffer) == 1 else -2
-            x = [self.polyBuffer[ind][0], self.polyBuffer[-1][0]]
-            y = [self.polyBuffer[ind][1], self.polyBuffer[-1][1]]
-            tempItemObject = self.displayArea.plot(
-                x, y,
-                pen=pg.mkPen('w', width=0.8),
-                symbol='s',
-                symbolPen=(150, 255, 255, 200),
-                symbolSize=7,
-                symbolBrush=(0, 0, 0, 0)
-            )
-            self.tempItemsBuffer.append(tempItemObject)
-            return
+    def appendSketchPoint(self, x, y):
+        if self.sketchCount == len(self.sketchPoints):
+            grown = np.empty((2 * len(self.sketchPoints), 2))
+            grown[:self.sketchCount] = self.sketchPoints
+            self.sketchPoints = grown
+        self.sketchPoints[self.sketchCount] = x, y
+        self.sketchCount += 1
+
+        points = self.sketchPoints[:self.sketchCount]
+        self.sketchItem.setData(points[:, 0], points[:, 1])
+
+    def clearSketch(self):
+        self.sketchCount = 0
+        self.sketchItem.setData([], [])
 
     # ~~~ Сопутствующие методы ~~~ #
 
@@ -515,26 +610,7 @@ class PolyWidget(QtWidgets.QWidget):
         Возвращает имена полигонов из displayData
         """
 
-        res = []
-        for poly in self.displayData:
-            res.append(poly.name)
-        return res
-
-    def _isItemSelected(self, item):
-        """
-        Метод проверяет, Selected ли Item
-        """
-        if item.isSelected() and self.selectedFlag:
-            self.selectedFlag = False
-            # Информация
-            logging.info(f"Ключ {item.data(1)}. Элемент {item.text()} выбран")
-            return True
-
-        item.setSelected(False)
-        self.selectedFlag = True
-        # Информация
-        logging.info(f"Ключ {item.data(1)}. Выбор с элемента {item.text()} снят")
-        return False
+        return self.displayData.names()
 
     def setItemCustomizationButtonsActive(self, status):
         self.savePolyPushButton.setEnabled(status)
@@ -548,7 +624,7 @@ class PolyWidget(QtWidgets.QWidget):
         # Активируем/деактивируем меню редактирования
         self.lineColorButtonWidget.setEnabled(status)
         self.markerColorButtonWidget.setEnabled(status)
-        # self.polyFillColorButtonWidget.setEnabled(status)     # Заливка
+        self.polyFillColorButtonWidget.setEnabled(status)
         self.lineStyleComboBox.setEnabled(status)
         self.markerStyleComboBox.setEnabled(status)
         self.lineWidthSpinBox.setEnabled(status)
@@ -560,37 +636,64 @@ class PolyWidget(QtWidgets.QWidget):
         selectedItemFromData = self.displayData[index] if index is not None else None
 
         # Если нашли (что хотелось бы...), то заполняем панель кастомизации, исходя из информации о полигоне
-        # в displayData
+        # в displayData. Сигналы панели на время заполнения блокируются, иначе стиль этого полигона применился
+        # бы ко всем выбранным
         if selectedItemFromData is not None:
-            self.lineColorButtonWidget.setColor(selectedItemFromData.linecolor)
-            self.markerColorButtonWidget.setColor(selectedItemFromData.markercolor)
-            # self.polyFillColorButtonWidget.setColor(selectedItemFromData.fillcolor)     # Заливка
-
-            assert selectedItemFromData.linestyle in \
-                   [self.lineStyleComboBox.itemText(i) for i in
-                    range(self.lineStyleComboBox.count())], "Default linestyle not in possible linestyle list"
-            self.lineStyleComboBox.setCurrentText(selectedItemFromData.linestyle)
-
-            assert selectedItemFromData.markerstyle in \
-                   [self.markerStyleComboBox.itemText(i) for i in
-                    range(self.markerStyleComboBox.count())], "Default markerstyle not in possible markerstyle list"
-            self.markerStyleComboBox.setCurrentText(selectedItemFromData.markerstyle)
-
-            self.lineWidthSpinBox.setValue(selectedItemFromData.linewidth)
-            self.markerSizeSpinBox.setValue(selectedItemFromData.markersize)
+            for widget in self.customizationWidgets():
+                widget.blockSignals(True)
+            try:
+                self._fillCustomizationWidgets(selectedItemFromData)
+            finally:
+                for widget in self.customizationWidgets():
+                    widget.blockSignals(False)
         else:
             raise Exception("Couldn't find selected item in displayData...")
 
+    def customizationWidgets(self):
+        return [self.lineColorButtonWidget, self.markerColorButtonWidget, self.polyFillColorButtonWidget,
+                self.lineStyleComboBox, self.markerStyleComboBox, self.lineWidthSpinBox, self.markerSizeSpinBox]
+
+    def _fillCustomizationWidgets(self, selectedItemFromData):
+        self.lineColorButtonWidget.setColor(selectedItemFromData.linecolor)
+        self.markerColorButtonWidget.setColor(selectedItemFromData.markercolor)
+        self.polyFillColorButtonWidget.setColor(selectedItemFromData.fillcolor)
+
+        assert selectedItemFromData.linestyle in \
+               [self.lineStyleComboBox.itemText(i) for i in
+                range(self.lineStyleComboBox.count())], "Default linestyle not in possible linestyle list"
+        self.lineStyleComboBox.setCurrentText(selectedItemFromData.linestyle)
+
+        assert selectedItemFromData.markerstyle in \
+               [self.markerStyleComboBox.itemText(i) for i in
+                range(self.markerStyleComboBox.count())], "Default markerstyle not in possible markerstyle list"
+        self.markerStyleComboBox.setCurrentText(selectedItemFromData.markerstyle)
+
+        self.lineWidthSpinBox.setValue(selectedItemFromData.linewidth)
+        self.markerSizeSpinBox.setValue(selectedItemFromData.markersize)
+
+    def selectedKeys(self):
+        """
+        Возвращает key_id выбранных в polyListWidget полигонов, а если выбранных нет - текущего
+        """
+        keys = [item.data(1) for item in self.polyListWidget.selectedItems()]
+        if not keys and self.polyListWidget.currentItem() is not None:
+            keys = [self.polyListWidget.currentItem().data(1)]
+        return [key_id for key_id in keys if key_id in self.displayData]
+
     def findItemIndexInData(self, item):
         """
-        Метод ищет индекс Item'а в displayData и возвращает его или None,
+        Метод ищет индекс Item'а в displayData (его key_id) и возвращает его или None,
         если элемент не нашелся (надеюсь, такого не будет)
         """
 
-        for i in range(len(self.displayData)):
-            if self.displayData[i].key_id == item.data(1):
-                return i
-        return None
+        key_id = item.data(1)
+        return key_id if key_id in self.displayData else None
+
+    @staticmethod
+    def displayRefreshRate():
+        screen = QtGui.QGuiApplication.primaryScreen()
+        rate = screen.refreshRate() if screen is not None else 0
+        return rate if rate > 0 else 60
 
     def getDisplayAreaState(self):
         return self.displayArea.getViewBox().state['viewRange']
@@ -617,15 +720,54 @@ class PolyWidget(QtWidgets.QWidget):
             mid + np.array([r * sqrt(3/2), -r * 0.5])
         ]
 
+    def queryPolysInBox(self, xmin, ymin, xmax, ymax):
+        """
+        Возвращает key_id полигонов, пересекающих прямоугольник
+        """
+        return self.spatialIndex.queryBox(xmin, ymin, xmax, ymax)
+
+    def queryPolysAtPoint(self, x, y):
+        """
+        Возвращает key_id полигонов, содержащих точку (например, под курсором)
+        """
+        return self.spatialIndex.queryPoint(x, y)
+
+    def queryNearestPoly(self, x, y):
+        """
+        Возвращает key_id ближайшего к точке полигона или None
+        """
+        return self.spatialIndex.nearest(x, y)
+
+    def showMetricsTable(self):
+        """
+        Показывает окно с сортируемой таблицей метрик всех полигонов (площадь, периметр, центр, габариты).
+        Двойной щелчок по строке выбирает полигон
+        """
+        if self.metricsView is None:
+            self.metricsView = QtWidgets.QTableView(self)
+            self.metricsView.setWindowFlags(QtCore.Qt.Tool)
+            self.metricsView.setWindowTitle('Метрики полигонов')
+            self.metricsView.setModel(self.metricsModel)
+            self.metricsView.setSortingEnabled(True)
+            self.metricsView.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+            self.metricsView.verticalHeader().setVisible(False)
+            self.metricsView.doubleClicked.connect(self.metricsRowActivated)
+        self.metricsView.show()
+        self.metricsView.raise_()
+
+    def metricsRowActivated(self, index):
+        item = self.polyItems.get(self.metricsModel.keyAt(index.row()))
+        if item is None:
+            return
+        # Выбор строки списка сам переводит полигон в редактируемый ROI (polySelectionChanged)
+        self.polyListWidget.setCurrentItem(item)
+
+    def getLinePen(self, linecolor, linewidth, linestyle):
+        return self.styleCache.linePen(linecolor, linewidth, linestyle)
+
     @staticmethod
     def getStyleFromStr(string):
-        if string.lower() == "solid":
-            return QtCore.Qt.SolidLine
-        elif string.lower() == "dashed":
-            return QtCore.Qt.DashLine
-        if string.lower() == "dash-dotted":
-            return QtCore.Qt.DashDotLine
-        return QtCore.Qt.DotLine
+        return penStyleFromStr(string)
 
     @staticmethod
     def getColorFromTuple(tup):
@@ -638,121 +780,219 @@ class PolyWidget(QtWidgets.QWidget):
     def doOperation(self):
         operation = self.polyOperationsComboBox.currentText()
 
-        polyName1 = self.poly1LineEdit.text()
-        index1 = None
-        for i in range(len(self.displayData)):
-            if self.displayData[i].name == polyName1:
-                index1 = i
-        if index1 is None:
-            QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Области с именем {polyName1} не существует')
+        keys = self.getOperandKeys()
+        if keys is None:
             return
-
-        polyName2 = self.poly2LineEdit.text()
-        index2 = None
-        for i in range(len(self.displayData)):
-            if self.displayData[i].name == polyName2:
-                index2 = i
-        if index2 is None:
-            QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Области с именем {polyName2} не существует')
+        if len(keys) < 2:
+            QtWidgets.QMessageBox.about(self, 'Ошибка!', 'Для операции нужно выбрать хотя бы две области')
             return
 
-        roi1 = self.displayData[index1].exterior_object
-        roi2 = self.displayData[index2].exterior_object
-
-        handles1 = []
-        for handle in roi1.handles:
-            handles1.append(
-                handle['pos'] if isinstance(handle['pos'], pg.Point) else pg.Point(handle['pos'].x(), handle['pos'].y())
-            )
-        handles1 = [roi1.getState()['pos'] + handle for handle in handles1]
-
-        handles2 = []
-        for handle in roi2.handles:
-            handles2.append(
-                handle['pos'] if isinstance(handle['pos'], pg.Point) else pg.Point(handle['pos'].x(), handle['pos'].y())
-            )
-        handles2 = [roi2.getState()['pos'] + handle for handle in handles2]
+        if self.operationJob is not None:
+            return
 
-        polygon1 = Polygon(handles1)
-        polygon2 = Polygon(handles2)
+        # Ту же операцию над теми же (по содержимому) операндами не пересчитываем
+        cacheKey = self.operationCache.key(operation, [self.fingerprintOf(key_id) for key_id in keys])
+        results = self.operationCache.get(cacheKey)
+        if results is not None:
+            if self.tracer.enabled:
+                self.tracer.record("operationCacheHit", vertices=sum(len(g.coordinates) for g in results))
+            self._applyOperationResult(operation, keys, results)
+            return
 
-        if operation == "Unite":
-            union = unary_union((polygon1, polygon2))
-            unionCoordinates = extractPolyCoordinates(union)
+        # В фоновую задачу передаются только массивы координат (только для чтения, без копирования)
+        self._shareCoordinates(keys)
+        job = BooleanOperationJob(operation, keys, [self.flatGeometryOf(key_id) for key_id in keys], cacheKey)
+        self._startJob(job, self.operationFinished)
+        if self.tracer.enabled:
+            self.tracer.record("operationStarted", vertices=sum(len(g.coordinates) for g in job.flatGeometries))
 
-            itemsInListWidget = [self.polyListWidget.item(x) for x in range(self.polyListWidget.count())]
+    def _shareCoordinates(self, keys):
+        """
+        Массивы координат полигонов keys уходят в фоновую задачу: после этого они больше не меняются на месте
+        (первая отмена правки вершин сделает копию)
+        """
+        for key_id in keys:
+            self._ownedCoordinates.pop(key_id, None)
 
-            for item in itemsInListWidget:
-                if item.text() == polyName1:
-                    item.setSelected(True)
-                    self.polyDeletion()
+    def _startJob(self, job, finished):
+        job.signals.progress.connect(self.operationProgressBar.setValue)
+        job.signals.finished.connect(finished)
+        job.signals.failed.connect(self.operationFailed)
+        job.signals.stopped.connect(self._operationJobs.discard)
 
-            for item in itemsInListWidget:
-                if item.text() == polyName2:
-                    item.setSelected(True)
-                    self.polyDeletion()
+        self.operationJob = job
+        self._operationJobs.add(job)
+        self.setOperationRunning(True)
+        self.operationPool.start(job)
 
-            self.polyAddition(exterior=unionCoordinates['exterior'])
+    def getOperandKeys(self):
+        """
+        Возвращает key_id операндов: две области, чьи имена введены в poly1LineEdit и poly2LineEdit, либо (если
+        поля не заполнены) все выбранные в polyListWidget области. Текущий элемент списка идет первым - он
+        является уменьшаемым для Subtract. Возвращает None, если имя из поля ввода не найдено
+        """
+        polyNames = [self.poly1LineEdit.text(), self.poly2LineEdit.text()]
+        if all(polyNames):
+            keys = []
+            for polyName in polyNames:
+                key_id = self.displayData.keyByName(polyName)
+                if key_id is None:
+                    QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Области с именем {polyName} не существует')
+                    return None
+                keys.append(key_id)
+            return keys
+
+        keys = [item.data(1) for item in self.polyListWidget.selectedItems()]
+        currentItem = self.polyListWidget.currentItem()
+        if currentItem is not None and currentItem.data(1) in keys:
+            keys.remove(currentItem.data(1))
+            keys.insert(0, currentItem.data(1))
+        return keys
 
-        if operation == "Intersect":
-            intersection = polygon1.intersection(polygon2)
-            intersectionCoordinates = extractPolyCoordinates(intersection)
+    def operationFinished(self, job, results):
+        """
+        Применение результата фоновой операции (в GUI-потоке): все операнды удаляются и все результаты
+        добавляются за один шаг
+        """
+        if job is not self.operationJob:
+            return
+        self.operationJob = None
+        self.setOperationRunning(False)
 
-            itemsInListWidget = [self.polyListWidget.item(x) for x in range(self.polyListWidget.count())]
+        # Результат верен для операндов на момент запуска, даже если с тех пор их изменили
+        self.operationCache.put(job.cacheKey, results)
 
-            for item in itemsInListWidget:
-                if item.text() == polyName1:
-                    item.setSelected(True)
-                    self.polyDeletion()
+        # Если пока шло вычисление операнд удалили или изменили, результат устарел
+        for key_id, geometry in zip(job.keys, job.flatGeometries):
+            if key_id not in self.displayData or \
+                    self.displayData.get(key_id, "coordinates") is not geometry.coordinates:
+                QtWidgets.QMessageBox.about(self, 'Ошибка!', 'Операнды изменились во время выполнения операции')
+                return
 
-            for item in itemsInListWidget:
-                if item.text() == polyName2:
-                    item.setSelected(True)
-                    self.polyDeletion()
+        if self.tracer.enabled:
+            self.tracer.record(job.operation, duration=perf_counter() - job.submitted,
+                               vertices=sum(len(g.coordinates) for g in results))
+        self._applyOperationResult(job.operation, job.keys, results)
 
-            self.polyAddition(exterior=intersectionCoordinates['exterior'])
+    def _applyOperationResult(self, operation, keys, results):
+        """
+        Применение результата операции: операнды удаляются и результаты добавляются за один шаг. При пустом
+        результате операнды и журнал не трогаются
+        """
+        if not results:
+            QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Результат операции {operation} пуст')
+            return
 
-        if operation == "Subtract":
-            subtraction = polygon1.difference(polygon2)
-            subtractionCoordinates = extractPolyCoordinates(subtraction)
+        # Subtract расходует только уменьшаемое, остальные операции - все операнды
+        consumed = keys[:1] if operation == "Subtract" else keys
+        with self.history.group():
+            self.polyBulkDeletion(consumed)
+            self.polyBulkAddition(results)
 
-            logging.info(f"Из полигона {self.displayData[index1].name} был вычтен полигон {self.displayData[index2].name}")
+        self.poly1LineEdit.clear()
+        self.poly2LineEdit.clear()
 
-            itemsInListWidget = [self.polyListWidget.item(x) for x in range(self.polyListWidget.count())]
+    def overlayPolys(self, keysA, keysB, workers=None):
+        """
+        Наложение двух групп полигонов (например, участков и зон): добавляются непустые пересечения всех пар
+        полигонов из разных групп. Пары-кандидаты отбираются через STRtree, а пересечения считаются в фоне
+        (при большом числе пар - в нескольких процессах). Каждый результат - производный полигон (узел Intersect
+        графа операций), поэтому он помечен обоими исходными key_id (operationGraph.node(key_id).inputs)
+        и пересчитывается при их изменении. Группы можно задать выбором или именами (polyKeysWithPrefix)
+        """
+        keysA = list(keysA)
+        keysB = list(keysB)
+        if not keysA or not keysB:
+            QtWidgets.QMessageBox.about(self, 'Ошибка!', 'Для наложения нужны две непустые группы областей')
+            return
+        if self.operationJob is not None:
+            return
 
-            # [pg.Point(x, y) for (x, y) in subtractionCoordinates['exterior']]
+        self._shareCoordinates(keysA + keysB)
+        job = OverlayJob(keysA, [self.flatGeometryOf(key_id) for key_id in keysA],
+                         keysB, [self.flatGeometryOf(key_id) for key_id in keysB], workers)
+        self._startJob(job, self.overlayFinished)
+        if self.tracer.enabled:
+            self.tracer.record("overlayStarted", vertices=sum(len(g.coordinates) for g in job.flatGeometriesA) +
+                               sum(len(g.coordinates) for g in job.flatGeometriesB))
 
-            for item in itemsInListWidget:
-                if item.text() == polyName1:
-                    item.setSelected(True)
-                    self.polyDeletion()
+    def overlayFinished(self, job, results):
+        """
+        Добавление результатов наложения (в GUI-потоке) одним шагом журнала
+        """
+        if job is not self.operationJob:
+            return
+        self.operationJob = None
+        self.setOperationRunning(False)
 
-            self.polyAddition(exterior=subtractionCoordinates['exterior'])
+        for key_id, geometry in zip(job.keysA + job.keysB, job.flatGeometriesA + job.flatGeometriesB):
+            if key_id not in self.displayData or \
+                    self.displayData.get(key_id, "coordinates") is not geometry.coordinates:
+                QtWidgets.QMessageBox.about(self, 'Ошибка!', 'Области изменились во время наложения')
+                return
 
-        if operation == "Symmetry Difference":
-            difference1 = polygon1.difference(polygon2)
-            difference2 = polygon2.difference(polygon1)
+        pairs, geometries = results
+        if self.tracer.enabled:
+            self.tracer.record(job.operation, duration=perf_counter() - job.submitted,
+                               vertices=sum(len(g.coordinates) for g in geometries))
+        store = self.displayData
+        names = [f"{store.get(keyA, 'name')}&{store.get(keyB, 'name')}" for keyA, keyB in pairs]
+        with self.history.group():
+            newKeys = self.polyBulkAddition(geometries, names=names)
+        for key_id, sources in zip(newKeys, pairs):
+            self.operationGraph.add(key_id, "Intersect", sources, [self.fingerprintOf(k) for k in sources])
 
-            difference1Coordinates = extractPolyCoordinates(difference1)
-            difference2Coordinates = extractPolyCoordinates(difference2)
+    def overlayGroupAButtonClicked(self):
+        self._setOverlayGroup('A', self.overlayGroupAPushButton)
 
-            itemsInListWidget = [self.polyListWidget.item(x) for x in range(self.polyListWidget.count())]
+    def overlayGroupBButtonClicked(self):
+        self._setOverlayGroup('B', self.overlayGroupBPushButton)
 
-            for item in itemsInListWidget:
-                if item.text() == polyName1:
-                    item.setSelected(True)
-                    self.polyDeletion()
+    def _setOverlayGroup(self, group, button):
+        """
+        Запоминает выбранные в polyListWidget полигоны как группу наложения group ('A' или 'B')
+        """
+        keys = self.selectedKeys()
+        self.overlayGroups[group] = keys
+        button.setText(f'Группа {group}: {len(keys)}')
+        self.overlayPushButton.setEnabled(self.operationJob is None and all(self.overlayGroups.values()))
+
+    def overlayButtonClicked(self):
+        # Полигоны, удаленные после выбора группы, пропускаются
+        keysA, keysB = ([key_id for key_id in self.overlayGroups[group] if key_id in self.displayData]
+                        for group in ('A', 'B'))
+        self.overlayPolys(keysA, keysB)
+
+    def polyKeysWithPrefix(self, prefix):
+        """
+        Возвращает key_id полигонов, чьи имена начинаются с prefix (в порядке добавления)
+        """
+        return [key_id for key_id, name in zip(self.displayData.column("key_id").tolist(),
+                                               self.displayData.column("name")) if name.startswith(prefix)]
 
-            for item in itemsInListWidget:
-                if item.text() == polyName2:
-                    item.setSelected(True)
-                    self.polyDeletion()
+    def operationFailed(self, job, message):
+        if job is not self.operationJob:
+            return
+        self.operationJob = None
+        self.setOperationRunning(False)
+        QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Операция {job.operation} не выполнена: {message}')
 
-            self.polyAddition(exterior=difference1Coordinates['exterior'])
-            self.polyAddition(exterior=difference2Coordinates['exterior'])
+    def cancelOperation(self):
+        """
+        Отмена текущей операции: задача доработает текущий шаг в фоне, но ее результат будет отброшен
+        """
+        if self.operationJob is None:
+            return
+        self.operationJob.cancel()
+        self.operationJob = None
+        self.setOperationRunning(False)
+        self.tracer.record("operationCancelled")
 
-        self.poly1LineEdit.clear()
-        self.poly2LineEdit.clear()
+    def setOperationRunning(self, status):
+        self.doPolyOperationPushButton.setEnabled(not status)
+        self.overlayPushButton.setEnabled(not status and all(self.overlayGroups.values()))
+        self.cancelOperationPushButton.setEnabled(status)
+        self.operationProgressBar.setValue(0)
 
     def operationActivated(self):
         operation = self.polyOperationsComboBox.currentText()
@@ -773,61 +1013,542 @@ class PolyWidget(QtWidgets.QWidget):
 
     def polyAddition(self, exterior=None):
         assert exterior is not None, "Need to add exterior coordinates"
+        self.polyBulkAddition([exterior])
 
-        # Преобразуем новый полигон в Item, чтобы можно было с ним работать, как с QListWidgetItem
-        newPolygonAsItem = QtWidgets.QListWidgetItem(self.polyListWidget)
-        polyNames = self.displayDataNames()
+    def polyBulkAddition(self, polygons, names=None, styles=None):
+        """
+        Добавление сразу многих полигонов за один шаг: QListWidget не перерисовывается и не шлет сигналы до конца
+        добавления, пространственный индекс обновляется одним пакетом, а пакетная отрисовка перестраивается
+        один раз. Полигон - это последовательность точек внешнего контура или FlatGeometry (с вырезами и частями).
+        Необязательные names и styles (словари полей стиля PolyRecord) задаются по одному
+        на полигон. Возвращает key_id добавленных полигонов
+        """
+        start = perf_counter()
+        names = repeat(None) if names is None else names
+        styles = repeat(None) if styles is None else styles
+
+        # Сначала разбираются геометрии, имена и стили всего пакета: если что-то не удалось, ничего не добавлено
+        geometries = []
+        newNames = []
+        takenNames = set()
+        overrides = []
+        taken = lambda n: self.displayData.hasName(n) or n in takenNames
+        for polygon, name, style in zip(polygons, names, styles):
+            geometries.append(toFlatGeometry(polygon))
+
+            # Пресечем возможность совпадения имен при добавлении нового элемента (в том числе внутри пакета)
+            if name is None or taken(name):
+                suffix = self.key_id + len(newNames) + 1
+                while taken(f"Polygon_{suffix}"):
+                    suffix += 1
+                name = f"Polygon_{suffix}"
+            takenNames.add(name)
+            newNames.append(name)
+            if style is not None:
+                overrides.append((len(newNames) - 1, style))
+
+        # Пакет записывается в хранилище одним снимком столбцов, тот же снимок попадает в журнал. Редактируемый
+        # ROI создается только при выборе полигона (_promotePoly), до этого полигон рисуется пакетно
+        newKeys = list(range(self.key_id, self.key_id + len(geometries)))
+        columns = self.displayData.newColumns(newKeys, newNames, geometries, self.defaultStyle(), overrides)
+        self.displayData.addColumns(columns)
+        self.key_id += len(newKeys)
+
+        # Преобразуем новые полигоны в Item'ы, чтобы можно было с ними работать, как с QListWidgetItem
+        self.polyListWidget.setUpdatesEnabled(False)
+        self.polyListWidget.blockSignals(True)
+        try:
+            for key_id, name in zip(newKeys, newNames):
+                self.polyItems[key_id] = self._newListItem(key_id, name)
+        finally:
+            self.polyListWidget.blockSignals(False)
+            self.polyListWidget.setUpdatesEnabled(True)
+
+        self._showPolys(newKeys)
+        self.history.record(PolysAdded(columns))
+        self.tracer.record("polyBulkAddition", duration=perf_counter() - start,
+                           vertices=sum(len(geometry.coordinates) for geometry in geometries))
+        return newKeys
+
+    def defaultStyle(self):
+        return dict(
+            linecolor=self.DEFAULT_LINE_COLOR,
+            linewidth=self.DEFAULT_LINE_WIDTH,
+            linestyle=self.DEFAULT_LINE_STYLE,
+            markercolor=self.DEFAULT_MARKER_COLOR,
+            markersize=self.DEFAULT_MARKER_SIZE,
+            markerstyle=self.DEFAULT_MARKER_STYLE,
+            fillcolor=self.DEFAULT_FILL_COLOR
+        )
 
-        # Пресечем возможность совпадения имен при добавлении нового элемента
-        newPolyName = f"Polygon_{self.key_id + 1}"
-        newPolygonAsItem.setText(newPolyName if newPolyName not in polyNames else f"Polygon_{self.key_id + 2}")
-        newPolygonAsItem.setData(1, self.key_id)
+    def _newListItem(self, key_id, name, row=None):
+        item = QtWidgets.QListWidgetItem()
+        item.setText(name)
+        item.setData(1, key_id)
 
-        # Добавляем Item на наш QListWidget и присваиваем ему дефолтное имя по порядку, исходя из displayData.
-        self.polyListWidget.addItem(newPolygonAsItem)
+        # Сделаем поле с названием полигона изменяемым (удобно ж). Но надо не забыть учесть изменение имя
+        # пользователем в хранилище displayData
+        item.setFlags(item.flags() | QtCore.Qt.ItemIsEditable)
 
-        # Сделаем поле с названием полигона изменяемым (удобно ж). Но надо не забыть учесть изменение имя пользователем
-        # в хранилище displayData
-        newPolygonAsItem.setFlags(newPolygonAsItem.flags() | QtCore.Qt.ItemIsEditable)
+        # Добавляем Item на наш QListWidget
+        if row is None:
+            self.polyListWidget.addItem(item)
+        else:
+            self.polyListWidget.insertItem(row, item)
+        return item
+
+    def _showPolys(self, keys):
+        geometries = polygonsFromFlatBatch([self.flatGeometryOf(key_id) for key_id in keys])
+        self.spatialIndex.bulkInsert(zip(keys, geometries))
+        self.metricsModel.polysChanged(keys)
+        for key_id in keys:
+            self.fillRenderer.show(key_id)
+            if self.batchRendering:
+                self.batchRenderer.show(key_id)
+            else:
+                self._promotePoly(key_id)
+
+    def flatGeometryOf(self, key_id):
+        store = self.displayData
+        return FlatGeometry(store.get(key_id, "coordinates"), store.get(key_id, "ringOffsets"),
+                            store.get(key_id, "partOffsets"))
+
+    def fingerprintOf(self, key_id):
+        """
+        Отпечаток геометрии полигона (geometryFingerprint). Вычисляется один раз и сбрасывается, когда геометрия
+        меняется
+        """
+        fingerprint = self._fingerprints.get(key_id)
+        if fingerprint is None:
+            fingerprint = self._fingerprints[key_id] = geometryFingerprint(self.flatGeometryOf(key_id))
+        return fingerprint
 
-        # Создадим на его месте полноценное изображение полигона
-        exteriorObj = pg.PolyLineROI(
-            exterior,
+    def _geometryChanged(self, key_id):
+        """
+        Геометрия полигона изменилась: отпечаток сбрасывается, а зависимые производные полигоны ставятся
+        в очередь на пересчет
+        """
+        self._fingerprints.pop(key_id, None)
+        self.metricsModel.polysChanged([key_id])
+        self.operationGraph.invalidate(key_id)
+        self._scheduleDerived()
+
+    def _updateFields(self, key_id, **fields):
+        """
+        Меняет поля записи полигона (имя, стиль) и записывает изменение в журнал отмены. Возвращает False,
+        если значения полей не изменились
+        """
+        old = {field: self.displayData.get(key_id, field) for field in fields}
+        if old == fields:
+            return False
+        self.displayData.update(key_id, **fields)
+        self.history.record(FieldsChanged(key_id, old, fields))
+        self.tracer.record("fieldsChanged", key_id)
+        if 'name' in fields:
+            self.metricsModel.nameChanged(key_id)
+        return True
+
+    # ~~~ Производные полигоны (граф операций) ~~~ #
+
+    def derivePolyButtonClicked(self):
+        # Операция и операнды берутся из панели операций (полей ввода или выбора в polyListWidget)
+        self.derivePoly()
+
+    def derivePoly(self, operation=None, keys=None):
+        """
+        Недеструктивная операция: результат добавляется производным полигоном (узлом графа операций), а операнды
+        остаются на месте. Когда геометрия операндов меняется, производный полигон пересчитывается. По умолчанию
+        берутся операция из polyOperationsComboBox и операнды getOperandKeys. Возвращает key_id производного
+        полигона или None, если результат пуст
+        """
+        operation = self.polyOperationsComboBox.currentText() if operation is None else operation
+        keys = self.getOperandKeys() if keys is None else list(keys)
+        if keys is None:
+            return None
+        if len(keys) < 2:
+            QtWidgets.QMessageBox.about(self, 'Ошибка!', 'Для операции нужно выбрать хотя бы две области')
+            return None
+
+        fingerprints = [self.fingerprintOf(key_id) for key_id in keys]
+        results = self._operationResults(operation, keys, fingerprints)
+        if not results:
+            QtWidgets.QMessageBox.about(self, 'Ошибка!', f'Результат операции {operation} пуст')
+            return None
+
+        key_id, = self.polyBulkAddition(results)
+        self.operationGraph.add(key_id, operation, keys, fingerprints)
+        return key_id
+
+    def detachDerivedPoly(self, key_id):
+        """
+        Превращает производный полигон в обычный: он больше не пересчитывается при изменении операндов
+        """
+        if key_id in self.operationGraph:
+            self.operationGraph.detach(key_id)
+
+    def _operationResults(self, operation, keys, fingerprints):
+        """
+        Результат операции для производного полигона (список из не более чем одной FlatGeometry) в GUI-потоке:
+        из кэша результатов или вычисленный и сохраненный в кэш. Доли операндов Symmetry Difference
+        объединяются в один полигон
+        """
+        cacheKey = self.operationCache.key(operation, fingerprints)
+        results = self.operationCache.get(cacheKey)
+        if results is None:
+            results = [extractPolyCoordinates(result) for result in
+                       booleanOperation(operation, [self.flatGeometryOf(key_id) for key_id in keys])]
+            self.operationCache.put(cacheKey, results)
+        if len(results) > 1:
+            results = [extractPolyCoordinates(shapely.union_all(polygonsFromFlatBatch(results)))]
+        return results
+
+    def _scheduleDerived(self):
+        if not self._derivedScheduled and self.operationGraph.hasDirty():
+            self._derivedScheduled = True
+            QtCore.QTimer.singleShot(0, self.evaluateDerived)
+
+    def evaluateDerived(self):
+        """
+        Пересчитывает производные полигоны из очереди в топологическом порядке (вызывается отложенно, один раз
+        на серию изменений). Узел пересчитывается, только если изменились отпечатки его входов, а его зависимые
+        проверяются, только если изменился он сам. Пересчет - следствие правки операндов, поэтому в журнал
+        отмены не пишется: отмена правки операнда пересчитает производные полигоны обратно
+        """
+        self._derivedScheduled = False
+        graph = self.operationGraph
+        vertices = 0
+        with self.tracer.span("evaluateDerived") as span, self.history.suspended():
+            while graph.hasDirty():
+                key_id = graph.popDirty()
+                operation, inputs = graph.node(key_id)
+
+                # Удаленный пользователем производный полигон и полигон с удаленным входом ждут отмены удаления
+                if not (key_id in self.displayData or key_id in self._emptyDerived) or \
+                        any(input_id not in self.displayData for input_id in inputs):
+                    continue
+                fingerprints = [self.fingerprintOf(input_id) for input_id in inputs]
+                if not graph.isStale(key_id, fingerprints):
+                    continue
+
+                results = self._operationResults(operation, inputs, fingerprints)
+                graph.markEvaluated(key_id, fingerprints)
+                vertices += sum(len(g.coordinates) for g in results)
+
+                # Пустой результат скрывает полигон (у полигона не бывает пустой геометрии) до следующего
+                # непустого результата
+                if not results:
+                    if key_id in self.displayData:
+                        self._emptyDerived[key_id] = self._removePolys([key_id])
+                    continue
+                geometry = results[0]
+                if key_id in self._emptyDerived:
+                    columns, rows = self._emptyDerived.pop(key_id)
+                    self._restorePolys(columns._replace(coordinates=[geometry.coordinates],
+                                                        ringOffsets=[geometry.ringOffsets],
+                                                        partOffsets=[geometry.partOffsets]), rows)
+                else:
+                    self._setGeometry(key_id, geometry)
+            span.vertices = vertices
+
+    # ~~~ Пакетные операции над геометрией ~~~ #
+
+    def polyGeometries(self, keys=None):
+        """
+        Массив shapely-геометрий полигонов keys (по умолчанию всех) для векторизованных функций shapely 2.
+        Геометрии берутся из пространственного индекса, где они уже собраны из буферов координат
+        """
+        keys = self.displayData.keys() if keys is None else keys
+        geometries = np.empty(len(keys), dtype=object)
+        geometries[:] = [self.spatialIndex.geometry(key_id) for key_id in keys]
+        return geometries
+
+    def polyAreas(self, keys=None):
+        """
+        Площади полигонов keys (по умолчанию всех) одним вызовом shapely.area
+        """
+        return shapely.area(self.polyGeometries(keys))
+
+    def invalidPolys(self, keys=None):
+        """
+        Возвращает key_id некорректных (самопересекающихся и т.п.) полигонов из keys (по умолчанию всех),
+        проверяя все полигоны одним вызовом shapely.is_valid. Например, для проверки после загрузки
+        """
+        keys = list(self.displayData.keys() if keys is None else keys)
+        valid = shapely.is_valid(self.polyGeometries(keys))
+        return [key_id for key_id, ok in zip(keys, valid.tolist()) if not ok]
+
+    def unitePolys(self, keys=None):
+        """
+        Объединяет полигоны keys (по умолчанию все) одним вызовом shapely.union_all: операнды заменяются
+        результатом за один шаг журнала. Возвращает key_id добавленных полигонов
+        """
+        keys = list(self.displayData.keys() if keys is None else keys)
+        if len(keys) < 2:
+            return []
+        with self.tracer.span("unitePolys", vertices=self._tracedVertices(keys)):
+            union = shapely.union_all(self.polyGeometries(keys))
+            results = [flat for flat in flatGeometriesFromPolygons([union]) if flat is not None]
+            with self.history.group():
+                self.polyBulkDeletion(keys)
+                return self.polyBulkAddition(results)
+
+    def clipPolys(self, boundary, keys=None):
+        """
+        Обрезает полигоны keys (по умолчанию все) границей boundary (shapely-геометрия, FlatGeometry или точки
+        контура) одним вызовом shapely.intersection. Возвращает key_id измененных полигонов
+        """
+        return self._applyBatchOperation(shapely.intersection, boundary, keys)
+
+    def subtractFromPolys(self, cutter, keys=None):
+        """
+        Вычитает cutter из полигонов keys (по умолчанию всех) одним вызовом shapely.difference. Возвращает key_id
+        измененных полигонов
+        """
+        return self._applyBatchOperation(shapely.difference, cutter, keys)
+
+    def _tracedVertices(self, keys):
+        """
+        Число вершин полигонов keys для трассировки (0 без перебора, если трассировка выключена)
+        """
+        if not self.tracer.enabled:
+            return 0
+        return sum(len(self.displayData.get(key_id, "coordinates")) for key_id in keys)
+
+    def _applyBatchOperation(self, operation, other, keys):
+        """
+        Применяет векторизованную функцию shapely operation(геометрии, other) к полигонам keys. Новая геометрия
+        записывается только в изменившиеся полигоны, а полигоны, от которых ничего не осталось, удаляются -
+        все за один шаг журнала
+        """
+        keys = list(self.displayData.keys() if keys is None else keys)
+        if not isinstance(other, shapely.Geometry):
+            other = polygonFromFlat(toFlatGeometry(other))
+
+        with self.tracer.span(operation.__name__, vertices=self._tracedVertices(keys)):
+            geometries = self.polyGeometries(keys)
+            results = operation(geometries, other)
+            # Полигоны, целиком лежащие внутри (для intersection) или снаружи (для difference), не меняются
+            changed = np.flatnonzero(~shapely.equals(results, geometries))
+            flats = flatGeometriesFromPolygons(results[changed])
+
+            changedKeys = []
+            emptyKeys = []
+            with self.history.group():
+                for i, flat in zip(changed.tolist(), flats):
+                    key_id = keys[i]
+                    if flat is None:
+                        emptyKeys.append(key_id)
+                        continue
+                    self.history.record(verticesDelta(key_id, self.flatGeometryOf(key_id), flat))
+                    self._setGeometry(key_id, flat, polygon=results[i])
+                    changedKeys.append(key_id)
+                if emptyKeys:
+                    self.polyBulkDeletion(emptyKeys)
+        return changedKeys
+
+    # ~~~ Отмена и повтор действий ~~~ #
+
+    def undo(self):
+        if not self.history.canUndo():
+            return
+        with self.tracer.span("undo"), self.history.suspended():
+            for delta in reversed(self.history.undoStep()):
+                self._applyDelta(delta, undo=True)
+
+    def redo(self):
+        if not self.history.canRedo():
+            return
+        with self.tracer.span("redo"), self.history.suspended():
+            for delta in self.history.redoStep():
+                self._applyDelta(delta, undo=False)
+
+    def _applyDelta(self, delta, undo):
+        if isinstance(delta, (PolysAdded, PolysRemoved)):
+            if isinstance(delta, PolysRemoved) == undo:
+                self._restorePolys(delta.columns, getattr(delta, 'rows', None))
+            else:
+                self.polyBulkDeletion(delta.columns.key_id.tolist())
+
+        elif isinstance(delta, FieldsChanged):
+            fields = delta.old if undo else delta.new
+            self.displayData.update(delta.key_id, **fields)
+            self.fillRenderer.show(delta.key_id)
+            item = self.polyItems[delta.key_id]
+            if 'name' in fields:
+                self.polyListWidget.blockSignals(True)
+                item.setText(fields['name'])
+                self.polyListWidget.blockSignals(False)
+                self.metricsModel.nameChanged(delta.key_id)
+            self._refreshPoly(delta.key_id)
+            if item.isSelected():
+                self.fillItemCustomizationButtons(item)
+
+        elif isinstance(delta, (VerticesMoved, VerticesTranslated)):
+            # Массив, которым владеет журнал, правится на месте; чужой (из кэша, фоновой задачи, файла)
+            # копируется один раз, и дальше журнал владеет копией
+            flat = self.flatGeometryOf(delta.key_id)
+            owned = self._ownedCoordinates.get(delta.key_id) is flat.coordinates
+            coordinates = applyVertices(flat.coordinates, delta, undo, inPlace=owned)
+            self._ownedCoordinates[delta.key_id] = coordinates
+            self._setGeometry(delta.key_id, flat._replace(coordinates=coordinates),
+                              movedIndices=getattr(delta, 'indices', None))
+
+        elif isinstance(delta, GeometryReplaced):
+            self._setGeometry(delta.key_id, delta.old if undo else delta.new)
+
+    def _restorePolys(self, columns, rows=None):
+        """
+        Возвращает удаленные полигоны (снимок столбцов PolyColumns) с прежними key_id (и на прежние строки
+        QListWidget, если они известны)
+        """
+        keys = columns.key_id.tolist()
+        names = self.displayData.decode("name", columns.name)
+        rows = repeat(None) if rows is None else rows
+        self.displayData.addColumns(columns)
+        self.polyListWidget.setUpdatesEnabled(False)
+        self.polyListWidget.blockSignals(True)
+        try:
+            for key_id, name, row in zip(keys, names, rows):
+                self.polyItems[key_id] = self._newListItem(key_id, name, row)
+        finally:
+            self.polyListWidget.blockSignals(False)
+            self.polyListWidget.setUpdatesEnabled(True)
+        self._showPolys(keys)
+
+        # Производные полигоны, которые зависят от возвращенных (или сами возвращены), проверяются заново
+        for key_id in keys:
+            self.operationGraph.invalidate(key_id)
+            self.operationGraph.markDirty(key_id)
+        self._scheduleDerived()
+
+    def _setGeometry(self, key_id, geometry, movedIndices=None, polygon=None):
+        """
+        Заменяет геометрию полигона (при отмене и повторе, пакетных операциях). Если у полигона есть ROI и сдвинуто
+        немного вершин внешнего контура, узлы ROI переставляются на месте, иначе ROI пересоздается. polygon -
+        уже собранная shapely-геометрия, если она известна
+        """
+        roi = self.displayData.get(key_id, "exterior_object")
+        patchable = (roi is not None and movedIndices is not None and len(movedIndices) <= self.HANDLE_PATCH_LIMIT
+                     and len(roi.handles) == self.displayData.get(key_id, "ringOffsets")[1]
+                     and movedIndices.max() < len(roi.handles))
+
+        if self._ownedCoordinates.get(key_id) is not geometry.coordinates:
+            self._ownedCoordinates.pop(key_id, None)
+        self.displayData.update(key_id, coordinates=geometry.coordinates, ringOffsets=geometry.ringOffsets,
+                                partOffsets=geometry.partOffsets)
+        self.spatialIndex.insert(key_id, polygonFromFlat(geometry) if polygon is None else polygon)
+        self.fillRenderer.invalidate(key_id)
+        self._geometryChanged(key_id)
+
+        if patchable:
+            for i, (x, y) in zip(movedIndices.tolist(), geometry.coordinates[movedIndices].tolist()):
+                handle = roi.handles[i]['item']
+                local = roi.mapFromParent(QtCore.QPointF(x, y))
+                scenePos = roi.mapToScene(local)
+                for owner in handle.rois:
+                    owner.movePoint(handle, scenePos, finish=False, coords='scene')
+                roi.validator.moveVertex(i, local.x(), local.y())
+            self._applyLinePen(key_id)
+        else:
+            self._refreshPoly(key_id)
+
+    def _refreshPoly(self, key_id):
+        """
+        Перерисовывает полигон после отмены или повтора: ROI пересоздается с текущими геометрией и стилем
+        """
+        if self.displayData.get(key_id, "exterior_object") is not None:
+            self._demotePoly(key_id, show=False)
+            self._promotePoly(key_id)
+        else:
+            self.batchRenderer.show(key_id)
+
+    # ~~~ Перевод полигонов между пакетной отрисовкой и редактируемыми ROI ~~~ #
+
+    @property
+    def promotedKeys(self):
+        return self.displayData.roiKeys()
+
+    def _promotePoly(self, key_id):
+        """
+        Создает для полигона полноценный редактируемый PolyLineROI и убирает полигон из пакетной отрисовки
+        """
+        record = self.displayData[key_id]
+        if record.exterior_object is not None:
+            return
+
+        rings = flatRings(self.flatGeometryOf(key_id))
+        exteriorObj = ValidatedPolyLineROI(
+            rings[0],
+            rejectInvalid=self.rejectInvalidEdits,
             closed=True,
             movable=True,
-            pen=pg.mkPen(self.DEFAULT_LINE_COLOR,
-                         width=self.DEFAULT_LINE_WIDTH/3,
-                         style=self.getStyleFromStr(self.DEFAULT_LINE_STYLE)),
-            handlePen=pg.mkPen(self.DEFAULT_MARKER_COLOR)
+            pen=self.getLinePen(record.linecolor, record.linewidth, record.linestyle),
+            handlePen=self.styleCache.handlePen(record.markercolor, record.markersize)
         )
-        for handle in exteriorObj.handles:
-            handle['item'].pen.setWidth(self.DEFAULT_MARKER_SIZE)
         self.displayArea.addItem(exteriorObj)
 
         exteriorObj.sigRegionChangeStarted.connect(self.regionChangeStarted)
-        # exteriorObj.sigRegionChanged.connect(self.regionChanged)
+        exteriorObj.sigRegionChanged.connect(self.regionChanged)
         exteriorObj.sigRegionChangeFinished.connect(self.regionChangeFinished)
 
-        # Создаем новый полигон как объект структуры customPolygonStructure
-        newPolygon = self.customPolygonStructure(
-            newPolygonAsItem.data(1),
-            newPolygonAsItem.text(),
-            exteriorObj,
-            [],
-            self.DEFAULT_LINE_COLOR,
-            self.DEFAULT_LINE_WIDTH,
-            self.DEFAULT_LINE_STYLE,
-            self.DEFAULT_MARKER_COLOR,
-            self.DEFAULT_MARKER_SIZE,
-            self.DEFAULT_MARKER_STYLE,
-            self.DEFAULT_FILL_COLOR
-        )
+        # Вырезы и прочие части рисуются дочерней кривой ROI в его локальных координатах (при создании ROI они
+        # совпадают с мировыми), поэтому сдвигаются вместе с ним
+        if len(rings) > 1:
+            companion = pg.PlotCurveItem(pen=exteriorObj.pen, skipFiniteCheck=True)
+            companion.setData(*closedRingBuffer(rings[1:]))
+            companion.setParentItem(exteriorObj)
+            self.roiCompanions[key_id] = (companion, record.coordinates[record.ringOffsets[1]:])
 
-        # Добавляем Item в хранилище отображаемых полигонов
-        self.displayData.append(newPolygon)
+        self.displayData.update(key_id, exterior_object=exteriorObj)
+        self.batchRenderer.hide(key_id)
+        if not exteriorObj.isValid:
+            self._applyLinePen(key_id)
 
-        # Увеличиваем key_id для следующего полигона
-        self.key_id += 1
+    def _demotePoly(self, key_id, show=True):
+        """
+        Удаляет ROI полигона со сцены. Координаты в displayData уже актуальны (обновляются в
+        regionChangeFinished), поэтому полигон просто возвращается в пакетную отрисовку
+        """
+        roi = self.displayData.get(key_id, "exterior_object")
+        if roi is None:
+            return
 
-        # Информация
-        logging.info(f"Добавлен новый элемент {newPolygon.name} с ключом {newPolygon.key_id}")
+        roi.sigRegionChangeStarted.disconnect(self.regionChangeStarted)
+        roi.sigRegionChanged.disconnect(self.regionChanged)
+        roi.sigRegionChangeFinished.disconnect(self.regionChangeFinished)
+        self.roiCompanions.pop(key_id, None)
+        self._roiShownValid.pop(key_id, None)
+        self.displayArea.removeItem(roi)
+        self.displayData.update(key_id, exterior_object=None)
+
+        if show:
+            self.batchRenderer.show(key_id)
+
+    def _applyLinePen(self, key_id):
+        store = self.displayData
+        roi = store.get(key_id, "exterior_object")
+        if roi is not None:
+            # Невалидный контур подсвечивается, пока его не исправят
+            valid = roi.isValid
+            self._roiShownValid[key_id] = valid
+            pen = self.getLinePen(store.get(key_id, "linecolor") if valid else self.INVALID_LINE_COLOR,
+                                  store.get(key_id, "linewidth"), store.get(key_id, "linestyle"))
+            roi.setPen(pen)
+            if key_id in self.roiCompanions:
+                self.roiCompanions[key_id][0].setPen(pen)
+        else:
+            self.batchRenderer.show(key_id)
+
+    def _applyHandlePen(self, key_id):
+        store = self.displayData
+        roi = store.get(key_id, "exterior_object")
+        if roi is None:
+            return
+        # Перо общее для всех узлов с этим стилем (из styleCache), поэтому узлам оно присваивается, а не меняется
+        pen = self.styleCache.handlePen(store.get(key_id, "markercolor"), store.get(key_id, "markersize"))
+        for handle in roi.handles:
+            item = handle['item']
+            if item.currentPen is item.pen:
+                item.currentPen = pen
+            item.pen = pen
+            item.update()